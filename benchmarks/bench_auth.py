@@ -0,0 +1,276 @@
+"""Benchmarks of carto_auth against a local stub CARTO server.
+
+Usage:
+    python benchmarks/bench_auth.py [--latency 0.005] [--error-rate 0]
+        [--iterations 50] [--duration 1] [--output FILE] [--compare FILE]
+
+Results are stored by default in benchmarks/results/<commit>.json, so runs
+of different commits can be compared with --compare.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.stub_server import StubServer, patch_urls  # noqa: E402
+from carto_auth import CartoAuth, CredentialsError, RetryPolicy  # noqa: E402
+from carto_auth import utils  # noqa: E402
+from carto_auth.broker import BrokerClient, TokenBroker  # noqa: E402
+from carto_auth.utils import (  # noqa: E402
+    create_session,
+    get_api_base_url,
+    load_cache_file,
+    save_cache_file,
+)
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def measure(func, iterations):
+    """Run func iterations times and summarize the latency in milliseconds."""
+    timings = []
+    errors = 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        try:
+            func()
+        except CredentialsError:
+            errors += 1
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarize(timings, errors)
+
+
+def summarize(timings, errors=0):
+    timings = sorted(timings)
+    return {
+        "unit": "ms",
+        "n": len(timings),
+        "errors": errors,
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    }
+
+
+def measure_throughput(func, duration):
+    """Run func during duration seconds and return the operations per second."""
+    ops = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while True:
+        for _ in range(1000):
+            func()
+        ops += 1000
+        if time.perf_counter() >= deadline:
+            break
+    return {"unit": "ops/s", "n": ops, "value": ops / (time.perf_counter() - start)}
+
+
+def run(args, workdir):
+    filepath = workdir / "carto_credentials.json"
+    filepath.write_text(
+        json.dumps(
+            {
+                # Replaced by the stub server URL below
+                "api_base_url": "",
+                "client_id": "bench",
+                "client_secret": "bench",
+            }
+        )
+    )
+    cache_filepath = workdir / "token_m2m.json"
+    results = {}
+
+    with StubServer(latency=args.latency, error_rate=args.error_rate) as server:
+        content = json.loads(filepath.read_text())
+        content["api_base_url"] = server.url
+        filepath.write_text(json.dumps(content))
+
+        with patch_urls(server):
+            # A policy by scenario, so an open circuit does not affect the rest
+            policy = RetryPolicy()
+
+            def cold_from_m2m():
+                CartoAuth.from_m2m(
+                    filepath,
+                    cache_filepath=cache_filepath,
+                    use_cache=False,
+                    session=create_session(),
+                    retry_policy=policy,
+                )
+
+            results["cold_from_m2m"] = measure(cold_from_m2m, args.iterations)
+
+            policy = RetryPolicy()
+            carto_auth = CartoAuth.from_m2m(
+                filepath, cache_filepath=cache_filepath, retry_policy=policy
+            )
+            results["cached_from_m2m"] = measure(
+                lambda: CartoAuth.from_m2m(
+                    filepath, cache_filepath=cache_filepath, retry_policy=policy
+                ),
+                args.iterations,
+            )
+            results["get_access_token"] = measure_throughput(
+                carto_auth.get_access_token, args.duration
+            )
+
+            carto_auth._retry_policy = RetryPolicy()
+
+            def refresh():
+                carto_auth._expiration = 0
+                carto_auth.get_access_token()
+
+            results["refresh"] = measure(refresh, args.iterations)
+
+            carto_auth._retry_policy = RetryPolicy()
+
+            def carto_dw_credentials():
+                carto_auth._carto_dw_credentials = None
+                carto_auth.get_carto_dw_credentials()
+
+            results["carto_dw_credentials"] = measure(
+                carto_dw_credentials, args.iterations
+            )
+
+            broker = TokenBroker(
+                workdir / "broker.sock",
+                cache_filepath=cache_filepath,
+                retry_policy=RetryPolicy(),
+            ).start()
+            try:
+                client = BrokerClient(
+                    {"mode": "m2m", "filepath": str(filepath)}, broker.socket_path
+                )
+                client.get_token_info()
+                results["broker_lookup"] = measure(
+                    client.get_token_info, args.iterations
+                )
+            finally:
+                client.close()
+                broker.stop()
+
+            access_token = carto_auth.get_access_token()
+            policy = RetryPolicy()
+            results["api_base_url_discovery"] = measure(
+                lambda: get_api_base_url(access_token, use_cache=False, policy=policy),
+                args.iterations,
+            )
+
+        data = load_cache_file(cache_filepath)
+
+        def cache_load():
+            # Read the file, not the content kept in memory
+            utils._cache_files.clear()
+            load_cache_file(cache_filepath)
+
+        results["cache_load"] = measure(cache_load, args.iterations)
+        results["cache_load_hit"] = measure(
+            lambda: load_cache_file(cache_filepath), args.iterations
+        )
+
+        def cache_save():
+            # New data each time, so the file is written
+            data["expiration"] += 1
+            save_cache_file(cache_filepath, data)
+
+        results["cache_save"] = measure(cache_save, args.iterations)
+        results["cache_save_unchanged"] = measure(
+            lambda: save_cache_file(cache_filepath, data), args.iterations
+        )
+        requests = dict(server.requests)
+
+    return results, requests
+
+
+def get_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        )
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def format_result(result):
+    if result["unit"] == "ops/s":
+        return f"{result['value']:12.0f} ops/s"
+    return (
+        f"{result['median']:8.3f} ms median  {result['p95']:8.3f} ms p95"
+        f"  ({result['errors']} errors)"
+    )
+
+
+def compare(results, baseline):
+    print(f"\nCompared with {baseline['commit']}:")
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        key = "value" if result["unit"] == "ops/s" else "median"
+        if previous[key]:
+            change = (result[key] - previous[key]) / previous[key] * 100
+            print(f"  {name:24} {change:+7.1f}% {key}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=1)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path)
+    args = parser.parse_args(argv)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the user cache files untouched
+        os.environ["HOME"] = workdir
+        results, requests = run(args, Path(workdir))
+
+    commit = get_commit()
+    report = {
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "iterations": args.iterations,
+            "duration": args.duration,
+        },
+        "results": results,
+        "requests": requests,
+    }
+
+    for name, result in results.items():
+        print(f"{name:26} {format_result(result)}")
+
+    output = args.output or RESULTS_DIR / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults stored in {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Measure the import time of carto_auth with python -X importtime.
+
+Usage:
+    python benchmarks/import_time.py [--module carto_auth] [--runs 5]
+        [--budget 50] [--top 10]
+
+The script exits with status 1 if the median cumulative import time of the
+module is above the budget in milliseconds.
+"""
+
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def parse_importtime(output):
+    """Parse the output of -X importtime into (module, self_us, cumulative_us)."""
+    entries = []
+    for line in output.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, _, module = match.groups()
+            entries.append((module, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def measure(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(result.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="carto_auth")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, help="Budget in milliseconds")
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    totals = []
+    for _ in range(args.runs):
+        entries = measure(args.module)
+        total = next(c for m, _, c in reversed(entries) if m == args.module)
+        totals.append(total / 1000)
+
+    print(f"{args.module}: median {statistics.median(totals):.1f} ms")
+    print(f"runs: {', '.join(f'{t:.1f}' for t in totals)} ms")
+    print("\nSlowest modules (self time, last run):")
+    slowest = sorted(entries, key=lambda e: -e[1])[: args.top]
+    for module, self_us, cumulative_us in slowest:
+        print(f"  {self_us / 1000:7.1f} ms  {cumulative_us / 1000:7.1f} ms  {module}")
+
+    if args.budget is not None and statistics.median(totals) > args.budget:
+        print(f"\nOver budget: {statistics.median(totals):.1f} > {args.budget} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""Local stand-in for the CARTO endpoints used by carto_auth.
+
+It serves the OAuth token, accounts, tenant config.yaml and CARTO DW token
+endpoints with configurable latency and error rate. Use patch_urls to point
+carto_auth.utils to it.
+"""
+
+import json
+import time
+import random
+import threading
+import contextlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from carto_auth import utils
+
+TOKEN_PATH = "/oauth/token"
+ACCOUNTS_PATH = "/accounts"
+CONFIG_PATH = "/config.yaml"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send the headers and the body in one segment, avoiding delayed ACKs
+    wbufsize = -1
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+    def _handle(self):
+        server = self.server
+        server.count(self.path)
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and random.random() < server.error_rate:
+            return self._send(503, b"", "text/plain")
+
+        path = self.path.split("?")[0]
+        if path == TOKEN_PATH:
+            server.issued += 1
+            body = {
+                "access_token": f"token-{server.issued}",
+                "expires_in": server.expires_in,
+            }
+        elif path == ACCOUNTS_PATH:
+            body = {"tenant_domain": server.host}
+        elif path == CONFIG_PATH:
+            if self.headers.get("If-None-Match") == '"config"':
+                return self._send(304, b"", "text/plain")
+            config = f"apis:\n  baseUrl: {server.url}\n".encode("utf-8")
+            return self._send(200, config, "text/yaml", {"ETag": '"config"'})
+        elif path == utils.CARTO_DW_TOKEN_PATH:
+            body = {"projectId": "carto-dw-project", "token": "carto-dw-token"}
+        else:
+            return self._send(404, b"", "text/plain")
+
+        self._send(200, json.dumps(body).encode("utf-8"), "application/json")
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """Stub CARTO server running in a background thread.
+
+    Args:
+        latency (float, optional): Seconds to wait before each response.
+            Default 0.
+        error_rate (float, optional): Fraction of the requests answered with
+            a 503 error. Default 0.
+        expires_in (int, optional): Lifetime in seconds of the issued tokens.
+            Default 86400.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, error_rate=0, expires_in=86400):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.expires_in = expires_in
+        self.issued = 0
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def host(self):
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    @property
+    def url(self):
+        return f"http://{self.host}"
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+@contextlib.contextmanager
+def patch_urls(server):
+    """Send the requests of carto_auth.utils to the stub server."""
+    urls = {
+        "OAUTH_TOKEN_URL": f"{server.url}{TOKEN_PATH}",
+        "ACCOUNTS_URL": f"{server.url}{ACCOUNTS_PATH}",
+        "TENANT_CONFIG_URL": "http://{tenant_domain}" + CONFIG_PATH,
+    }
+    previous = {name: getattr(utils, name) for name in urls}
+    for name, url in urls.items():
+        setattr(utils, name, url)
+    try:
+        yield
+    finally:
+        for name, url in previous.items():
+            setattr(utils, name, url)
@@ -1,9 +1,35 @@
 from carto_auth._version import __version__
 from carto_auth.auth import CartoAuth
+from carto_auth.cache import (
+    TokenCache,
+    MemoryTokenCache,
+    FileTokenCache,
+    SQLiteTokenCache,
+    RedisTokenCache,
+)
 from carto_auth.errors import CredentialsError
+from carto_auth.metrics import Metrics
+from carto_auth.retry import RetryPolicy
 
 __all__ = [
     "__version__",
     "CartoAuth",
+    "AsyncCartoAuth",
+    "TokenCache",
+    "MemoryTokenCache",
+    "FileTokenCache",
+    "SQLiteTokenCache",
+    "RedisTokenCache",
     "CredentialsError",
+    "Metrics",
+    "RetryPolicy",
 ]
+
+
+def __getattr__(name):
+    # Avoid importing asyncio until the async API is used
+    if name == "AsyncCartoAuth":
+        from carto_auth.async_auth import AsyncCartoAuth
+
+        return AsyncCartoAuth
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,463 @@
+import sys
+import json
+import time
+import asyncio
+import functools
+
+from carto_auth.auth import (
+    CARTO_DW_TOKEN_TTL,
+    _is_carto_dw_valid,
+    _record_file_cache,
+    _record_refresh,
+)
+from carto_auth.errors import CredentialsError
+from carto_auth.jwt import get_jwt_tenant_domain, get_jwt_expiration
+from carto_auth.metrics import get_default_metrics, TTL_BUCKETS
+from carto_auth.retry import get_default_policy
+from carto_auth.token_state import TokenState
+from carto_auth.utils import (
+    get_cache_filepath,
+    get_cache_key,
+    load_cache_file,
+    save_cache_file,
+    api_headers,
+    is_token_expired,
+    get_oauth_token_info,
+    load_refresh_token,
+    save_refresh_token,
+    m2m_token_payload,
+    parse_m2m_token_response,
+    parse_accounts_response,
+    parse_tenant_config_response,
+    tenant_config_headers,
+    load_tenant_cache,
+    save_tenant_cache,
+    parse_carto_dw_response,
+    OAUTH_TOKEN_URL,
+    ACCOUNTS_URL,
+    TENANT_CONFIG_URL,
+    CARTO_DW_TOKEN_PATH,
+    FORM_HEADERS,
+)
+
+
+class AsyncCartoAuth:
+    """Asyncio version of CartoAuth.
+
+    It uses the same cache files as CartoAuth. The requests are sent with
+    an httpx.AsyncClient and the files are read and written in the default
+    executor, so the event loop is never blocked. The interactive OAuth
+    flow also runs in the default executor.
+
+    It requires extra dependencies carto-auth[async] to be installed.
+
+    Args:
+        mode (str): Type of authentication: oauth, m2m.
+        api_base_url (str, optional): Base URL for a CARTO account.
+        access_token (str, optional): Token already generated with CARTO.
+        expiration (int, optional): Time in seconds when the token will be expired.
+            Default the exp claim of the access_token.
+        client_id (str, optional): Client id of a M2M application
+            provided by CARTO.
+        client_secret (str, optional): Client secret of a M2M application
+            provided by CARTO.
+        cache_filepath (str, optional): File path where the token is stored.
+        use_cache (bool, optional): Whether the stored cached token should be used.
+            Default True.
+        open_browser (bool, optional): Whether the web browser should be opened
+            to authorize a user. Default True.
+        org (str, optional): Single Sign-On (SSO) organization in CARTO.
+        client (httpx.AsyncClient, optional): Client used for the requests
+            to CARTO. Default a new client owned by this object.
+        retry_policy (RetryPolicy, optional): Timeouts, retries and circuit
+            breaker of the requests to CARTO. Default a policy shared by all
+            CartoAuth objects.
+        metrics (Metrics, optional): Metrics where the cache hits, refreshes
+            and CARTO DW fetches are recorded. Default the metrics shared by
+            all CartoAuth objects.
+    """
+
+    def __init__(
+        self,
+        mode,
+        api_base_url=None,
+        access_token=None,
+        expiration=None,
+        client_id=None,
+        client_secret=None,
+        cache_filepath=None,
+        use_cache=True,
+        open_browser=True,
+        org=None,
+        client=None,
+        retry_policy=None,
+        metrics=None,
+    ):
+        if mode not in ("oauth", "m2m"):
+            raise CredentialsError("Mode not supported. Available modes: oauth, m2m")
+
+        self._mode = mode
+        self._api_base_url = api_base_url
+        if access_token and not expiration:
+            expiration = get_jwt_expiration(access_token)
+        self._token = TokenState(access_token, expiration)
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._cache_filepath = cache_filepath
+        self._use_cache = use_cache
+        self._open_browser = open_browser
+        self._org = org
+        self._refresh_token = None
+        self._client = client
+        self._owns_client = client is None
+        self._retry_policy = retry_policy or get_default_policy()
+        self._metrics = metrics or get_default_metrics()
+        self._memory_hits = self._metrics.counter(
+            "cache_requests_total", layer="memory", result="hit"
+        )
+        self._ttl_at_use = self._metrics.histogram(
+            "token_ttl_at_use_seconds", TTL_BUCKETS
+        )
+        self._refresh_lock = None
+        self._carto_dw_lock = None
+        self._carto_dw_credentials = None
+        self._cache_key = get_cache_key(
+            mode, client_id if mode == "m2m" else None, org, api_base_url
+        )
+
+    @classmethod
+    async def from_oauth(
+        cls,
+        cache_filepath=None,
+        use_cache=True,
+        open_browser=True,
+        api_base_url=None,
+        org=None,
+        client=None,
+        retry_policy=None,
+        metrics=None,
+    ):
+        """Create an AsyncCartoAuth object using OAuth with CARTO.
+
+        Args:
+            cache_filepath (str, optional): File path where the token is stored.
+                Default "home()/.carto-auth/token_oauth_<key>.json", a file
+                for each org and api_base_url.
+            use_cache (bool, optional): Whether the stored cached token should be used.
+                Default True.
+            open_browser (bool, optional): Whether the web browser should be opened
+                to authorize a user. Default True.
+            api_base_url (str, optional): Base URL for a CARTO account.
+            org (str, optional): Single Sign-On (SSO) organization in CARTO.
+            client (httpx.AsyncClient, optional): Client used for the requests.
+            retry_policy (RetryPolicy, optional): Retry policy of the requests.
+            metrics (Metrics, optional): Metrics of this object.
+        """
+        mode = "oauth"
+
+        if cache_filepath is None:
+            cache_key = get_cache_key(mode, org=org, api_base_url=api_base_url)
+            cache_filepath = await _run(get_cache_filepath, mode, cache_key)
+
+        carto_auth = cls(
+            mode=mode,
+            api_base_url=api_base_url,
+            cache_filepath=cache_filepath,
+            use_cache=use_cache,
+            open_browser=open_browser,
+            org=org,
+            client=client,
+            retry_policy=retry_policy,
+            metrics=metrics,
+        )
+
+        if use_cache:
+            data = await _run(load_cache_file, cache_filepath)
+            if data and data.get("key") != carto_auth._cache_key:
+                # Token of another identity or of a previous version
+                data = None
+            _record_file_cache(carto_auth._metrics, data)
+            if (
+                data
+                and data.get("api_base_url")
+                and not is_token_expired(data.get("expiration"))
+            ):
+                carto_auth._api_base_url = data.get("api_base_url")
+                carto_auth._token = TokenState(
+                    data.get("access_token"), data.get("expiration")
+                )
+                await carto_auth._save_cache_file()
+                return carto_auth
+
+        await carto_auth._refresh_access_token()
+        if not carto_auth._api_base_url:
+            carto_auth._api_base_url = await carto_auth._fetch_api_base_url()
+            await carto_auth._save_cache_file()
+
+        return carto_auth
+
+    @classmethod
+    async def from_m2m(
+        cls,
+        filepath,
+        cache_filepath=None,
+        use_cache=True,
+        client=None,
+        retry_policy=None,
+        metrics=None,
+    ):
+        """Create an AsyncCartoAuth object using CARTO credentials file.
+
+        Args:
+            filepath (str): File path of the CARTO credentials file.
+            cache_filepath (str, optional): File path where the token is stored.
+                Default "home()/.carto-auth/token_m2m_<key>.json", a file
+                for each client_id and api_base_url.
+            use_cache (bool, optional): Whether the stored cached token should be used.
+                Default True.
+            client (httpx.AsyncClient, optional): Client used for the requests.
+            retry_policy (RetryPolicy, optional): Retry policy of the requests.
+            metrics (Metrics, optional): Metrics of this object.
+
+        Raises:
+            AttributeError: If the CARTO credentials file does not contain the
+                attributes "api_base_url", "client_id", "client_secret".
+            ValueError: If the CARTO credentials file does not contain any
+                attribute value.
+        """
+        mode = "m2m"
+
+        content = await _run(_load_json, filepath)
+        for attr in ("api_base_url", "client_id", "client_secret"):
+            if attr not in content:
+                raise AttributeError(f"Missing attribute {attr} from {filepath}")
+            if not content[attr]:
+                raise ValueError(f"Missing value for {attr} in {filepath}")
+
+        if cache_filepath is None:
+            cache_key = get_cache_key(
+                mode, content.get("client_id"), api_base_url=content.get("api_base_url")
+            )
+            cache_filepath = await _run(get_cache_filepath, mode, cache_key)
+
+        carto_auth = cls(
+            mode=mode,
+            api_base_url=content.get("api_base_url"),
+            client_id=content.get("client_id"),
+            client_secret=content.get("client_secret"),
+            cache_filepath=cache_filepath,
+            use_cache=use_cache,
+            client=client,
+            retry_policy=retry_policy,
+            metrics=metrics,
+        )
+
+        if use_cache:
+            data = await _run(load_cache_file, cache_filepath)
+            if data and data.get("key") != carto_auth._cache_key:
+                # Token of another identity or of a previous version
+                data = None
+            _record_file_cache(carto_auth._metrics, data)
+            if (
+                data
+                and data.get("api_base_url")
+                and not is_token_expired(data.get("expiration"))
+            ):
+                carto_auth._api_base_url = data.get("api_base_url")
+                carto_auth._token = TokenState(
+                    data.get("access_token"), data.get("expiration")
+                )
+                await carto_auth._save_cache_file()
+                return carto_auth
+
+        await carto_auth._refresh_access_token()
+        return carto_auth
+
+    async def get_api_base_url(self):
+        return self._api_base_url
+
+    async def get_access_token(self):
+        token = self._token
+        ttl = token.deadline - time.monotonic()
+        if ttl > 0 and token.access_token:
+            self._memory_hits.inc()
+            self._ttl_at_use.observe(ttl)
+            return token.access_token
+
+        # Token expired
+        self._metrics.inc("cache_requests_total", layer="memory", result="miss")
+        return await self._refresh_access_token(token.access_token)
+
+    def stats(self):
+        """Get a snapshot of the metrics of this object.
+
+        They are the metrics passed in the metrics parameter or, by default,
+        the ones shared by all the objects of the process. See
+        metrics.Metrics.stats.
+        """
+        return self._metrics.stats()
+
+    async def get_carto_dw_credentials(self) -> tuple:
+        """Get the CARTO Data Warehouse credentials.
+
+        The credentials are cached until they expire or the access token changes.
+
+        Returns:
+            tuple: carto_dw_project, carto_dw_token.
+
+        Raises:
+            CredentialsError: If the API Base URL is not provided,
+                the response is not JSON or has invalid attributes.
+        """
+        if not self._api_base_url:
+            raise CredentialsError("api_base_url required")
+
+        access_token = await self.get_access_token()
+
+        credentials = self._carto_dw_credentials
+        if not _is_carto_dw_valid(credentials, access_token):
+            if self._carto_dw_lock is None:
+                self._carto_dw_lock = asyncio.Lock()
+            async with self._carto_dw_lock:
+                credentials = self._carto_dw_credentials
+                if not _is_carto_dw_valid(credentials, access_token):
+                    credentials = await self._fetch_carto_dw_credentials(access_token)
+                    self._carto_dw_credentials = credentials
+
+        return credentials["project_id"], credentials["token"]
+
+    async def aclose(self):
+        """Close the HTTP client if it is owned by this object."""
+        if self._owns_client and self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _refresh_access_token(self, stale_token=None):
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+
+        async with self._refresh_lock:
+            token = self._token
+            if token.access_token != stale_token and not token.is_expired():
+                # Already renewed by another task
+                return token.access_token
+
+            with _record_refresh(self._metrics, self._mode):
+                if self._mode == "oauth":
+                    data = await self._fetch_oauth_token_info()
+                elif self._mode == "m2m":
+                    data = await self._fetch_m2m_token_info()
+
+            self._token = TokenState(data.get("access_token"), data.get("expiration"))
+            await self._save_cache_file()
+
+            return self._token.access_token
+
+    async def _fetch_oauth_token_info(self):
+        refresh_token = self._refresh_token
+        if self._use_cache:
+            refresh_token = (
+                await _run(load_refresh_token, self._cache_key) or refresh_token
+            )
+
+        data = await _run(
+            get_oauth_token_info,
+            self._open_browser,
+            self._org,
+            None,
+            self._retry_policy,
+            refresh_token,
+        )
+
+        self._refresh_token = data.get("refresh_token")
+        if self._use_cache:
+            await _run(save_refresh_token, self._cache_key, self._refresh_token)
+        return data
+
+    async def _fetch_m2m_token_info(self):
+        response = await self._request(
+            "POST",
+            OAUTH_TOKEN_URL,
+            headers=FORM_HEADERS,
+            data=m2m_token_payload(self._client_id, self._client_secret),
+        )
+        return parse_m2m_token_response(response)
+
+    async def _fetch_api_base_url(self):
+        tenant_domain = get_jwt_tenant_domain(self._token.access_token)
+        if tenant_domain is None:
+            response = await self._request(
+                "GET", ACCOUNTS_URL, headers=api_headers(self._token.access_token)
+            )
+            tenant_domain = parse_accounts_response(response)
+
+        if tenant_domain:
+            entry = None
+            if self._use_cache:
+                entry = await _run(load_tenant_cache, tenant_domain)
+            if entry and time.time() < entry.get("expiration", 0):
+                return entry["api_base_url"]
+
+            url = TENANT_CONFIG_URL.format(tenant_domain=tenant_domain)
+            response = await self._request(
+                "GET", url, headers=tenant_config_headers(entry)
+            )
+            entry = parse_tenant_config_response(response, entry)
+            if self._use_cache:
+                await _run(save_tenant_cache, tenant_domain, entry)
+            return entry["api_base_url"]
+
+    async def _fetch_carto_dw_credentials(self, access_token):
+        url = f"{self._api_base_url}{CARTO_DW_TOKEN_PATH}"
+        self._metrics.inc("carto_dw_fetches_total")
+        response = await self._request("GET", url, headers=api_headers(access_token))
+        project_id, token = parse_carto_dw_response(response)
+
+        return {
+            "project_id": project_id,
+            "token": token,
+            "expiration": int(time.time()) + CARTO_DW_TOKEN_TTL,
+            "access_token": access_token,
+        }
+
+    async def _request(self, method, url, **kwargs):
+        return await self._retry_policy.arequest(
+            self._get_client(), method, url, **kwargs
+        )
+
+    def _get_client(self):
+        if self._client is None:
+            try:
+                import httpx
+            except ImportError:
+                sys.stderr.write("Error: async extension not found.\n")
+                sys.stderr.write("Please, install carto-auth[async]\n")
+                raise
+            self._client = httpx.AsyncClient()
+        return self._client
+
+    async def _save_cache_file(self):
+        if self._use_cache and self._cache_filepath:
+            data = {
+                "api_base_url": self._api_base_url,
+                "access_token": self._token.access_token,
+                "expiration": self._token.expiration,
+                "key": self._cache_key,
+            }
+            await _run(save_cache_file, self._cache_filepath, data)
+
+
+def _load_json(filepath):
+    with open(filepath, "r") as f:
+        return json.load(f)
+
+
+async def _run(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
@@ -1,19 +1,147 @@
+import os
 import sys
 import json
-import requests
+import time
+import contextlib
+import logging
+import weakref
+import threading
+
+from datetime import datetime, timezone
 
 from carto_auth.errors import CredentialsError
+from carto_auth.jwt import get_jwt_expiration, verify_jwt
+from carto_auth.metrics import get_default_metrics, TTL_BUCKETS
+from carto_auth.shm import SharedTokenSlot, get_shared_slot_filepath
+from carto_auth.token_state import TokenState
 from carto_auth.utils import (
     get_cache_filepath,
+    get_cache_key,
     load_cache_file,
     save_cache_file,
+    lock_cache_file,
     api_headers,
     is_token_expired,
     get_oauth_token_info,
     get_m2m_token_info,
+    load_refresh_token,
+    save_refresh_token,
     get_api_base_url,
+    get_session,
+    request,
+    parse_carto_dw_response,
+    CARTO_DW_TOKEN_PATH,
 )
 
+logger = logging.getLogger(__name__)
+
+REFRESH_RETRY_INTERVAL = 10
+
+# The CARTO DW token response has no expiration. BigQuery access tokens
+# last one hour, but the token may have been issued before the request.
+CARTO_DW_TOKEN_TTL = 1800
+CARTO_DW_REFRESH_MARGIN = 300
+
+# Objects whose locks and threads are recreated in forked processes
+_instances = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for carto_auth in list(_instances):
+        carto_auth._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _get_oauth_token_info(
+    cache_key,
+    use_cache,
+    open_browser,
+    org,
+    refresh_token=None,
+    session=None,
+    policy=None,
+):
+    """Get an OAuth token with the stored refresh token, or in the browser."""
+    if use_cache:
+        refresh_token = load_refresh_token(cache_key) or refresh_token
+
+    data = get_oauth_token_info(
+        open_browser, org, session=session, policy=policy, refresh_token=refresh_token
+    )
+
+    if use_cache:
+        save_refresh_token(cache_key, data.get("refresh_token"))
+
+    return data
+
+
+def _cache_lock(cache_filepath, shared, token_cache=None, cache_key=None):
+    if not shared:
+        return contextlib.nullcontext()
+    if token_cache is not None:
+        return token_cache.lock(cache_key)
+    return lock_cache_file(cache_filepath)
+
+
+def _load_cache(cache_filepath, token_cache=None, cache_key=None):
+    if token_cache is not None:
+        return token_cache.get(cache_key)
+
+    data = load_cache_file(cache_filepath)
+    # Ignore tokens of other identities stored in the same cache file, and
+    # files of previous versions without key, whose expiration may be wrong
+    if data and data.get("key") == cache_key:
+        return data
+
+
+def _is_carto_dw_valid(credentials, access_token, min_ttl=0):
+    return (
+        credentials is not None
+        and credentials.get("access_token") == access_token
+        and time.time() + min_ttl < credentials.get("expiration", 0)
+    )
+
+
+@contextlib.contextmanager
+def _record_refresh(metrics, mode):
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        metrics.inc("token_refresh_errors_total", mode=mode)
+        raise
+    metrics.inc("token_refreshes_total", mode=mode)
+    metrics.observe(
+        "token_refresh_duration_seconds", time.monotonic() - start, mode=mode
+    )
+
+
+def _record_file_cache(metrics, data):
+    result = "hit" if data and not is_token_expired(data.get("expiration")) else "miss"
+    metrics.inc("cache_requests_total", layer="file", result=result)
+
+
+def _import_carto_dw_modules():
+    try:
+        import google.cloud.bigquery  # noqa: F401
+        import google.oauth2.credentials  # noqa: F401
+    except ImportError:
+        # Reported by get_carto_dw_client
+        pass
+
+
+def _log_prewarm_error(future):
+    if future.exception() is not None:
+        logger.error("Prewarm failed", exc_info=future.exception())
+
+
+def _utc_datetime(timestamp):
+    # google-auth expects naive UTC datetimes
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
 
 class CartoAuth:
     """CARTO Authentication object used to gather connect with the CARTO services.
@@ -23,6 +151,7 @@ class CartoAuth:
         api_base_url (str, optional): Base URL for a CARTO account.
         access_token (str, optional): Token already generated with CARTO.
         expiration (int, optional): Time in seconds when the token will be expired.
+            Default the exp claim of the access_token.
         client_id (str, optional): Client id of a M2M application
             provided by CARTO.
         client_secret (str, optional): Client secret of a M2M application
@@ -34,6 +163,53 @@ class CartoAuth:
         open_browser (bool, optional): Whether the web browser should be opened
             to authorize a user. Default True.
         org (str, optional): Single Sign-On (SSO) organization in CARTO.
+        refresh_token (str, optional): OAuth refresh token used to renew
+            the access token without opening the browser. With use_cache,
+            it is stored in its own file readable only by the user.
+        refresh_skew (int, optional): Seconds before the expiration when the
+            background refresh renews the token. Default 300.
+        background_refresh (bool, optional): Whether the token should be renewed
+            in a background thread before it expires. Only available
+            for m2m mode. The thread is restarted in forked processes only
+            with shared_memory. Default False.
+        refresh_timeout (float, optional): Seconds to wait for a token refresh
+            in progress in another thread. Default 60.
+        shared_cache (bool, optional): Whether the cache file is shared between
+            processes. If True, the cache file is locked while the token is
+            renewed, so only one process requests a new token and the rest
+            read it from the file. Default False.
+        session (requests.Session, optional): Session used for the requests
+            to CARTO. Default a session shared by all CartoAuth objects,
+            see utils.create_session to configure a custom connection pool.
+        cache_carto_dw (bool, optional): Whether the CARTO DW credentials should
+            also be stored in the cache file. Default False.
+        carto_dw_credentials (dict, optional): CARTO DW credentials already
+            generated for the access_token, with keys "project_id", "token"
+            and "expiration".
+        token_cache (TokenCache, optional): Cache that stores the tokens of many
+            identities, like FileTokenCache, SQLiteTokenCache or RedisTokenCache.
+            If provided, it is used instead of cache_filepath.
+        cache_key (str, optional): Key of the token in the cache.
+            Default built from mode, client_id, org and api_base_url.
+        retry_policy (RetryPolicy, optional): Timeouts, retries and circuit
+            breaker of the requests to CARTO. Default a policy shared by all
+            CartoAuth objects.
+        metrics (Metrics, optional): Metrics where the cache hits, refreshes
+            and CARTO DW fetches are recorded. Default the metrics shared by
+            all CartoAuth objects.
+        prewarm (bool, optional): Whether the access token, API base URL and
+            CARTO DW credentials should be fetched in a background thread
+            when the object is created, see prewarm. Default False.
+        verify_token (bool, optional): Whether the signature and claims of
+            access_token should be verified with the public keys of CARTO,
+            see jwt.verify_jwt. It requires carto-auth[jwt]. Default False.
+        broker (TokenChannel, optional): Channel that provides the tokens
+            instead of CARTO, see from_broker and delegate.
+        shared_memory (bool, optional): Whether the token should be shared
+            in memory with the other processes of the host with the same
+            identity, like the workers forked from this process. Only one
+            process renews the token and the rest read it from memory,
+            see shm.SharedTokenSlot. Default False.
     """
 
     def __init__(
@@ -48,20 +224,78 @@ class CartoAuth:
         use_cache=True,
         open_browser=True,
         org=None,
+        refresh_token=None,
+        refresh_skew=300,
+        background_refresh=False,
+        refresh_timeout=60,
+        shared_cache=False,
+        session=None,
+        cache_carto_dw=False,
+        carto_dw_credentials=None,
+        token_cache=None,
+        cache_key=None,
+        retry_policy=None,
+        metrics=None,
+        prewarm=False,
+        verify_token=False,
+        broker=None,
+        shared_memory=False,
     ):
         self._mode = mode
         self._api_base_url = api_base_url
         self._cache_filepath = cache_filepath
         self._use_cache = use_cache
+        self._shared_cache = shared_cache
+        self._token_cache = token_cache
+        self._cache_key = cache_key or get_cache_key(
+            mode, client_id if mode == "m2m" else None, org, api_base_url
+        )
+        self._session = session
+        self._broker = broker
+        self._retry_policy = retry_policy
+        self._metrics = metrics or get_default_metrics()
+        self._memory_hits = self._metrics.counter(
+            "cache_requests_total", layer="memory", result="hit"
+        )
+        self._ttl_at_use = self._metrics.histogram(
+            "token_ttl_at_use_seconds", TTL_BUCKETS
+        )
         self._org = org
+        self._refresh_skew = refresh_skew
+        self._refresh_timeout = refresh_timeout
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_stop = threading.Event()
+        self._last_used = None
+        self._cache_carto_dw = cache_carto_dw
+        self._carto_dw_credentials = None
+        self._carto_dw_lock = threading.Lock()
+        self._carto_dw_client = None
+        self._carto_dw_client_lock = threading.Lock()
+
+        if carto_dw_credentials and access_token:
+            self._carto_dw_credentials = dict(
+                carto_dw_credentials, access_token=access_token
+            )
+
+        if access_token and not expiration:
+            expiration = get_jwt_expiration(access_token)
+        if access_token and verify_token:
+            verify_jwt(access_token, session, retry_policy, use_cache)
+        self._token = TokenState(access_token, expiration)
+
+        self._shared_slot = None
+        self._slot_generation = 0
+        if shared_memory:
+            self._shared_slot = SharedTokenSlot(
+                get_shared_slot_filepath(self._cache_key)
+            )
+            self._load_shared_slot()
 
         if mode == "oauth":
-            self._access_token = access_token
-            self._expiration = expiration
             self._open_browser = open_browser
+            self._refresh_token = refresh_token
         elif mode == "m2m":
-            self._access_token = access_token
-            self._expiration = expiration
             self._client_id = client_id
             self._client_secret = client_secret
         else:
@@ -69,6 +303,16 @@ class CartoAuth:
 
         self._save_cache_file()
 
+        if background_refresh:
+            self.start_background_refresh()
+
+        _instances.add(self)
+
+        self._prewarm_future = None
+        if prewarm:
+            self._prewarm_future = self.prewarm(wait=False)
+            self._prewarm_future.add_done_callback(_log_prewarm_error)
+
     @classmethod
     def from_oauth(
         cls,
@@ -77,64 +321,111 @@ class CartoAuth:
         open_browser=True,
         api_base_url=None,
         org=None,
+        shared_cache=False,
+        **kwargs,
     ):
         """Create a CartoAuth object using OAuth with CARTO.
 
         Args:
             cache_filepath (str, optional): File path where the token is stored.
-                Default "home()/.carto-auth/token_oauth.json".
+                Default "home()/.carto-auth/token_oauth_<key>.json", a file
+                for each org and api_base_url.
             use_cache (bool, optional): Whether the stored cached token should be used.
                 Default True.
             open_browser (bool, optional): Whether the web browser should be opened
                 to authorize a user. Default True.
             api_base_url (str, optional): Base URL for a CARTO account.
             org (str, optional): Single Sign-On (SSO) organization in CARTO.
+            shared_cache (bool, optional): Whether the cache file is shared
+                between processes. Default False.
+            **kwargs: Extra arguments passed to the CartoAuth constructor.
         """
         mode = "oauth"
 
-        if cache_filepath is None:
-            cache_filepath = get_cache_filepath(mode)
+        cache_key = get_cache_key(mode, org=org, api_base_url=api_base_url)
+        token_cache = kwargs.get("token_cache")
+        if cache_filepath is None and token_cache is None:
+            cache_filepath = get_cache_filepath(mode, cache_key)
 
-        if use_cache:
-            data = load_cache_file(cache_filepath)
-            if (
-                data
-                and data.get("api_base_url")
-                and not is_token_expired(data.get("expiration"))
-            ):
-                return cls(
-                    mode=mode,
-                    api_base_url=data.get("api_base_url"),
-                    access_token=data.get("access_token"),
-                    expiration=data.get("expiration"),
-                    cache_filepath=cache_filepath,
-                    use_cache=use_cache,
-                    open_browser=open_browser,
-                    org=org,
-                )
+        metrics = kwargs.get("metrics") or get_default_metrics()
+        shared = use_cache and shared_cache
 
-        data = get_oauth_token_info(open_browser, org)
-        return cls(
-            mode=mode,
-            api_base_url=api_base_url or get_api_base_url(data.get("access_token")),
-            access_token=data.get("access_token"),
-            expiration=data.get("expiration"),
-            cache_filepath=cache_filepath,
-            use_cache=use_cache,
-            open_browser=open_browser,
-            org=org,
-        )
+        with _cache_lock(cache_filepath, shared, token_cache, cache_key):
+            if use_cache:
+                data = _load_cache(cache_filepath, token_cache, cache_key)
+                _record_file_cache(metrics, data)
+                if (
+                    data
+                    and data.get("api_base_url")
+                    and not is_token_expired(data.get("expiration"))
+                ):
+                    return cls(
+                        mode=mode,
+                        api_base_url=data.get("api_base_url"),
+                        access_token=data.get("access_token"),
+                        expiration=data.get("expiration"),
+                        carto_dw_credentials=data.get("carto_dw"),
+                        cache_filepath=cache_filepath,
+                        use_cache=use_cache,
+                        open_browser=open_browser,
+                        org=org,
+                        shared_cache=shared_cache,
+                        cache_key=cache_key,
+                        **kwargs,
+                    )
+
+            session = kwargs.get("session")
+            policy = kwargs.get("retry_policy")
+            with _record_refresh(metrics, mode):
+                data = _get_oauth_token_info(
+                    cache_key,
+                    use_cache,
+                    open_browser,
+                    org,
+                    session=session,
+                    policy=policy,
+                )
+            access_token = data.get("access_token")
+            return cls(
+                mode=mode,
+                api_base_url=api_base_url
+                or get_api_base_url(
+                    access_token, session=session, use_cache=use_cache, policy=policy
+                ),
+                access_token=access_token,
+                expiration=data.get("expiration"),
+                cache_filepath=cache_filepath,
+                use_cache=use_cache,
+                open_browser=open_browser,
+                org=org,
+                refresh_token=data.get("refresh_token"),
+                shared_cache=shared_cache,
+                cache_key=cache_key,
+                **kwargs,
+            )
 
     @classmethod
-    def from_m2m(cls, filepath, cache_filepath=None, use_cache=True):
+    def from_m2m(
+        cls,
+        filepath,
+        cache_filepath=None,
+        use_cache=True,
+        shared_cache=False,
+        **kwargs,
+    ):
         """Create a CartoAuth object using CARTO credentials file.
 
         Args:
             filepath (str): File path of the CARTO credentials file.
             cache_filepath (str, optional): File path where the token is stored.
-                Default "home()/.carto-auth/token_m2m.json".
+                Default "home()/.carto-auth/token_m2m_<key>.json", a file
+                for each client_id and api_base_url.
             use_cache (bool, optional): Whether the stored cached token should be used.
                 Default True.
+            shared_cache (bool, optional): Whether the cache file is shared
+                between processes. Default False.
+            **kwargs: Extra arguments passed to the CartoAuth constructor,
+                like refresh_skew or background_refresh.
 
         Raises:
             AttributeError: If the CARTO credentials file does not contain the
@@ -156,61 +447,420 @@ class CartoAuth:
         client_id = content.get("client_id")
         client_secret = content.get("client_secret")
 
-        if cache_filepath is None:
-            cache_filepath = get_cache_filepath(mode)
+        cache_key = get_cache_key(mode, client_id, api_base_url=api_base_url)
+        token_cache = kwargs.get("token_cache")
+        if cache_filepath is None and token_cache is None:
+            cache_filepath = get_cache_filepath(mode, cache_key)
 
-        if use_cache:
-            data = load_cache_file(cache_filepath)
-            if (
-                data
-                and data.get("api_base_url")
-                and not is_token_expired(data.get("expiration"))
-            ):
-                return cls(
-                    mode=mode,
-                    api_base_url=data.get("api_base_url"),
-                    access_token=data.get("access_token"),
-                    expiration=data.get("expiration"),
-                    client_id=client_id,
-                    client_secret=client_secret,
-                    cache_filepath=cache_filepath,
-                    use_cache=use_cache,
+        metrics = kwargs.get("metrics") or get_default_metrics()
+        shared = use_cache and shared_cache
+
+        with _cache_lock(cache_filepath, shared, token_cache, cache_key):
+            if use_cache:
+                data = _load_cache(cache_filepath, token_cache, cache_key)
+                _record_file_cache(metrics, data)
+                if (
+                    data
+                    and data.get("api_base_url")
+                    and not is_token_expired(data.get("expiration"))
+                ):
+                    return cls(
+                        mode=mode,
+                        api_base_url=data.get("api_base_url"),
+                        access_token=data.get("access_token"),
+                        expiration=data.get("expiration"),
+                        carto_dw_credentials=data.get("carto_dw"),
+                        client_id=client_id,
+                        client_secret=client_secret,
+                        cache_filepath=cache_filepath,
+                        use_cache=use_cache,
+                        shared_cache=shared_cache,
+                        cache_key=cache_key,
+                        **kwargs,
+                    )
+
+            with _record_refresh(metrics, mode):
+                data = get_m2m_token_info(
+                    client_id,
+                    client_secret,
+                    session=kwargs.get("session"),
+                    policy=kwargs.get("retry_policy"),
                 )
+            return cls(
+                mode=mode,
+                api_base_url=api_base_url,
+                access_token=data.get("access_token"),
+                expiration=data.get("expiration"),
+                client_id=client_id,
+                client_secret=client_secret,
+                cache_filepath=cache_filepath,
+                use_cache=use_cache,
+                shared_cache=shared_cache,
+                cache_key=cache_key,
+                **kwargs,
+            )
+
+    @classmethod
+    def from_broker(cls, filepath, socket_path=None, **kwargs):
+        """Create a CartoAuth object that gets its tokens from a TokenBroker.
+
+        The token is kept in memory until it expires, and then requested
+        again to the broker, which renews it in advance. Start the broker
+        with the carto-auth-broker command.
+
+        Args:
+            filepath (str): File path of the CARTO credentials file,
+                readable by the broker.
+            socket_path (str, optional): File path of the Unix socket of the
+                broker. Default "home()/.carto-auth/broker.sock".
+            **kwargs: Extra arguments passed to the CartoAuth constructor.
 
-        data = get_m2m_token_info(client_id, client_secret)
+        Raises:
+            CredentialsError: If the broker is not available or cannot get
+                the token.
+        """
+        from carto_auth.broker import BrokerClient
+
+        identity = {"mode": "m2m", "filepath": os.path.abspath(filepath)}
+        broker = BrokerClient(identity, socket_path)
+        data = broker.get_token_info()
         return cls(
-            mode=mode,
-            api_base_url=api_base_url,
+            mode="m2m",
+            api_base_url=data.get("api_base_url"),
             access_token=data.get("access_token"),
             expiration=data.get("expiration"),
-            client_id=client_id,
-            client_secret=client_secret,
-            cache_filepath=cache_filepath,
-            use_cache=use_cache,
+            use_cache=False,
+            broker=broker,
+            **kwargs,
+        )
+
+    def delegate(self, channel=None):
+        """Create a picklable handle of this object for other processes.
+
+        The handle carries the current access token, API base URL and
+        CARTO DW credentials, but not the client secret nor the refresh
+        token, so it can be sent to multiprocessing, Dask or Spark workers.
+        When the token expires, the workers ask this process for a new one
+        through the channel instead of requesting it to CARTO.
+
+        Example:
+            with DelegateServer(carto_auth) as server:
+                handle = carto_auth.delegate(server.channel())
+                pool.map(work, [handle] * 100)
+
+        Args:
+            channel (TokenChannel, optional): Channel to this process, like
+                DelegateServer.channel. Without a channel, the handle fails
+                when the token expires.
+
+        Returns:
+            DelegatedCartoAuth: Handle with the current token.
+        """
+        from carto_auth.delegate import DelegatedCartoAuth, _public_carto_dw
+
+        self.get_access_token()
+        token = self._token
+        credentials = self._carto_dw_credentials
+        if _is_carto_dw_valid(credentials, token.access_token):
+            credentials = _public_carto_dw(credentials)
+        else:
+            credentials = None
+
+        return DelegatedCartoAuth(
+            self._mode,
+            self._api_base_url,
+            token.access_token,
+            token.expiration,
+            carto_dw_credentials=credentials,
+            channel=channel,
         )
 
     def get_api_base_url(self):
         return self._api_base_url
 
     def get_access_token(self):
-        if self._access_token and not is_token_expired(self._expiration):
-            return self._access_token
+        slot = self._shared_slot
+        if slot is not None and slot.generation() != self._slot_generation:
+            # Renewed by another process
+            self._load_shared_slot()
+
+        token = self._token
+        now = time.monotonic()
+        # Read by RefreshScheduler to prioritize the identities in use
+        self._last_used = now
+        ttl = token.deadline - now
+        if ttl > 0 and token.access_token:
+            self._memory_hits.inc()
+            self._ttl_at_use.observe(ttl)
+            return token.access_token
 
         # Token expired
-        if self._mode == "oauth":
-            data = get_oauth_token_info(self._open_browser, self._org)
-        elif self._mode == "m2m":
-            data = get_m2m_token_info(self._client_id, self._client_secret)
+        self._metrics.inc("cache_requests_total", layer="memory", result="miss")
+        return self._refresh_access_token(token.access_token)
 
-        self._access_token = data.get("access_token")
-        self._expiration = data.get("expiration")
-        self._save_cache_file()
+    def prewarm(self, carto_dw=True, carto_dw_client=False, wait=True):
+        """Fetch in advance everything needed by the first requests.
+
+        The access token is resolved first. Then the API base URL is
+        discovered, if unknown, and the CARTO DW credentials are fetched,
+        while the BigQuery modules are imported in parallel if carto_dw_client
+        is requested. All the results are stored in the caches.
+
+        Args:
+            carto_dw (bool, optional): Whether the CARTO DW credentials should
+                be fetched. Default True.
+            carto_dw_client (bool, optional): Whether the CARTO DW client
+                should be created. Default False.
+            wait (bool, optional): Whether to wait until everything is fetched.
+                If False, it runs in a background thread. Default True.
+
+        Returns:
+            concurrent.futures.Future: Future of the background prewarm,
+            only if wait is False.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not wait:
+            executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="carto-auth-prewarm"
+            )
+            future = executor.submit(self.prewarm, carto_dw, carto_dw_client)
+            executor.shutdown(wait=False)
+            return future
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            imports = None
+            if carto_dw_client:
+                imports = executor.submit(_import_carto_dw_modules)
+
+            access_token = self.get_access_token()
+            if not self._api_base_url:
+                self._api_base_url = get_api_base_url(
+                    access_token,
+                    session=self._get_session(),
+                    use_cache=self._use_cache,
+                    policy=self._retry_policy,
+                )
+                self._save_cache_file()
+
+            if carto_dw or carto_dw_client:
+                self._get_carto_dw_credentials()
+
+            if imports is not None:
+                imports.result()
+                self.get_carto_dw_client()
+
+    def get_requests_auth(self):
+        """Get a requests authentication for the CARTO APIs.
+
+        The access token is added to each request, and it is renewed
+        once when a request is rejected with 401 Unauthorized.
+
+        Example:
+            requests.get(url, auth=carto_auth.get_requests_auth())
+        """
+        from carto_auth.session import CartoRequestsAuth
+
+        return CartoRequestsAuth(self)
+
+    def get_api_session(self, pool_connections=10, pool_maxsize=10):
+        """Get a session for the CARTO APIs authenticated with this object.
+
+        Relative URLs are resolved against the API base URL.
+
+        Args:
+            pool_connections (int, optional): Number of hosts with a cached pool.
+                Default 10.
+            pool_maxsize (int, optional): Maximum number of connections per host.
+                Default 10.
+
+        Example:
+            session = carto_auth.get_api_session()
+            session.get("/v3/connections")
+        """
+        from carto_auth.session import CartoApiSession
+
+        return CartoApiSession(self, pool_connections, pool_maxsize)
+
+    def stats(self):
+        """Get a snapshot of the metrics of this object.
+
+        They are the metrics passed in the metrics parameter or, by default,
+        the ones shared by all the objects of the process. See
+        metrics.Metrics.stats.
+        """
+        return self._metrics.stats()
+
+    def start_background_refresh(self, daemon=True):
+        """Start renewing the access token in a background thread.
+
+        The token is renewed `refresh_skew` seconds before it expires,
+        so get_access_token does not need to wait for the token endpoint.
+
+        Forked processes restart the thread only with shared_memory, where
+        the token renewed by one process is read by the rest. Otherwise,
+        call this method in the forked process to renew its own token.
+
+        Args:
+            daemon (bool, optional): Whether the thread should be a daemon thread.
+                Default True.
+
+        Raises:
+            CredentialsError: If the mode is not m2m.
+        """
+        if self._mode != "m2m":
+            raise CredentialsError("Background refresh is only available for m2m")
+
+        if self.is_background_refresh_running():
+            return
+
+        self._refresh_stop.clear()
+        self._refresh_thread = threading.Thread(
+            target=self._background_refresh_loop,
+            name="carto-auth-refresh",
+            daemon=daemon,
+        )
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self, timeout=None):
+        """Stop the background refresh thread.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the thread to finish.
+                Default None (wait until it finishes).
+        """
+        self._refresh_stop.set()
+        if self._refresh_thread is not None:
+            if self._refresh_thread is not threading.current_thread():
+                self._refresh_thread.join(timeout)
+            self._refresh_thread = None
+
+    def is_background_refresh_running(self):
+        return self._refresh_thread is not None and self._refresh_thread.is_alive()
+
+    def _background_refresh_loop(self):
+        refreshed = False
+        while not self._refresh_stop.is_set():
+            ttl = self._token.ttl() if self._access_token else 0
+            delay = ttl - self._refresh_skew
+            if refreshed and delay <= 0:
+                # The token lifetime is shorter than the skew: renew it halfway
+                delay = ttl / 2 if ttl > 0 else REFRESH_RETRY_INTERVAL
+            if delay > 0 and self._refresh_stop.wait(delay):
+                break
+            try:
+                self._refresh_access_token(self._access_token)
+                refreshed = True
+            except Exception:
+                logger.exception("Background token refresh failed")
+                refreshed = False
+                if self._refresh_stop.wait(REFRESH_RETRY_INTERVAL):
+                    break
+
+    def _refresh_access_token(self, stale_token=None):
+        """Renew the access token, at most once at a time per object.
+
+        Callers arriving while a refresh is in progress wait for it
+        and get its result instead of requesting another token.
+        """
+        timeout = -1 if self._refresh_timeout is None else self._refresh_timeout
+        if not self._refresh_lock.acquire(timeout=timeout):
+            raise CredentialsError("Timeout waiting for the token refresh")
+
+        try:
+            token = self._token
+            if token.access_token != stale_token and not token.is_expired():
+                # Already renewed by another thread
+                return token.access_token
+
+            slot = self._shared_slot
+            if slot is None:
+                return self._renew_access_token(stale_token)
+
+            with slot.lock():
+                self._load_shared_slot()
+                token = self._token
+                if token.access_token != stale_token and not token.is_expired():
+                    # Already renewed by another process
+                    self._metrics.inc(
+                        "cache_requests_total", layer="shared_memory", result="hit"
+                    )
+                    return token.access_token
+                self._metrics.inc(
+                    "cache_requests_total", layer="shared_memory", result="miss"
+                )
+
+                access_token = self._renew_access_token(stale_token)
+                self._slot_generation = slot.write(self._token)
+                return access_token
+        finally:
+            self._refresh_lock.release()
+
+    def _renew_access_token(self, stale_token):
+        shared = self._use_cache and self._shared_cache and self._has_cache()
+        with _cache_lock(
+            self._cache_filepath, shared, self._token_cache, self._cache_key
+        ):
+            if shared:
+                data = _load_cache(
+                    self._cache_filepath, self._token_cache, self._cache_key
+                )
+                if (
+                    data
+                    and data.get("access_token") != stale_token
+                    and not is_token_expired(data.get("expiration"))
+                ):
+                    # Already renewed by another process
+                    self._metrics.inc(
+                        "cache_requests_total", layer="file", result="hit"
+                    )
+                    self._set_token(data)
+                    return self._access_token
+                self._metrics.inc("cache_requests_total", layer="file", result="miss")
+
+            data = self._fetch_token_info(stale_token)
+
+            self._set_token(data)
+            self._save_cache_file()
 
         return self._access_token
 
+    def _fetch_token_info(self, stale_token=None):
+        if self._broker is not None:
+            token = self._token
+            if token.access_token == stale_token and not token.is_expired():
+                # Rejected by CARTO before it expired, for example with a 401
+                return self._broker.get_token_info(stale_token)
+            return self._broker.get_token_info()
+
+        session = self._get_session()
+        policy = self._retry_policy
+        with _record_refresh(self._metrics, self._mode):
+            if self._mode == "oauth":
+                data = _get_oauth_token_info(
+                    self._cache_key,
+                    self._use_cache,
+                    self._open_browser,
+                    self._org,
+                    refresh_token=self._refresh_token,
+                    session=session,
+                    policy=policy,
+                )
+                self._refresh_token = data.get("refresh_token")
+                return data
+            elif self._mode == "m2m":
+                return get_m2m_token_info(
+                    self._client_id,
+                    self._client_secret,
+                    session=session,
+                    policy=policy,
+                )
+
     def get_carto_dw_credentials(self) -> tuple:
         """Get the CARTO Data Warehouse credentials.
 
+        The credentials are cached until they expire or the access token changes.
+
         Returns:
             tuple: carto_dw_project, carto_dw_token.
 
@@ -218,34 +868,58 @@ class CartoAuth:
             CredentialsError: If the API Base URL is not provided,
                 the response is not JSON or has invalid attributes.
         """
+        credentials = self._get_carto_dw_credentials()
+        return credentials["project_id"], credentials["token"]
+
+    def _get_carto_dw_credentials(self, min_ttl=0):
         if not self._api_base_url:
             raise CredentialsError("api_base_url required")
 
-        url = f"{self._api_base_url}/v3/connections/carto-dw/token"
-
         access_token = self.get_access_token()
-        headers = api_headers(access_token)
-        response = requests.get(url, headers=headers)
 
-        try:
-            response_data = response.json()
-        except requests.exceptions.JSONDecodeError:
-            raise CredentialsError(
-                "Invalid CARTO DW Token response. "
-                "Please, make sure api_base_url is correctly defined"
-            )
+        credentials = self._carto_dw_credentials
+        if not _is_carto_dw_valid(credentials, access_token, min_ttl):
+            with self._carto_dw_lock:
+                credentials = self._carto_dw_credentials
+                if not _is_carto_dw_valid(credentials, access_token, min_ttl):
+                    credentials = self._fetch_carto_dw_credentials(access_token)
+                    self._carto_dw_credentials = credentials
+                    if self._cache_carto_dw:
+                        self._save_cache_file()
+
+        return credentials
+
+    def _fetch_carto_dw_credentials(self, access_token):
+        if self._broker is not None:
+            credentials = self._broker.get_carto_dw_credentials()
+            return dict(credentials, access_token=access_token)
 
-        if "projectId" in response_data and "token" in response_data:
-            return response_data["projectId"], response_data["token"]
+        url = f"{self._api_base_url}{CARTO_DW_TOKEN_PATH}"
+        self._metrics.inc("carto_dw_fetches_total")
 
-        raise CredentialsError(
-            "Invalid attributes in CARTO DW Token response. "
-            "Please, make sure api_base_url is correctly defined"
+        headers = api_headers(access_token)
+        response = request(
+            "GET",
+            url,
+            session=self._get_session(),
+            policy=self._retry_policy,
+            headers=headers,
         )
+        project_id, token = parse_carto_dw_response(response)
+
+        return {
+            "project_id": project_id,
+            "token": token,
+            "expiration": int(time.time()) + CARTO_DW_TOKEN_TTL,
+            "access_token": access_token,
+        }
 
     def get_carto_dw_client(self):
         """Returns a client to query directly the CARTO Data Warehouse.
 
+        The client is created once and reused. Its credentials renew
+        the CARTO DW token when it expires.
+
         It requires extra dependencies carto-auth[carto-dw] to be installed.
         """
         try:
@@ -255,14 +929,98 @@ class CartoAuth:
             sys.stderr.write("Error: CARTO DW extension not found.\n")
             sys.stderr.write("Please, install carto-auth[carto-dw]\n")
 
-        cdw_project, cdw_token = self.get_carto_dw_credentials()
-        return Client(cdw_project, credentials=Credentials(cdw_token))
+        with self._carto_dw_client_lock:
+            if self._carto_dw_client is None:
+                cdw_credentials = self._get_carto_dw_credentials()
+                credentials = Credentials(
+                    cdw_credentials["token"],
+                    expiry=_utc_datetime(cdw_credentials["expiration"]),
+                    refresh_handler=self._refresh_carto_dw_token,
+                )
+                self._carto_dw_client = Client(
+                    cdw_credentials["project_id"], credentials=credentials
+                )
+
+        return self._carto_dw_client
+
+    def _refresh_carto_dw_token(self, request, scopes):
+        # google-auth refreshes the token some minutes before the expiry,
+        # so a token about to expire must not be returned from the cache
+        cdw_credentials = self._get_carto_dw_credentials(CARTO_DW_REFRESH_MARGIN)
+        return cdw_credentials["token"], _utc_datetime(cdw_credentials["expiration"])
+
+    def _get_session(self):
+        return self._session or get_session()
+
+    @property
+    def _access_token(self):
+        return self._token.access_token
+
+    @_access_token.setter
+    def _access_token(self, access_token):
+        self._token = TokenState(access_token, self._token.expiration)
+
+    @property
+    def _expiration(self):
+        return self._token.expiration
+
+    @_expiration.setter
+    def _expiration(self, expiration):
+        self._token = TokenState(self._token.access_token, expiration)
+
+    def _load_shared_slot(self):
+        entry = self._shared_slot.read()
+        if entry is not None:
+            self._slot_generation, token = entry
+            if token.access_token and not token.is_expired():
+                self._token = token
+
+    def _after_fork(self):
+        # Locks may have been held by threads that do not exist in the child
+        self._refresh_lock = threading.Lock()
+        self._carto_dw_lock = threading.Lock()
+        self._carto_dw_client_lock = threading.Lock()
+        # The connections of the client belong to the parent
+        self._carto_dw_client = None
+        after_fork = getattr(self._broker, "_after_fork", None)
+        if after_fork is not None:
+            after_fork()
+
+        background_refresh = self._refresh_thread is not None
+        self._refresh_thread = None
+        self._refresh_stop = threading.Event()
+        # Only with a shared slot, where one process renews the token for all:
+        # otherwise every worker would request its own tokens
+        if background_refresh and self._shared_slot is not None:
+            self.start_background_refresh()
+
+    def _set_token(self, data):
+        self._token = TokenState(data.get("access_token"), data.get("expiration"))
+
+    def _has_cache(self):
+        return self._token_cache is not None or bool(self._cache_filepath)
 
     def _save_cache_file(self):
-        if self._use_cache and self._cache_filepath:
+        if self._use_cache and self._has_cache():
+            token = self._token
             data = {
                 "api_base_url": self._api_base_url,
-                "access_token": self._access_token,
-                "expiration": self._expiration,
+                "access_token": token.access_token,
+                "expiration": token.expiration,
             }
-            save_cache_file(self._cache_filepath, data)
+            credentials = self._carto_dw_credentials
+            if self._cache_carto_dw and _is_carto_dw_valid(
+                credentials, token.access_token
+            ):
+                data["carto_dw"] = {
+                    "project_id": credentials["project_id"],
+                    "token": credentials["token"],
+                    "expiration": credentials["expiration"],
+                }
+            if self._token_cache is not None:
+                # Write only when the token changes, not for every new object
+                if self._token_cache.get(self._cache_key) != data:
+                    self._token_cache.set(self._cache_key, data)
+            else:
+                data["key"] = self._cache_key
+                save_cache_file(self._cache_filepath, data)
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import socketserver
+
+from carto_auth.auth import CartoAuth
+from carto_auth.delegate import TokenChannel, handle_message, parse_response
+from carto_auth.errors import CredentialsError
+from carto_auth.utils import get_home_dir
+
+logger = logging.getLogger(__name__)
+
+
+def get_broker_socket_path():
+    return get_home_dir() / "broker.sock"
+
+
+class TokenBroker:
+    """Process that owns the tokens of the workers of a host.
+
+    The broker keeps a CartoAuth object per CARTO credentials file, renews
+    its token in the background before it expires, and serves the tokens
+    and CARTO DW credentials over a Unix socket. Workers use
+    CartoAuth.from_broker, so a host requests one token per identity
+    instead of one per process.
+
+    The protocol is one JSON object per line: {"op": ..., "identity": ...}
+    requests, answered with {"ok": true, "result": ...} or
+    {"ok": false, "error": ...}. Token requests may carry the "stale_token"
+    rejected by CARTO, which the broker renews if it is still its token.
+    The socket is only accessible by its user.
+
+    Only the m2m mode is supported, because the broker cannot authorize
+    a user in the browser.
+
+    Args:
+        socket_path (str, optional): File path of the Unix socket.
+            Default "home()/.carto-auth/broker.sock".
+        **kwargs: Extra arguments passed to CartoAuth.from_m2m,
+            like refresh_skew or token_cache.
+    """
+
+    def __init__(self, socket_path=None, **kwargs):
+        self.socket_path = str(socket_path or get_broker_socket_path())
+        self._kwargs = kwargs
+        self._carto_auths = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        """Serve the clients in a background thread."""
+        self._bind()
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="carto-auth-broker", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve the clients until stop is called."""
+        self._bind()
+        logger.info("Serving tokens at %s", self.socket_path)
+        self._server.serve_forever()
+
+    def stop(self):
+        """Stop serving the clients and renewing the tokens."""
+        if self._server is not None:
+            if self._thread is not None:
+                self._server.shutdown()
+                self._thread.join()
+                self._thread = None
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            carto_auths = list(self._carto_auths.values())
+            self._carto_auths.clear()
+        for carto_auth in carto_auths:
+            carto_auth.stop_background_refresh()
+
+    def get_carto_auth(self, identity):
+        """Get the CartoAuth object of an identity, creating it if needed."""
+        if identity.get("mode", "m2m") != "m2m":
+            raise CredentialsError("The broker only supports the m2m mode")
+        if not identity.get("filepath"):
+            raise CredentialsError("filepath required")
+
+        key = os.path.abspath(identity["filepath"])
+        carto_auth = self._carto_auths.get(key)
+        if carto_auth is None:
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+            # Other identities are not blocked while the token is requested
+            with lock:
+                carto_auth = self._carto_auths.get(key)
+                if carto_auth is None:
+                    carto_auth = CartoAuth.from_m2m(
+                        key, background_refresh=True, **self._kwargs
+                    )
+                    with self._lock:
+                        self._carto_auths[key] = carto_auth
+        return carto_auth
+
+    def handle(self, message):
+        """Answer a request of a client.
+
+        Args:
+            message (dict): Request with the operation "op" (ping, token or
+                carto_dw_credentials) and the "identity" of the token.
+
+        Returns:
+            dict: Response with "ok" and the "result" or the "error".
+        """
+        return handle_message(message, self.get_carto_auth)
+
+    def _bind(self):
+        if _is_listening(self.socket_path):
+            raise CredentialsError(f"Broker already running at {self.socket_path}")
+        try:
+            # Socket of a broker that did not stop cleanly
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+        self._server = _BrokerServer(self.socket_path, _BrokerHandler)
+        self._server.broker = self
+
+
+class BrokerClient(TokenChannel):
+    """Client of a TokenBroker for an identity.
+
+    The connection to the broker is kept open, one per thread, and opened
+    again if the broker is restarted.
+
+    Args:
+        identity (dict): Identity of the token, with the "mode" and the
+            "filepath" of the CARTO credentials file.
+        socket_path (str, optional): File path of the Unix socket of the broker.
+            Default "home()/.carto-auth/broker.sock".
+        timeout (float, optional): Seconds to wait for the broker. Default 60.
+    """
+
+    def __init__(self, identity, socket_path=None, timeout=60):
+        self.identity = identity
+        self.socket_path = str(socket_path or get_broker_socket_path())
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, op, **params):
+        """Send a request to the broker.
+
+        Returns:
+            The result of the operation.
+
+        Raises:
+            CredentialsError: If the broker is not available or the request fails.
+        """
+        message = dict(params, op=op, identity=self.identity)
+        message = json.dumps(message).encode("utf-8")
+        for attempt in range(2):
+            try:
+                sock, reader = self._connect()
+                sock.sendall(message + b"\n")
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError("Connection closed by the broker")
+                break
+            except OSError as error:
+                self.close()
+                # The connection may be from a previous broker, try a new one
+                if attempt:
+                    raise CredentialsError(
+                        f"Broker not available at {self.socket_path}: {error}",
+                        retryable=True,
+                    ) from error
+
+        return parse_response(json.loads(line))
+
+    def close(self):
+        """Close the connection of this thread."""
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _after_fork(self):
+        # The connection of the parent must not be shared with the child
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            connection = (sock, sock.makefile("rb"))
+            self._local.connection = connection
+        return connection
+
+
+class _BrokerServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def server_bind(self):
+        super().server_bind()
+        # Before listen, so no client can connect with other permissions
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        # Clients connected to a stopped broker must connect to the next one
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class _BrokerHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        with self.server.connections_lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self.connection)
+        super().finish()
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                response = {"ok": False, "error": "Invalid request"}
+            else:
+                if isinstance(message, dict):
+                    response = self.server.broker.handle(message)
+                else:
+                    response = {"ok": False, "error": "Invalid request"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+def _is_listening(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def main(argv=None):
+    import signal
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="carto-auth-broker",
+        description="Serve the CARTO tokens of the processes of this host "
+        "over a Unix socket.",
+    )
+    parser.add_argument(
+        "--socket",
+        help="File path of the Unix socket. " "Default ~/.carto-auth/broker.sock",
+    )
+    parser.add_argument(
+        "--refresh-skew",
+        type=int,
+        default=300,
+        help="Seconds before the expiration when the tokens are renewed. "
+        "Default 300",
+    )
+    parser.add_argument("--log-level", default="INFO", help="Default INFO")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper())
+    # Stop cleanly, removing the socket, when the process is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    broker = TokenBroker(args.socket, refresh_skew=args.refresh_skew)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,662 @@
+import os
+import abc
+import json
+import time
+import hashlib
+import logging
+import weakref
+import threading
+import contextlib
+
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+
+from carto_auth.errors import CredentialsError
+from carto_auth.utils import (
+    get_home_dir,
+    get_file_signature,
+    lock_cache_file,
+    write_json_file,
+    is_token_expired,
+)
+
+CACHE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+# Caches whose locks and connections are recreated in forked processes
+_instances = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for token_cache in list(_instances):
+        token_cache._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class TokenCache(abc.ABC):
+    """Interface of the token caches accepted by CartoAuth (token_cache).
+
+    The tokens are stored by key, see utils.get_cache_key. The data of each
+    key is a dict with "api_base_url", "access_token" and "expiration".
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Get the data stored for a key, or None if missing or expired."""
+
+    @abc.abstractmethod
+    def set(self, key, data):
+        """Store the data for a key."""
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """Remove the data stored for a key."""
+
+    @abc.abstractmethod
+    def lock(self, key):
+        """Context manager that holds an exclusive lock to renew the token of a key.
+
+        It is used by CartoAuth with shared_cache=True, so only one of the
+        processes sharing the cache requests a new token.
+        """
+
+
+class MemoryTokenCache(TokenCache):
+    """Token cache stored in memory, shared by the objects of a process.
+
+    It does not need a writable filesystem, but the tokens are lost
+    when the process ends.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def get(self, key):
+        """Get the data stored for a key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or is_token_expired(entry.get("expiration")):
+                return None
+            return dict(entry)
+
+    def set(self, key, data):
+        """Store the data for a key."""
+        with self._lock:
+            self._entries = {
+                k: v
+                for k, v in self._entries.items()
+                if not is_token_expired(v.get("expiration"))
+            }
+            self._entries[key] = dict(data)
+
+    def delete(self, key):
+        """Remove the data stored for a key."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold an exclusive lock between threads to renew the token of a key."""
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.RLock())
+        with lock:
+            yield
+
+    def _after_fork(self):
+        # Locks may have been held by threads that do not exist in the child
+        self._lock = threading.Lock()
+        self._locks = {}
+
+
+class FileTokenCache(TokenCache):
+    """Token cache for many identities stored in a single file.
+
+    Each entry is stored under the key of its identity, see utils.get_cache_key.
+    The entries are indexed in memory and the file is only read again when
+    it is modified by another process. Expired entries are removed and the
+    least recently used entries are evicted when there are more than
+    max_entries.
+
+    Args:
+        filepath (str, optional): File path where the tokens are stored.
+            Default "home()/.carto-auth/tokens.json".
+        max_entries (int, optional): Maximum number of stored tokens.
+            Default 1000.
+    """
+
+    def __init__(self, filepath=None, max_entries=1000):
+        if filepath is None:
+            filepath = get_home_dir() / "tokens.json"
+
+        self._filepath = filepath
+        self._max_entries = max_entries
+        self._entries = {}
+        self._signature = None
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        _instances.add(self)
+
+    def get(self, key):
+        """Get the data stored for a key, or None if missing or expired."""
+        with self._lock:
+            self._reload()
+            entry = self._entries.get(key)
+            if entry is None or is_token_expired(entry.get("expiration")):
+                return None
+            entry["last_used"] = int(time.time())
+            return {k: v for k, v in entry.items() if k != "last_used"}
+
+    def set(self, key, data):
+        """Store the data for a key."""
+        with self._lock, self._lock_file():
+            self._reload()
+            self._entries[key] = dict(data, last_used=int(time.time()))
+            self._prune()
+            self._write()
+
+    def delete(self, key):
+        """Remove the data stored for a key."""
+        with self._lock, self._lock_file():
+            self._reload()
+            if self._entries.pop(key, None) is not None:
+                self._write()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold an exclusive lock between processes to renew the token of a key.
+
+        Each key has its own lock file, so the renewals of different keys
+        do not wait for each other.
+        """
+        lock_dir = Path(f"{self._filepath}.locks")
+        lock_dir.mkdir(exist_ok=True)
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        with lock_cache_file(lock_dir / digest):
+            yield
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def _lock_file(self):
+        if getattr(self._local, "locked", False):
+            yield
+            return
+
+        with lock_cache_file(self._filepath):
+            self._local.locked = True
+            try:
+                yield
+            finally:
+                self._local.locked = False
+
+    def _reload(self):
+        signature = get_file_signature(self._filepath)
+        if signature is None or signature == self._signature:
+            return
+
+        try:
+            with open(self._filepath, "r") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if not isinstance(content, dict) or content.get("version") != CACHE_VERSION:
+            return
+
+        entries = content.get("entries")
+        if not isinstance(entries, dict):
+            return
+        # Ignore invalid entries
+        entries = {
+            key: entry
+            for key, entry in entries.items()
+            if isinstance(entry, dict) and "access_token" in entry
+        }
+        for key, entry in self._entries.items():
+            # Keep the usage of this process, not written on reads
+            if key in entries:
+                entries[key]["last_used"] = max(
+                    entries[key].get("last_used", 0), entry.get("last_used", 0)
+                )
+        self._entries = entries
+        self._signature = signature
+
+    def _prune(self):
+        self._entries = {
+            key: entry
+            for key, entry in self._entries.items()
+            if not is_token_expired(entry.get("expiration"))
+        }
+
+        excess = len(self._entries) - self._max_entries
+        if excess > 0:
+            lru = sorted(
+                self._entries, key=lambda k: self._entries[k].get("last_used", 0)
+            )
+            for key in lru[:excess]:
+                del self._entries[key]
+
+    def _write(self):
+        content = {"version": CACHE_VERSION, "entries": self._entries}
+        write_json_file(self._filepath, content)
+        self._signature = get_file_signature(self._filepath)
+
+
+class SQLiteTokenCache(TokenCache):
+    """Token cache stored in a SQLite database in WAL mode.
+
+    Readers never wait for a writer. The lock to renew a token is a row
+    of the locks table, held at most timeout seconds, so the renewals of
+    different keys do not wait for each other, and it also works between
+    processes where file locks are not available.
+
+    Args:
+        filepath (str, optional): File path of the database.
+            Default "home()/.carto-auth/tokens.db".
+        timeout (float, optional): Seconds to wait for the database, and
+            seconds the lock to renew a token is held at most and waited
+            for at most. Default 60.
+    """
+
+    BUSY_RETRY_INTERVAL = 0.05
+    LOCK_POLL_INTERVAL = 0.05
+
+    def __init__(self, filepath=None, timeout=60):
+        if filepath is None:
+            filepath = get_home_dir() / "tokens.db"
+
+        self._filepath = str(filepath)
+        self._timeout = timeout
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        _instances.add(self)
+
+    def get(self, key):
+        """Get the data stored for a key, or None if missing or expired."""
+        row = (
+            self._connect()
+            .execute("SELECT data FROM tokens WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return _parse_data(row[0])
+
+    def set(self, key, data):
+        """Store the data for a key."""
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM tokens WHERE expiration < ?", (int(time.time()),)
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO tokens (key, data, expiration) "
+                "VALUES (?, ?, ?)",
+                (key, json.dumps(data), data.get("expiration")),
+            )
+
+    def delete(self, key):
+        """Remove the data stored for a key."""
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM tokens WHERE key = ?", (key,))
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold an exclusive lock between processes to renew the token of a key.
+
+        Raises:
+            CredentialsError: If the lock is not acquired in timeout seconds.
+        """
+        owner = os.urandom(16).hex()
+        self._acquire(key, owner)
+        try:
+            yield
+        finally:
+            with self._transaction() as connection:
+                connection.execute(
+                    "DELETE FROM locks WHERE key = ? AND owner = ?", (key, owner)
+                )
+
+    def _acquire(self, key, owner):
+        deadline = time.monotonic() + self._timeout
+        while True:
+            with self._transaction() as connection:
+                now = time.time()
+                # Locks of processes that ended without releasing them expire
+                connection.execute(
+                    "DELETE FROM locks WHERE key = ? AND expiration < ?", (key, now)
+                )
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO locks (key, owner, expiration) "
+                    "VALUES (?, ?, ?)",
+                    (key, owner, now + self._timeout),
+                )
+                if cursor.rowcount == 1:
+                    return
+            if time.monotonic() >= deadline:
+                raise CredentialsError("Timeout waiting for the token cache lock")
+            time.sleep(self.LOCK_POLL_INTERVAL)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            import sqlite3
+
+            connection = sqlite3.connect(
+                self._filepath, timeout=self._timeout, isolation_level=None
+            )
+            with self._init_lock:
+                if not self._initialized:
+                    self._initialize(connection)
+                    self._initialized = True
+            self._local.connection = connection
+        return connection
+
+    def _initialize(self, connection):
+        import sqlite3
+
+        # Changing the journal mode of a new database fails at once, without
+        # waiting for the busy timeout, while another process initializes it
+        deadline = time.monotonic() + self._timeout
+        while True:
+            try:
+                connection.execute("PRAGMA journal_mode=WAL")
+                break
+            except sqlite3.OperationalError as error:
+                if not _is_busy(error) or time.monotonic() >= deadline:
+                    raise
+                time.sleep(self.BUSY_RETRY_INTERVAL)
+
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens "
+                "(key TEXT PRIMARY KEY, data TEXT NOT NULL, expiration INTEGER)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS locks "
+                "(key TEXT PRIMARY KEY, owner TEXT NOT NULL, expiration REAL)"
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _after_fork(self):
+        # The connections of the parent must not be used by the child
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+
+
+class RedisTokenCache(TokenCache):
+    """Token cache stored in Redis, shared by the processes of many hosts.
+
+    It speaks the Redis protocol (RESP) directly, so it does not need extra
+    dependencies. The tokens expire in Redis with the access token, and the
+    lock to renew a token is a Redis lock with a timeout, released only by
+    its owner.
+
+    If Redis is not available, the cache is skipped with a warning and
+    each process renews its own token.
+
+    Args:
+        host (str, optional): Redis host. Default "localhost".
+        port (int, optional): Redis port. Default 6379.
+        db (int, optional): Redis database number. Default 0.
+        password (str, optional): Redis password.
+        prefix (str, optional): Prefix of the Redis keys. Default "carto-auth:".
+        socket_timeout (float, optional): Seconds to wait for Redis. Default 5.
+        lock_timeout (float, optional): Seconds the lock to renew a token is
+            held at most, and waited for at most. Default 60.
+    """
+
+    LOCK_POLL_INTERVAL = 0.05
+    RELEASE_SCRIPT = (
+        'if redis.call("get", KEYS[1]) == ARGV[1] then '
+        'return redis.call("del", KEYS[1]) else return 0 end'
+    )
+
+    def __init__(
+        self,
+        host="localhost",
+        port=6379,
+        db=0,
+        password=None,
+        prefix="carto-auth:",
+        socket_timeout=5,
+        lock_timeout=60,
+    ):
+        self._host = host
+        self._port = port
+        self._db = db
+        self._password = password
+        self._prefix = prefix
+        self._socket_timeout = socket_timeout
+        self._lock_timeout = lock_timeout
+        self._socket = None
+        self._reader = None
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """Create a RedisTokenCache from a URL like redis://:password@host:port/db.
+
+        Args:
+            url (str): Redis URL.
+            **kwargs: Extra arguments passed to the RedisTokenCache constructor.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise CredentialsError(f"Unsupported Redis URL: {url}")
+        return cls(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip("/") or 0),
+            password=unquote(parsed.password) if parsed.password else None,
+            **kwargs,
+        )
+
+    def get(self, key):
+        """Get the data stored for a key, or None if missing or expired."""
+        try:
+            value = self._command("GET", self._token_key(key))
+        except OSError as error:
+            logger.warning("Redis token cache not available: %s", error)
+            return None
+
+        if value is None:
+            return None
+        return _parse_data(value)
+
+    def set(self, key, data):
+        """Store the data for a key."""
+        ttl = int((data.get("expiration") or 0) - time.time())
+        if ttl <= 0:
+            return
+        try:
+            self._command("SET", self._token_key(key), json.dumps(data), "EX", ttl)
+        except OSError as error:
+            logger.warning("Redis token cache not available: %s", error)
+
+    def delete(self, key):
+        """Remove the data stored for a key."""
+        try:
+            self._command("DEL", self._token_key(key))
+        except OSError as error:
+            logger.warning("Redis token cache not available: %s", error)
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Hold an exclusive lock between hosts to renew the token of a key.
+
+        Raises:
+            CredentialsError: If the lock is not acquired in lock_timeout seconds.
+        """
+        lock_key = f"{self._prefix}lock:{key}"
+        owner = os.urandom(16).hex()
+
+        try:
+            self._acquire(lock_key, owner)
+            acquired = True
+        except OSError as error:
+            logger.warning("Redis token cache not available: %s", error)
+            acquired = False
+
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    self._command("EVAL", self.RELEASE_SCRIPT, 1, lock_key, owner)
+                except OSError as error:
+                    logger.warning("Redis token cache not available: %s", error)
+
+    def close(self):
+        """Close the connection to Redis."""
+        with self._lock:
+            self._disconnect()
+
+    def _acquire(self, lock_key, owner):
+        timeout_ms = int(self._lock_timeout * 1000)
+        deadline = time.monotonic() + self._lock_timeout
+        while True:
+            try:
+                if self._command(
+                    "SET", lock_key, owner, "NX", "PX", timeout_ms, retry=False
+                ):
+                    return
+            except OSError:
+                # The reply may have been lost after the lock was set,
+                # so the command is not sent again: check the owner instead
+                if self._command("GET", lock_key) == owner:
+                    return
+            if time.monotonic() >= deadline:
+                raise CredentialsError("Timeout waiting for the token cache lock")
+            time.sleep(self.LOCK_POLL_INTERVAL)
+
+    def _token_key(self, key):
+        return f"{self._prefix}token:{key}"
+
+    def _command(self, *args, retry=True):
+        """Send a command to Redis.
+
+        Args:
+            *args: Command and its arguments.
+            retry (bool, optional): Whether the command is sent again once if
+                the connection fails. Only for commands that can be applied
+                twice, because the server may have applied it before the
+                reply was lost. Default True.
+        """
+        with self._lock:
+            try:
+                return self._execute(args)
+            except OSError:
+                # The connection may have been closed by the server
+                self._disconnect()
+                if not retry:
+                    raise
+                return self._execute(args)
+
+    def _execute(self, args):
+        if self._socket is None:
+            self._connect()
+        self._socket.sendall(_encode_command(args))
+        return _read_reply(self._reader)
+
+    def _connect(self):
+        import socket
+
+        self._socket = socket.create_connection(
+            (self._host, self._port), timeout=self._socket_timeout
+        )
+        self._reader = self._socket.makefile("rb")
+        if self._password:
+            self._execute(("AUTH", self._password))
+        if self._db:
+            self._execute(("SELECT", self._db))
+
+    def _after_fork(self):
+        # The connection of the parent must not be used by the child
+        self._lock = threading.Lock()
+        self._socket = None
+        self._reader = None
+
+    def _disconnect(self):
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+        self._socket = None
+        self._reader = None
+
+
+def _parse_data(value):
+    # Invalid or expired data is a cache miss
+    try:
+        data = json.loads(value)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or is_token_expired(data.get("expiration")):
+        return None
+    return data
+
+
+def _is_busy(error):
+    message = str(error)
+    return "locked" in message or "busy" in message
+
+
+def _encode_command(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        value = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(f"${len(value)}\r\n".encode() + value + b"\r\n")
+    return b"".join(parts)
+
+
+def _read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by Redis")
+
+    kind, value = line[:1], line[1:-2]
+    if kind == b"+":
+        return value.decode("utf-8")
+    if kind == b"-":
+        raise CredentialsError(f"Redis error: {value.decode('utf-8')}")
+    if kind == b":":
+        return int(value)
+    if kind == b"$":
+        length = int(value)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Connection closed by Redis")
+        return data[:-2].decode("utf-8")
+    if kind == b"*":
+        length = int(value)
+        if length < 0:
+            return None
+        return [_read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Invalid Redis reply: {line!r}")
@@ -0,0 +1,491 @@
+import abc
+import hmac
+import json
+import time
+import socket
+import logging
+import secrets
+import threading
+
+from carto_auth.errors import CredentialsError
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ("ping", "token", "carto_dw_credentials")
+
+# Seconds to complete the authkey handshake of a connection
+HANDSHAKE_TIMEOUT = 10
+
+_CHALLENGE = b"#CHALLENGE#"
+_WELCOME = b"#WELCOME#"
+_FAILURE = b"#FAILURE#"
+
+
+class TokenChannel(abc.ABC):
+    """Channel that provides the tokens of a CartoAuth object in another process.
+
+    CartoAuth objects with a channel, like the delegated handles or the
+    clients of a TokenBroker, ask the channel for a new token when theirs
+    expires instead of requesting it to CARTO. Custom channels implement
+    request, for example with the messaging of a Dask or Spark cluster,
+    and are answered with handle_message.
+    """
+
+    @abc.abstractmethod
+    def request(self, op, **params):
+        """Send a request of an operation to the owner of the tokens.
+
+        Args:
+            op (str): Operation: ping, token or carto_dw_credentials.
+            **params: Parameters of the operation, like stale_token.
+
+        Returns:
+            The result of the operation.
+
+        Raises:
+            CredentialsError: If the request fails.
+        """
+
+    def get_token_info(self, stale_token=None):
+        """Get the access token, its expiration and the API base URL.
+
+        Args:
+            stale_token (str, optional): Token rejected by CARTO, for example
+                with a 401 response. If it is still the token of the owner,
+                the owner renews it.
+        """
+        if stale_token:
+            return self.request("token", stale_token=stale_token)
+        return self.request("token")
+
+    def get_carto_dw_credentials(self):
+        """Get the CARTO DW project_id, token and expiration."""
+        return self.request("carto_dw_credentials")
+
+    def _after_fork(self):
+        pass
+
+
+class DelegatedCartoAuth:
+    """Picklable handle of a CartoAuth object to use its token in other processes.
+
+    It carries the access token, the API base URL and the CARTO DW
+    credentials, but not the credentials to request new tokens. When the
+    token expires, the handle asks for a new one through its channel,
+    so the requests to CARTO do not grow with the number of workers.
+
+    Create it with CartoAuth.delegate.
+
+    Args:
+        mode (str): Type of authentication: oauth, m2m.
+        api_base_url (str): Base URL for a CARTO account.
+        access_token (str): Token generated with CARTO.
+        expiration (int): Time in seconds when the token will be expired.
+        carto_dw_credentials (dict, optional): CARTO DW credentials with keys
+            "project_id", "token" and "expiration".
+        channel (TokenChannel, optional): Channel to renew the token. Without
+            a channel, the handle fails when the token expires.
+    """
+
+    def __init__(
+        self,
+        mode,
+        api_base_url,
+        access_token,
+        expiration,
+        carto_dw_credentials=None,
+        channel=None,
+    ):
+        self.mode = mode
+        self.api_base_url = api_base_url
+        self.access_token = access_token
+        self.expiration = expiration
+        self.carto_dw_credentials = carto_dw_credentials
+        self.channel = channel
+        self._carto_auth = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        carto_auth = self._carto_auth
+        if carto_auth is not None:
+            # Forward the latest token instead of the original one
+            token = carto_auth._token
+            self.access_token = token.access_token
+            self.expiration = token.expiration
+            credentials = carto_auth._carto_dw_credentials
+            if credentials and credentials.get("access_token") == token.access_token:
+                self.carto_dw_credentials = _public_carto_dw(credentials)
+
+        return {
+            "mode": self.mode,
+            "api_base_url": self.api_base_url,
+            "access_token": self.access_token,
+            "expiration": self.expiration,
+            "carto_dw_credentials": self.carto_dw_credentials,
+            "channel": self.channel,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_api_base_url(self):
+        return self.api_base_url
+
+    def get_access_token(self):
+        return self.get_carto_auth().get_access_token()
+
+    def get_carto_dw_credentials(self) -> tuple:
+        """Get the CARTO Data Warehouse credentials.
+
+        Returns:
+            tuple: carto_dw_project, carto_dw_token.
+        """
+        return self.get_carto_auth().get_carto_dw_credentials()
+
+    def get_carto_dw_client(self):
+        """Returns a client to query directly the CARTO Data Warehouse.
+
+        It requires extra dependencies carto-auth[carto-dw] to be installed.
+        """
+        return self.get_carto_auth().get_carto_dw_client()
+
+    def get_carto_auth(self):
+        """Get the CartoAuth object of this process that uses the handle."""
+        if self._carto_auth is None:
+            with self._lock:
+                if self._carto_auth is None:
+                    from carto_auth.auth import CartoAuth
+
+                    self._carto_auth = CartoAuth(
+                        self.mode,
+                        api_base_url=self.api_base_url,
+                        access_token=self.access_token,
+                        expiration=self.expiration,
+                        carto_dw_credentials=self.carto_dw_credentials,
+                        use_cache=False,
+                        broker=self.channel or _ClosedChannel(),
+                    )
+        return self._carto_auth
+
+
+class DelegateServer:
+    """Serve the tokens of a CartoAuth object to its delegated handles.
+
+    The server listens in a background thread with
+    multiprocessing.connection. The server and the clients prove to each
+    other that they know the authkey with an HMAC-SHA256 challenge. The
+    tokens are sent without encryption, so only listen on trusted networks.
+
+    Args:
+        carto_auth (CartoAuth): Object that owns the tokens.
+        address (tuple, optional): Host and port to listen to. Use a host
+            reachable by the workers for remote executors, like Dask or Spark.
+            Default ("127.0.0.1", 0), a free local port.
+        authkey (bytes, optional): Secret shared with the handles.
+            Default a random key.
+    """
+
+    def __init__(self, carto_auth, address=("127.0.0.1", 0), authkey=None):
+        from multiprocessing.connection import Listener
+
+        self.carto_auth = carto_auth
+        self.authkey = authkey or secrets.token_bytes(32)
+        # The authkey is checked by the thread of each connection, with a
+        # deadline, so a silent client cannot block the accept loop
+        self._listener = Listener(address)
+        self.address = self._listener.address
+        self._connections = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._serve, name="carto-auth-delegates", daemon=True
+        )
+        self._thread.start()
+
+    def channel(self):
+        """Get a picklable channel to this server, for CartoAuth.delegate."""
+        return ConnectionChannel(self.address, self.authkey)
+
+    def close(self):
+        """Stop serving the handles."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            connections = list(self._connections)
+
+        # Wake up the accept of the server thread. No handshake is done by
+        # accept, so the connection does not wait for the server thread
+        try:
+            _wake_up(self.address)
+        except OSError:
+            pass
+        self._thread.join()
+        self._listener.close()
+        for connection in connections:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _serve(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except OSError:
+                if self._closed:
+                    break
+                continue
+            with self._lock:
+                if self._closed:
+                    connection.close()
+                    break
+                self._connections.add(connection)
+            threading.Thread(
+                target=self._handle, args=(connection,), daemon=True
+            ).start()
+
+    def _handle(self, connection):
+        from multiprocessing import AuthenticationError
+
+        try:
+            handshake = _Deadline(connection, HANDSHAKE_TIMEOUT)
+            _deliver_challenge(handshake, self.authkey)
+            _answer_challenge(handshake, self.authkey)
+            while True:
+                message = connection.recv_bytes()
+                try:
+                    message = json.loads(message)
+                except ValueError:
+                    message = None
+                if isinstance(message, dict):
+                    response = handle_message(message, self._get_carto_auth)
+                else:
+                    response = {"ok": False, "error": "Invalid request"}
+                connection.send_bytes(json.dumps(response).encode("utf-8"))
+        except (EOFError, OSError, AuthenticationError):
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(connection)
+            connection.close()
+
+    def _get_carto_auth(self, identity):
+        return self.carto_auth
+
+
+class ConnectionChannel(TokenChannel):
+    """Channel to a DelegateServer.
+
+    The connection is opened on the first request, one per thread, and
+    opened again if it is closed.
+
+    Args:
+        address (tuple): Host and port of the server.
+        authkey (bytes): Secret of the server.
+        timeout (float, optional): Seconds to wait for the server. Default 60.
+    """
+
+    def __init__(self, address, authkey, timeout=60):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {
+            "address": self.address,
+            "authkey": self.authkey,
+            "timeout": self.timeout,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def request(self, op, **params):
+        from multiprocessing import AuthenticationError
+
+        message = json.dumps(dict(params, op=op)).encode("utf-8")
+        for attempt in range(2):
+            try:
+                connection = self._connect()
+                connection.send_bytes(message)
+                if not connection.poll(self.timeout):
+                    raise TimeoutError("Timeout waiting for the server")
+                response = connection.recv_bytes()
+                break
+            except (EOFError, OSError) as error:
+                self._close()
+                # The connection may have been closed, try a new one
+                if attempt:
+                    raise CredentialsError(
+                        f"Delegate server not available at {self.address}: {error}",
+                        retryable=True,
+                    ) from error
+            except AuthenticationError as error:
+                raise CredentialsError(
+                    f"Delegate server at {self.address} rejected the authkey"
+                ) from error
+
+        return parse_response(json.loads(response))
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            from multiprocessing.connection import Client
+
+            connection = Client(self.address)
+            try:
+                handshake = _Deadline(connection, self.timeout)
+                _answer_challenge(handshake, self.authkey)
+                _deliver_challenge(handshake, self.authkey)
+            except BaseException:
+                connection.close()
+                raise
+            self._local.connection = connection
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection.close()
+
+    def _after_fork(self):
+        # The connection of the parent must not be shared with the child
+        self._local = threading.local()
+
+
+def handle_message(message, get_carto_auth):
+    """Answer a request sent through a TokenChannel.
+
+    Args:
+        message (dict): Request with the operation "op", the "identity"
+            of the token and the "stale_token" rejected by the client.
+        get_carto_auth (callable): Function that gets the CartoAuth object
+            of an identity.
+
+    Returns:
+        dict: Response with "ok" and the "result" or the "error".
+    """
+    try:
+        op = message.get("op")
+        if op not in OPERATIONS:
+            raise CredentialsError(f"Unknown operation: {op}")
+
+        if op == "ping":
+            result = "pong"
+        else:
+            carto_auth = get_carto_auth(message.get("identity") or {})
+            if op == "token":
+                stale_token = message.get("stale_token")
+                if stale_token and stale_token == carto_auth._token.access_token:
+                    # Rejected by CARTO before it expired, for example with a 401
+                    carto_auth._refresh_access_token(stale_token)
+                else:
+                    carto_auth.get_access_token()
+                token = carto_auth._token
+                result = {
+                    "access_token": token.access_token,
+                    "expiration": token.expiration,
+                    "api_base_url": carto_auth.get_api_base_url(),
+                }
+            else:
+                result = _public_carto_dw(carto_auth._get_carto_dw_credentials())
+    except CredentialsError as error:
+        return {
+            "ok": False,
+            "error": str(error),
+            "retryable": error.retryable,
+            "status_code": error.status_code,
+        }
+    except Exception as error:
+        logger.exception("Token request failed")
+        return {"ok": False, "error": f"{type(error).__name__}: {error}"}
+
+    return {"ok": True, "result": result}
+
+
+def parse_response(response):
+    """Get the result of a response of handle_message, or raise its error."""
+    if not response.get("ok"):
+        raise CredentialsError(
+            response.get("error"),
+            retryable=response.get("retryable", False),
+            status_code=response.get("status_code"),
+        )
+    return response["result"]
+
+
+class _Deadline:
+    """Connection whose receives fail when a deadline is reached."""
+
+    def __init__(self, connection, timeout):
+        self._connection = connection
+        self._deadline = time.monotonic() + timeout
+
+    def send_bytes(self, buf):
+        self._connection.send_bytes(buf)
+
+    def recv_bytes(self, maxlength=None):
+        timeout = max(self._deadline - time.monotonic(), 0)
+        if not self._connection.poll(timeout):
+            raise TimeoutError("Timeout waiting for the authkey handshake")
+        return self._connection.recv_bytes(maxlength)
+
+
+def _deliver_challenge(connection, authkey):
+    """Check that the other end of the connection knows the authkey."""
+    from multiprocessing import AuthenticationError
+
+    message = secrets.token_bytes(32)
+    connection.send_bytes(_CHALLENGE + message)
+    digest = connection.recv_bytes(256)
+    if hmac.compare_digest(digest, _digest(authkey, message)):
+        connection.send_bytes(_WELCOME)
+    else:
+        connection.send_bytes(_FAILURE)
+        raise AuthenticationError("Digest received was wrong")
+
+
+def _answer_challenge(connection, authkey):
+    """Prove to the other end of the connection that the authkey is known."""
+    from multiprocessing import AuthenticationError
+
+    message = connection.recv_bytes(256)
+    if not message.startswith(_CHALLENGE):
+        raise AuthenticationError("Invalid authkey challenge")
+    challenge = message.replace(_CHALLENGE, b"", 1)
+    connection.send_bytes(_digest(authkey, challenge))
+    if connection.recv_bytes(256) != _WELCOME:
+        raise AuthenticationError("Digest sent was rejected")
+
+
+def _digest(authkey, message):
+    return hmac.new(authkey, message, "sha256").digest()
+
+
+def _wake_up(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(1)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address, timeout=1)
+    sock.close()
+
+
+class _ClosedChannel(TokenChannel):
+    def request(self, op, **params):
+        raise CredentialsError("The delegated token expired and it has no channel")
+
+
+def _public_carto_dw(credentials):
+    return {
+        "project_id": credentials["project_id"],
+        "token": credentials["token"],
+        "expiration": credentials["expiration"],
+    }
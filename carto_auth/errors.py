@@ -1,2 +1,14 @@
 class CredentialsError(Exception):
-    pass
+    """Error getting the CARTO credentials.
+
+    Args:
+        message (str, optional): Description of the error.
+        retryable (bool, optional): Whether the same request may succeed later,
+            like after a timeout or a 5xx response. Default False.
+        status_code (int, optional): HTTP status code of the failed response.
+    """
+
+    def __init__(self, message=None, retryable=False, status_code=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.status_code = status_code
@@ -0,0 +1,195 @@
+import sys
+import json
+import time
+import base64
+
+from carto_auth.errors import CredentialsError
+from carto_auth.utils import get_home_dir, request, write_json_file, AUDIENCE
+
+JWKS_URL = "https://auth.carto.com/.well-known/jwks.json"
+ISSUER = "https://auth.carto.com/"
+JWKS_CACHE_TTL = 86400
+# Minimum seconds between requests of the keys when a token has an unknown key id
+JWKS_MIN_REFRESH_INTERVAL = 300
+# Claims that may contain the tenant domain of the user, in order of preference
+TENANT_DOMAIN_CLAIMS = ("http://app.carto.com/tenant_domain", "tenant_domain")
+
+
+def decode_jwt(token):
+    """Decode the claims of a JWT without verifying its signature.
+
+    Args:
+        token (str): Access token.
+
+    Returns:
+        dict: Claims of the token, or None if it is not a JWT.
+    """
+    try:
+        claims = json.loads(_b64decode(token.split(".")[1]))
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+    if isinstance(claims, dict):
+        return claims
+
+
+def get_jwt_expiration(token):
+    """Get the expiration of a JWT from its exp claim, or None."""
+    exp = (decode_jwt(token) or {}).get("exp")
+    if isinstance(exp, (int, float)) and not isinstance(exp, bool):
+        return int(exp)
+
+
+def get_jwt_tenant_domain(token):
+    """Get the tenant domain of a JWT from its claims, or None."""
+    claims = decode_jwt(token) or {}
+    for claim in TENANT_DOMAIN_CLAIMS:
+        value = claims.get(claim)
+        if value and isinstance(value, str):
+            return value
+
+
+def verify_jwt(
+    token, session=None, policy=None, use_cache=True, audience=AUDIENCE, leeway=0
+):
+    """Verify the signature and the exp, aud and iss claims of a JWT.
+
+    The signature is verified with the public keys of CARTO, which are
+    stored in "home()/.carto-auth/jwks.json" for JWKS_CACHE_TTL seconds,
+    and requested again when the token is signed with an unknown key.
+
+    It requires the package cryptography to be installed.
+
+    Args:
+        token (str): Access token.
+        session (requests.Session, optional): Session used for the requests.
+        policy (RetryPolicy, optional): Retry policy of the requests.
+        use_cache (bool, optional): Whether the keys cache file should be used.
+            Default True.
+        audience (str, optional): Expected aud claim.
+            Default "carto-cloud-native-api".
+        leeway (float, optional): Seconds of tolerance of the exp claim. Default 0.
+
+    Returns:
+        dict: Claims of the token.
+
+    Raises:
+        CredentialsError: If the token is not a valid JWT issued by CARTO.
+    """
+    try:
+        header_segment, payload_segment, signature_segment = token.split(".")
+        header = json.loads(_b64decode(header_segment))
+        claims = json.loads(_b64decode(payload_segment))
+        signature = _b64decode(signature_segment)
+    except (AttributeError, ValueError):
+        raise CredentialsError("Invalid JWT")
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise CredentialsError("Invalid JWT")
+
+    if header.get("alg") != "RS256":
+        raise CredentialsError(f"Unsupported JWT algorithm: {header.get('alg')}")
+
+    jwk = get_jwk(header.get("kid"), session, policy, use_cache)
+    signing_input = f"{header_segment}.{payload_segment}".encode("ascii")
+    if not _verify_rs256(jwk, signing_input, signature):
+        raise CredentialsError("Invalid JWT signature")
+
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or time.time() > exp + leeway:
+        raise CredentialsError("JWT expired")
+
+    aud = claims.get("aud")
+    if audience not in (aud if isinstance(aud, list) else [aud]):
+        raise CredentialsError("Invalid JWT audience")
+
+    if claims.get("iss") != ISSUER:
+        raise CredentialsError("Invalid JWT issuer")
+
+    return claims
+
+
+def get_jwk(kid, session=None, policy=None, use_cache=True):
+    """Get the public key of CARTO with a key id."""
+    jwks = load_jwks_cache() if use_cache else None
+    jwk = _find_jwk(jwks, kid)
+    if jwk is None and _can_refresh_jwks(jwks):
+        response = request("GET", JWKS_URL, session=session, policy=policy)
+        jwks = parse_jwks_response(response)
+        if use_cache:
+            write_json_file(get_jwks_cache_filepath(), jwks)
+        jwk = _find_jwk(jwks, kid)
+
+    if jwk is None:
+        raise CredentialsError(f"Unknown JWT key: {kid}")
+
+    return jwk
+
+
+def parse_jwks_response(response):
+    try:
+        keys = response.json()["keys"]
+    except (KeyError, TypeError, ValueError):
+        raise CredentialsError("Invalid JWKS response")
+
+    return {"keys": keys, "fetched_at": int(time.time())}
+
+
+def get_jwks_cache_filepath():
+    return get_home_dir() / "jwks.json"
+
+
+def load_jwks_cache():
+    try:
+        with open(get_jwks_cache_filepath(), "r") as f:
+            jwks = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (
+        isinstance(jwks, dict)
+        and isinstance(jwks.get("keys"), list)
+        and time.time() < jwks.get("fetched_at", 0) + JWKS_CACHE_TTL
+    ):
+        return jwks
+
+
+def _can_refresh_jwks(jwks):
+    return jwks is None or (
+        time.time() >= jwks.get("fetched_at", 0) + JWKS_MIN_REFRESH_INTERVAL
+    )
+
+
+def _find_jwk(jwks, kid):
+    for jwk in (jwks or {}).get("keys", []):
+        if isinstance(jwk, dict) and jwk.get("kid") == kid and jwk.get("kty") == "RSA":
+            return jwk
+
+
+def _verify_rs256(jwk, signing_input, signature):
+    try:
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    except ImportError:
+        sys.stderr.write("Error: jwt extension not found.\n")
+        sys.stderr.write("Please, install carto-auth[jwt]\n")
+        raise
+
+    try:
+        public_key = rsa.RSAPublicNumbers(
+            int.from_bytes(_b64decode(jwk["e"]), "big"),
+            int.from_bytes(_b64decode(jwk["n"]), "big"),
+        ).public_key()
+    except (KeyError, ValueError):
+        raise CredentialsError("Invalid JWT key")
+
+    try:
+        public_key.verify(signature, signing_input, padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        return False
+    return True
+
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
@@ -0,0 +1,237 @@
+import os
+import math
+import bisect
+import weakref
+import threading
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TTL_BUCKETS = (0, 60, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+_default_metrics = None
+_default_metrics_lock = threading.Lock()
+
+# Objects whose locks are recreated in forked processes
+_instances = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    # Locks may have been held by threads that do not exist in the child
+    global _default_metrics_lock
+    _default_metrics_lock = threading.Lock()
+    for metrics in list(_instances):
+        metrics._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class Metrics:
+    """Counters and histograms of the tokens and requests of carto_auth.
+
+    The metrics are identified by a name and a set of labels, whose values
+    are converted to strings. Use stats
+    to get a snapshot, or export to format it, for example in Prometheus
+    text format with prometheus_exporter.
+
+    Recorded metrics:
+        cache_requests_total (layer, result): Token lookups in the memory,
+            shared_memory and file caches, with result hit or miss.
+        token_ttl_at_use_seconds: Seconds left of the token when it is used.
+        token_refreshes_total (mode): Tokens requested to CARTO.
+        token_refresh_errors_total (mode): Failed token requests.
+        token_refresh_duration_seconds (mode): Latency of the token requests.
+        carto_dw_fetches_total: CARTO DW credentials requested to CARTO.
+        unauthorized_retries_total: API requests sent again with a renewed
+            token after a 401 response, see CartoRequestsAuth.
+        http_requests_total (method, host, status): HTTP requests by status
+            code, or status "error" if no response was received.
+        http_request_duration_seconds (method, host): Latency of each HTTP
+            request attempt.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def counter(self, name, **labels):
+        """Get the counter of a name and labels, to increment it repeatedly."""
+        key = _key(name, labels)
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, _Counter())
+        return counter
+
+    def histogram(self, name, buckets=DURATION_BUCKETS, **labels):
+        """Get the histogram of a name and labels, to record values repeatedly."""
+        key = _key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, _Histogram(buckets))
+        return histogram
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        self.counter(name, **labels).inc(value)
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """Record a value in a histogram."""
+        self.histogram(name, buckets, **labels).observe(value)
+
+    def stats(self):
+        """Get a snapshot of all the metrics.
+
+        Returns:
+            dict: For each metric name, a list of samples with its "labels"
+            and "value" for counters, or "count", "sum" and cumulative
+            "buckets" for histograms.
+        """
+        snapshot = {}
+        with self._lock:
+            for (name, labels), counter in sorted(
+                self._counters.items(), key=lambda item: item[0]
+            ):
+                snapshot.setdefault(name, []).append(
+                    {"labels": dict(labels), "value": counter.value}
+                )
+            for (name, labels), histogram in sorted(
+                self._histograms.items(), key=lambda item: item[0]
+            ):
+                snapshot.setdefault(name, []).append(
+                    dict(histogram.snapshot(), labels=dict(labels))
+                )
+        return snapshot
+
+    def export(self, exporter):
+        """Export a snapshot of the metrics.
+
+        Args:
+            exporter (callable): Function that receives the stats snapshot,
+                like prometheus_exporter.
+
+        Returns:
+            The value returned by the exporter.
+        """
+        return exporter(self.stats())
+
+    def reset(self):
+        """Set all the recorded metrics to zero."""
+        with self._lock:
+            for counter in self._counters.values():
+                counter.reset()
+            for histogram in self._histograms.values():
+                histogram.reset()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        for metric in list(self._counters.values()) + list(self._histograms.values()):
+            metric._lock = threading.Lock()
+
+
+class _Counter:
+    # Each metric has its own lock, so recording a value does not wait for
+    # the other metrics or for the creation of new ones
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def inc(self, value=1):
+        with self._lock:
+            self._value += value
+
+    def reset(self):
+        with self._lock:
+            self._value = 0
+
+
+class _Histogram:
+    # Own lock, like _Counter
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._lock = threading.Lock()
+        self._counts = [0] * len(self.buckets)
+        self._count = 0
+        self._sum = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._count += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            count = self._count
+            total = self._sum
+
+        buckets = {}
+        cumulative = 0
+        for bound, value in zip(self.buckets, counts):
+            cumulative += value
+            buckets[bound] = cumulative
+        return {"count": count, "sum": total, "buckets": buckets}
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * len(self.buckets)
+            self._count = 0
+            self._sum = 0
+
+
+def _key(name, labels):
+    # Label values are strings, so samples with mixed types can be sorted
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def get_default_metrics():
+    """Get the metrics shared by default by all the CartoAuth objects."""
+    global _default_metrics
+    if _default_metrics is None:
+        with _default_metrics_lock:
+            if _default_metrics is None:
+                _default_metrics = Metrics()
+    return _default_metrics
+
+
+def prometheus_exporter(stats, prefix="carto_auth_"):
+    """Format a stats snapshot in Prometheus text exposition format."""
+    lines = []
+    for name, samples in stats.items():
+        metric = f"{prefix}{name}"
+        histogram = "buckets" in samples[0]
+        lines.append(f"# TYPE {metric} {'histogram' if histogram else 'counter'}")
+        for sample in samples:
+            labels = sample["labels"]
+            if not histogram:
+                lines.append(f"{metric}{_labels(labels)} {sample['value']}")
+                continue
+            for bound, count in sample["buckets"].items():
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append(f"{metric}_bucket{_labels(labels, le=le)} {count}")
+            lines.append(f"{metric}_sum{_labels(labels)} {sample['sum']:g}")
+            lines.append(f"{metric}_count{_labels(labels)} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -4,14 +4,17 @@ import random
 import logging
 import secrets
 import requests
+import threading
 import webbrowser
 
+from concurrent.futures import Future
 from urllib.parse import urlparse, urlencode
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qsl
-from datetime import datetime, timedelta
 
 from carto_auth.errors import CredentialsError
+from carto_auth.retry import get_default_policy
+from carto_auth.utils import get_expiration
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +24,9 @@ AUDIENCE = "carto-cloud-native-api"
 CLIENT_ID = "0dxb8HR3ATXCxJiPOJVHsLoHoAtbRX6u"
 REDIRECT_URI = "http://localhost:10000/callback/"
 REDIRECT_URI_CLI = "https://app.carto.com/auth/token"
+AUTH_TIMEOUT = 300
+# Request a refresh token to renew the access token without the browser
+SCOPE = "offline_access"
 
 
 class CartoPKCE:
@@ -30,6 +36,9 @@ class CartoPKCE:
         self,
         open_browser=True,
         org=None,
+        session=None,
+        policy=None,
+        timeout=AUTH_TIMEOUT,
     ):
         """Creates PKCE Auth flow.
 
@@ -38,6 +47,10 @@ class CartoPKCE:
                 to authorize a user. Default True, except when using Google Colab
                 or Databricks.
             org (str, optional): Single Sign-On (SSO) organization in CARTO.
+            session (requests.Session, optional): Session used for the requests.
+            policy (RetryPolicy, optional): Retry policy of the requests.
+            timeout (float, optional): Seconds to wait for the authorization
+                in the web browser. Default 300.
         """
         using_google_colab = "google.colab" in sys.modules
         using_databricks = "DATABRICKS_RUNTIME_VERSION" in os.environ
@@ -45,10 +58,12 @@ class CartoPKCE:
             False if (using_google_colab or using_databricks) else open_browser
         )
         self.org = org
+        self.timeout = timeout
 
         self.redirect_uri = REDIRECT_URI if self.open_browser else REDIRECT_URI_CLI
 
-        self._session = requests.Session()
+        self._session = session or requests.Session()
+        self._policy = policy or get_default_policy()
         self._code_challenge_method = "S256"
         self._code_verifier = None
         self._code_challenge = None
@@ -81,7 +96,7 @@ class CartoPKCE:
         payload = {
             "client_id": CLIENT_ID,
             "response_type": "code",
-            "scope": None,
+            "scope": SCOPE,
             "audience": AUDIENCE,
             "redirect_uri": self.redirect_uri,
             "code_challenge_method": self._code_challenge_method,
@@ -109,34 +124,54 @@ class CartoPKCE:
         if open_browser is None:
             open_browser = self.open_browser
 
-        try:
-            if (
-                open_browser
-                and redirect_host in ("127.0.0.1", "localhost")
-                and redirect_info.scheme == "http"
-            ):
-                return self._get_auth_response_local_server(redirect_port)
-        except Exception:
-            self.redirect_uri = REDIRECT_URI_CLI
-            return self._get_auth_response_interactive()
+        if (
+            open_browser
+            and redirect_host in ("127.0.0.1", "localhost")
+            and redirect_info.scheme == "http"
+        ):
+            try:
+                future = self._start_local_server_flow(redirect_port)
+            except Exception:
+                self.redirect_uri = REDIRECT_URI_CLI
+                return self._get_auth_response_interactive()
+            return future.result()
 
         return self._get_auth_response_interactive()
 
-    def _get_auth_response_local_server(self, redirect_port):
-        server = _start_local_http_server(redirect_port)
-        self._open_auth_url()
-        server.handle_request()
+    def get_auth_code_future(self):
+        """Start the authorization in the web browser without waiting for it.
 
-        if server.auth_code is not None:
-            return server.auth_code
-        elif server.error is not None:
-            raise CredentialsError(
-                "Received error from OAuth server: {}".format(server.error)
-            )
-        else:
-            raise CredentialsError(
-                "Server listening on localhost has not been accessed"
-            )
+        A local server receives the authorization code in a background
+        thread. Requests to the server without the state of this flow
+        are ignored.
+
+        Returns:
+            concurrent.futures.Future: Future of the authorization code. It fails
+            with CredentialsError if the authorization is rejected or not
+            completed in timeout seconds.
+        """
+        redirect_info = urlparse(self.redirect_uri)
+        _, redirect_port = _get_host_port(redirect_info.netloc)
+        return self._start_local_server_flow(redirect_port)
+
+    async def aget_auth_code(self):
+        """Get the authorization code in the web browser without blocking the loop.
+
+        See get_auth_code_future.
+        """
+        import asyncio
+
+        return await asyncio.wrap_future(self.get_auth_code_future())
+
+    def _start_local_server_flow(self, redirect_port):
+        state = secrets.token_urlsafe(16)
+        server = _start_local_http_server(redirect_port, state, self.timeout)
+        try:
+            self._open_auth_url(state)
+        except Exception as error:
+            server.resolve(error=CredentialsError(str(error)))
+            raise
+        return server.future
 
     def _input(self, prompt):
         print(prompt)
@@ -177,8 +212,12 @@ class CartoPKCE:
 
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-        response = self._session.post(
+        # The authorization code can only be used once
+        response = self._policy.request(
+            self._session,
+            "POST",
             OAUTH_TOKEN_URL,
+            idempotent=False,
             data=payload,
             headers=headers,
             verify=True,
@@ -191,16 +230,13 @@ class CartoPKCE:
             raise CredentialsError("Invalid OAuth response")
 
         if "access_token" in response_data and "expires_in" in response_data:
-            access_token = response_data["access_token"]
-            expires_in = response_data["expires_in"]
-            expiration = int(
-                (datetime.utcnow() + timedelta(seconds=expires_in)).timestamp()
-            )
-
-            return {
-                "access_token": access_token,
-                "expiration": expiration,
+            token_info = {
+                "access_token": response_data["access_token"],
+                "expiration": get_expiration(response_data["expires_in"]),
             }
+            if response_data.get("refresh_token"):
+                token_info["refresh_token"] = response_data["refresh_token"]
+            return token_info
 
         raise CredentialsError("Invalid attributes in OAuth response")
 
@@ -222,19 +258,28 @@ class CartoPKCE:
 
 class RequestHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        self.server.auth_code = self.server.error = None
-        try:
-            state, auth_code = CartoPKCE._parse_auth_response_url(self.path)
-            self.server.state = state
-            self.server.auth_code = auth_code
-        except Exception as error:
-            self.server.error = error
+        form = dict(parse_qsl(urlparse(self.path).query))
+        if form.get("state") != self.server.state or not (
+            form.get("code") or form.get("error")
+        ):
+            # Stray request, like a favicon: keep waiting for the callback
+            self.send_error(404)
+            return
+
+        if form.get("error"):
+            self.server.resolve(
+                error=CredentialsError(
+                    "Received error from OAuth server: {}".format(form["error"])
+                )
+            )
+        else:
+            self.server.resolve(auth_code=form["code"])
 
         self.send_response(200)
         self.send_header("Content-Type", "text/html")
         self.end_headers()
 
-        if self.server.auth_code:
+        if not form.get("error"):
             callback_html = """<script>
             window.location.href = "https://app.carto.com/auth/success";
             </script>"""
@@ -252,12 +297,59 @@ class RequestHandler(BaseHTTPRequestHandler):
         return
 
 
-def _start_local_http_server(port, handler=RequestHandler):
-    server = HTTPServer(("localhost", port), handler)
-    server.allow_reuse_address = True
-    server.auth_code = None
-    server.auth_token_form = None
-    server.error = None
+class _CallbackServer(ThreadingHTTPServer):
+    """Local server that receives the authorization code in a background thread.
+
+    The server stops when the code or an error is received, or after timeout
+    seconds.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, port, state, timeout, handler=RequestHandler):
+        super().__init__(("localhost", port), handler)
+        self.state = state
+        self.future = Future()
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(timeout, self._timeout)
+        self._timer.daemon = True
+
+    def start(self):
+        threading.Thread(
+            target=self.serve_forever, name="carto-auth-pkce", daemon=True
+        ).start()
+        self._timer.start()
+
+    def resolve(self, auth_code=None, error=None):
+        with self._lock:
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(auth_code)
+
+        self._timer.cancel()
+        # The server cannot be stopped from its own request thread
+        threading.Thread(target=self._stop, daemon=True).start()
+
+    def _timeout(self):
+        self.resolve(
+            error=CredentialsError(
+                "Timeout waiting for the authorization in the web browser"
+            )
+        )
+
+    def _stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _start_local_http_server(port, state, timeout, handler=RequestHandler):
+    server = _CallbackServer(port, state, timeout, handler)
+    server.start()
     return server
 
 
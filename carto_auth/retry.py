@@ -0,0 +1,290 @@
+import os
+import time
+import weakref
+import threading
+
+from urllib.parse import urlparse
+
+from carto_auth.errors import CredentialsError
+from carto_auth.metrics import get_default_metrics
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_default_policy = None
+_default_policy_lock = threading.Lock()
+
+# Policies and breakers whose locks are recreated in forked processes
+_instances = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    # Locks may have been held by threads that do not exist in the child
+    global _default_policy_lock
+    _default_policy_lock = threading.Lock()
+    for instance in list(_instances):
+        instance._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class RetryPolicy:
+    """Timeouts, retries and circuit breaker for the requests to CARTO.
+
+    Failed requests are retried with exponential backoff and full jitter,
+    honoring the Retry-After header. After failure_threshold consecutive
+    failures to a host, its requests fail fast for recovery_timeout seconds.
+
+    Args:
+        connect_timeout (float, optional): Seconds to establish a connection.
+            Default 5.
+        read_timeout (float, optional): Seconds to wait for the response.
+            Default 30.
+        deadline (float, optional): Maximum seconds for all the attempts
+            of a request. Default 60.
+        max_retries (int, optional): Maximum number of retries. Default 3.
+        backoff_factor (float, optional): Base seconds of the exponential backoff.
+            Default 0.5.
+        max_backoff (float, optional): Maximum seconds between attempts.
+            Default 10.
+        failure_threshold (int, optional): Consecutive failures that open
+            the circuit of a host. Default 5.
+        recovery_timeout (float, optional): Seconds the circuit stays open.
+            Default 30.
+        metrics (Metrics, optional): Metrics where the status code and latency
+            of each attempt are recorded. Default the metrics shared by all
+            CartoAuth objects.
+    """
+
+    def __init__(
+        self,
+        connect_timeout=5,
+        read_timeout=30,
+        deadline=60,
+        max_retries=3,
+        backoff_factor=0.5,
+        max_backoff=10,
+        failure_threshold=5,
+        recovery_timeout=30,
+        metrics=None,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.metrics = metrics or get_default_metrics()
+        self._breakers = {}
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def request(self, session, method, url, idempotent=True, **kwargs):
+        """Send a request with a requests.Session.
+
+        Requests that are not idempotent are only retried when the connection
+        could not be established.
+
+        Raises:
+            CredentialsError: If the circuit is open, or all the attempts
+                fail with a connection error or a retryable status code.
+        """
+        import requests
+
+        breaker = self._get_breaker(url)
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            breaker.before_request(url)
+            timeout = (self.connect_timeout, self._read_timeout(deadline))
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self._record(method, url, start)
+                breaker.record_failure()
+                retry = idempotent or isinstance(error, requests.ConnectTimeout)
+                delay = self._next_delay(attempt, deadline, retry)
+                if delay is None:
+                    raise CredentialsError(
+                        f"Request to {url} failed: {error}", retryable=True
+                    ) from error
+            else:
+                self._record(method, url, start, response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                delay = self._next_delay(attempt, deadline, idempotent, response)
+                if delay is None:
+                    raise _status_error(url, response.status_code)
+
+            time.sleep(delay)
+            attempt += 1
+
+    async def arequest(self, client, method, url, idempotent=True, **kwargs):
+        """Send a request with an httpx.AsyncClient.
+
+        It follows the same rules as request.
+        """
+        import httpx
+        import asyncio
+
+        breaker = self._get_breaker(url)
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+
+        while True:
+            breaker.before_request(url)
+            timeout = httpx.Timeout(
+                self._read_timeout(deadline), connect=self.connect_timeout
+            )
+            start = time.monotonic()
+            try:
+                response = await client.request(method, url, timeout=timeout, **kwargs)
+            except httpx.TransportError as error:
+                self._record(method, url, start)
+                breaker.record_failure()
+                retry = idempotent or isinstance(
+                    error, (httpx.ConnectError, httpx.ConnectTimeout)
+                )
+                delay = self._next_delay(attempt, deadline, retry)
+                if delay is None:
+                    raise CredentialsError(
+                        f"Request to {url} failed: {error}", retryable=True
+                    ) from error
+            else:
+                self._record(method, url, start, response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                delay = self._next_delay(attempt, deadline, idempotent, response)
+                if delay is None:
+                    raise _status_error(url, response.status_code)
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _get_breaker(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.recovery_timeout)
+                self._breakers[host] = breaker
+            return breaker
+
+    def _record(self, method, url, start, status_code=None):
+        host = urlparse(url).netloc
+        self.metrics.inc(
+            "http_requests_total",
+            method=method,
+            host=host,
+            status=status_code or "error",
+        )
+        self.metrics.observe(
+            "http_request_duration_seconds",
+            time.monotonic() - start,
+            method=method,
+            host=host,
+        )
+
+    def _read_timeout(self, deadline):
+        return max(min(self.read_timeout, deadline - time.monotonic()), 0.001)
+
+    def _next_delay(self, attempt, deadline, retry, response=None):
+        """Seconds to wait before the next attempt, or None to stop retrying."""
+        if not retry or attempt >= self.max_retries:
+            return None
+
+        delay = _retry_after(response)
+        if delay is None:
+            import random
+
+            backoff = min(self.max_backoff, self.backoff_factor * 2**attempt)
+            delay = random.uniform(0, backoff)
+
+        if time.monotonic() + delay >= deadline:
+            return None
+
+        return delay
+
+
+class CircuitBreaker:
+    """Fail fast while a host keeps failing.
+
+    The circuit opens after failure_threshold consecutive failures. After
+    recovery_timeout seconds, one request is let through: if it succeeds
+    the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+        _instances.add(self)
+
+    def before_request(self, url=None):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.recovery_timeout:
+                raise CredentialsError(
+                    f"Circuit open for {url}: too many failed requests",
+                    retryable=True,
+                )
+            # Half-open: let this request through, fail fast the rest
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+def get_default_policy():
+    """Get the retry policy shared by default by all the requests to CARTO."""
+    global _default_policy
+    if _default_policy is None:
+        with _default_policy_lock:
+            if _default_policy is None:
+                _default_policy = RetryPolicy()
+    return _default_policy
+
+
+def _retry_after(response):
+    value = response is not None and response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(retry_at.timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _status_error(url, status_code):
+    return CredentialsError(
+        f"Request to {url} failed with status {status_code}",
+        retryable=True,
+        status_code=status_code,
+    )
@@ -0,0 +1,225 @@
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from carto_auth.errors import CredentialsError
+
+logger = logging.getLogger(__name__)
+
+REFRESH_RETRY_INTERVAL = 10
+
+
+class RefreshScheduler:
+    """Renew the m2m tokens of many CartoAuth objects before they expire.
+
+    Tokens issued together expire together, so a service with hundreds of
+    identities would request them to CARTO in synchronized spikes. The
+    scheduler renews each token at a random time between `refresh_skew`
+    seconds before its expiration and `jitter` of its remaining lifetime
+    earlier, with at most `max_concurrency` token requests at a time.
+
+    When more refreshes are due than can run at once, the identities used
+    most recently, the most likely to be used next, are renewed first.
+    Identities not used since their last refresh are renewed last.
+
+    A failed refresh is retried after REFRESH_RETRY_INTERVAL seconds,
+    with jitter. A token renewed by other means, for example after a 401
+    response, is rescheduled with its new expiration.
+
+    Example:
+        scheduler = RefreshScheduler(max_concurrency=4)
+        for filepath in filepaths:
+            scheduler.add(CartoAuth.from_m2m(filepath))
+        scheduler.start()
+
+    Args:
+        max_concurrency (int, optional): Maximum number of token requests
+            at a time. Default 4.
+        refresh_skew (int, optional): Minimum seconds before the expiration
+            when the tokens are renewed. Default 300.
+        jitter (float, optional): Fraction of the remaining lifetime of the
+            token, after refresh_skew, over which its refresh is spread.
+            Default 0.1.
+    """
+
+    def __init__(self, max_concurrency=4, refresh_skew=300, jitter=0.1):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if not 0 <= jitter <= 1:
+            raise ValueError("jitter must be between 0 and 1")
+
+        self.max_concurrency = max_concurrency
+        self.refresh_skew = refresh_skew
+        self.jitter = jitter
+        self._entries = {}
+        self._heap = []
+        self._ready = []
+        self._running = 0
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopped = True
+
+    def add(self, carto_auth):
+        """Renew the token of a CartoAuth object.
+
+        Raises:
+            CredentialsError: If the mode is not m2m.
+        """
+        if carto_auth._mode != "m2m":
+            raise CredentialsError("Background refresh is only available for m2m")
+
+        with self._condition:
+            if carto_auth in self._entries:
+                return
+            entry = _Entry(carto_auth)
+            self._entries[carto_auth] = entry
+            self._schedule(entry, self._get_refresh_time(entry))
+            self._condition.notify()
+
+    def remove(self, carto_auth):
+        """Stop renewing the token of a CartoAuth object."""
+        with self._condition:
+            entry = self._entries.pop(carto_auth, None)
+            if entry is not None:
+                entry.removed = True
+
+    def __contains__(self, carto_auth):
+        return carto_auth in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self, daemon=True):
+        """Start renewing the tokens in background threads.
+
+        Args:
+            daemon (bool, optional): Whether the threads should be daemon threads.
+                Default True.
+        """
+        with self._condition:
+            if not self._stopped:
+                return self
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency,
+                thread_name_prefix="carto-auth-scheduler",
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="carto-auth-scheduler", daemon=daemon
+            )
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop renewing the tokens.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the scheduler thread
+                to finish. Default None (wait until it finishes).
+        """
+        with self._condition:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+        self._thread = None
+        self._executor = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                heap = self._heap
+                while heap and heap[0][0] <= now:
+                    _, _, entry = heapq.heappop(heap)
+                    if not entry.removed:
+                        self._ready.append(entry)
+
+                if self._ready and self._running < self.max_concurrency:
+                    self._ready.sort(key=_priority)
+                    while self._ready and self._running < self.max_concurrency:
+                        entry = self._ready.pop(0)
+                        if not entry.removed:
+                            self._running += 1
+                            self._executor.submit(self._refresh, entry)
+
+                timeout = None
+                if heap:
+                    timeout = max(heap[0][0] - now, 0)
+                self._condition.wait(timeout)
+
+    def _refresh(self, entry):
+        carto_auth = entry.carto_auth
+        token = carto_auth._token
+        try:
+            if token.deadline != entry.deadline and token.ttl() > self.refresh_skew:
+                # Renewed by other means since it was scheduled
+                refresh_time = self._get_refresh_time(entry)
+            else:
+                carto_auth._refresh_access_token(token.access_token)
+                entry.refreshed_at = time.monotonic()
+                refresh_time = self._get_refresh_time(entry, refreshed=True)
+        except Exception:
+            logger.exception("Scheduled token refresh failed")
+            refresh_time = time.monotonic() + REFRESH_RETRY_INTERVAL * (
+                1 + random.random()
+            )
+
+        with self._condition:
+            self._running -= 1
+            if not entry.removed:
+                self._schedule(entry, refresh_time)
+            self._condition.notify()
+
+    def _get_refresh_time(self, entry, refreshed=False):
+        token = entry.carto_auth._token
+        entry.deadline = token.deadline
+        now = time.monotonic()
+        if not token.access_token:
+            return now
+
+        ttl = token.deadline - now
+        delay = ttl - self.refresh_skew
+        if delay <= 0:
+            # The token lifetime is shorter than the skew: renew it halfway
+            return now + ttl / 2 if refreshed and ttl > 0 else now
+        return now + delay * (1 - self.jitter * random.random())
+
+    def _schedule(self, entry, refresh_time):
+        heapq.heappush(self._heap, (refresh_time, next(self._counter), entry))
+
+
+class _Entry:
+    __slots__ = ("carto_auth", "deadline", "refreshed_at", "removed")
+
+    def __init__(self, carto_auth):
+        self.carto_auth = carto_auth
+        self.deadline = None
+        self.refreshed_at = float("-inf")
+        self.removed = False
+
+
+def _priority(entry):
+    last_used = entry.carto_auth._last_used
+    if last_used is None or last_used < entry.refreshed_at:
+        # Not used since its last refresh
+        return (1, entry.deadline)
+    return (0, -last_used)
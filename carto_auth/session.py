@@ -0,0 +1,99 @@
+import requests
+
+from requests.auth import AuthBase
+from requests.adapters import HTTPAdapter
+
+from carto_auth.errors import CredentialsError
+
+
+class CartoRequestsAuth(AuthBase):
+    """Authentication of requests to the CARTO APIs with a CartoAuth object.
+
+    The access token is added to each request. If a request is rejected with
+    401 Unauthorized, the token is renewed once and the request is sent again.
+    Concurrent requests rejected with the same token share the renewal.
+
+    Args:
+        carto_auth (CartoAuth): Object that provides the access token.
+    """
+
+    def __init__(self, carto_auth):
+        self._carto_auth = carto_auth
+
+    def __call__(self, r):
+        r.headers["Authorization"] = _bearer(self._carto_auth.get_access_token())
+        r.register_hook("response", self._handle_401)
+        return r
+
+    def _handle_401(self, response, **kwargs):
+        request = response.request
+        if (
+            response.status_code != 401
+            or getattr(request, "_carto_auth_retried", False)
+            or not _is_replayable(request.body)
+        ):
+            return response
+
+        stale_token = request.headers.get("Authorization", "").partition(" ")[2]
+        access_token = self._carto_auth._refresh_access_token(stale_token)
+        self._carto_auth._metrics.inc("unauthorized_retries_total")
+
+        # Release the connection before sending the request again
+        response.content
+        response.close()
+
+        retry = request.copy()
+        retry.headers["Authorization"] = _bearer(access_token)
+        retry._carto_auth_retried = True
+
+        retry_response = response.connection.send(retry, **kwargs)
+        retry_response.history.append(response)
+        retry_response.request = retry
+        return retry_response
+
+
+class CartoApiSession(requests.Session):
+    """Session for the CARTO APIs authenticated with a CartoAuth object.
+
+    Relative URLs are resolved against the API base URL, so
+    session.get("/v3/connections") requests
+    "{api_base_url}/v3/connections". The requests are authenticated
+    with CartoRequestsAuth.
+
+    Args:
+        carto_auth (CartoAuth): Object that provides the access token
+            and the API base URL.
+        pool_connections (int, optional): Number of hosts with a cached pool.
+            Default 10.
+        pool_maxsize (int, optional): Maximum number of connections per host.
+            Default 10.
+    """
+
+    def __init__(self, carto_auth, pool_connections=10, pool_maxsize=10):
+        super().__init__()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.auth = CartoRequestsAuth(carto_auth)
+        self._carto_auth = carto_auth
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, self._build_url(url), *args, **kwargs)
+
+    def _build_url(self, url):
+        if url.startswith(("http://", "https://")):
+            return url
+        api_base_url = self._carto_auth.get_api_base_url()
+        if not api_base_url:
+            raise CredentialsError("api_base_url required")
+        return f"{api_base_url.rstrip('/')}/{url.lstrip('/')}"
+
+
+def _bearer(access_token):
+    return f"Bearer {access_token}"
+
+
+def _is_replayable(body):
+    return body is None or isinstance(body, (bytes, str))
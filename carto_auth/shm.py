@@ -0,0 +1,106 @@
+import os
+import mmap
+import struct
+
+from carto_auth.token_state import TokenState
+from carto_auth.utils import get_home_dir, lock_cache_file
+
+# Layout of the slot: generation, expiration and length of the token,
+# followed by the token
+_HEADER = struct.Struct("<QdI")
+_GENERATION = struct.Struct("<Q")
+_TOKEN_OFFSET = 32
+_READ_ATTEMPTS = 100
+
+SLOT_CAPACITY = 16384
+
+
+def get_shared_slot_filepath(cache_key):
+    return get_home_dir() / f"token_{cache_key}.shm"
+
+
+class SharedTokenSlot:
+    """Token shared in memory by the processes of a host.
+
+    The slot is a memory-mapped file, so the processes forked from the one
+    that opened it, and any other process that opens the same file, read
+    the token and its expiration without system calls or parsing.
+
+    The slot is a seqlock: the writer makes the generation odd while it
+    writes and even again when it finishes, and readers retry if the
+    generation changed while they read. Writers are serialized with lock.
+
+    Args:
+        filepath (str): File path of the slot.
+        capacity (int, optional): Maximum bytes of the token. Default 16384.
+    """
+
+    def __init__(self, filepath, capacity=SLOT_CAPACITY):
+        self.filepath = str(filepath)
+        self.capacity = capacity
+        size = _TOKEN_OFFSET + capacity
+
+        fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size, mmap.MAP_SHARED)
+        finally:
+            os.close(fd)
+
+    def generation(self):
+        """Get the generation of the slot, which changes with every write."""
+        return _GENERATION.unpack_from(self._mmap)[0]
+
+    def read(self):
+        """Read the token of the slot.
+
+        Returns:
+            tuple: generation and TokenState, or None if the slot is empty
+            or being written.
+        """
+        mm = self._mmap
+        for _ in range(_READ_ATTEMPTS):
+            generation, expiration, length = _HEADER.unpack_from(mm)
+            if generation & 1 or length > self.capacity:
+                # Being written
+                continue
+            end = _TOKEN_OFFSET + length
+            data = mm[_TOKEN_OFFSET:end]
+            if _GENERATION.unpack_from(mm)[0] != generation:
+                continue
+            if generation == 0:
+                return None
+            return generation, TokenState(data.decode("utf-8"), int(expiration))
+        return None
+
+    def write(self, token):
+        """Write a token in the slot. The caller must hold the lock.
+
+        Args:
+            token (TokenState): Token to share.
+
+        Returns:
+            int: New generation of the slot.
+        """
+        data = token.access_token.encode("utf-8")
+        if len(data) > self.capacity:
+            raise ValueError("Token larger than the shared memory slot")
+
+        mm = self._mmap
+        generation = _GENERATION.unpack_from(mm)[0]
+        # Odd while writing. It is already odd if a writer died while writing
+        generation |= 1
+        _GENERATION.pack_into(mm, 0, generation)
+        end = _TOKEN_OFFSET + len(data)
+        mm[_TOKEN_OFFSET:end] = data
+        _HEADER.pack_into(mm, 0, generation, token.expiration or 0, len(data))
+        _GENERATION.pack_into(mm, 0, generation + 1)
+        return generation + 1
+
+    def lock(self):
+        """Hold the lock to renew the token, between processes."""
+        return lock_cache_file(self.filepath)
+
+    def close(self):
+        self._mmap.close()
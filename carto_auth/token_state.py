@@ -0,0 +1,35 @@
+import math
+import time
+
+
+class TokenState:
+    """Access token with its expiration.
+
+    The expiration is the POSIX timestamp stored in the caches. The deadline
+    is the same instant in the monotonic clock, so the token can be checked
+    with a single comparison, unaffected by changes of the system clock.
+
+    The objects are not modified: a renewed token is a new TokenState, so
+    readers in other threads always see a token with its own expiration.
+
+    Args:
+        access_token (str, optional): Token generated with CARTO.
+        expiration (int, optional): Time in seconds when the token will be expired.
+    """
+
+    __slots__ = ("access_token", "expiration", "deadline")
+
+    def __init__(self, access_token=None, expiration=None):
+        self.access_token = access_token
+        self.expiration = expiration
+        if expiration:
+            self.deadline = time.monotonic() + (expiration - time.time())
+        else:
+            self.deadline = -math.inf
+
+    def ttl(self):
+        """Seconds left until the expiration (negative if already expired)."""
+        return self.deadline - time.monotonic()
+
+    def is_expired(self):
+        return time.monotonic() > self.deadline
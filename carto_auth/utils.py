@@ -1,13 +1,46 @@
 import os
 import json
-import yaml
-import requests
+import time
+import hashlib
+import threading
+import contextlib
 
 from pathlib import Path
-from datetime import datetime, timedelta
 
-from carto_auth.pkce import CartoPKCE
 from carto_auth.errors import CredentialsError
+from carto_auth.retry import get_default_policy
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None
+
+OAUTH_TOKEN_URL = "https://auth.carto.com/oauth/token"
+ACCOUNTS_URL = "https://accounts.app.carto.com/accounts"
+TENANT_CONFIG_URL = "https://{tenant_domain}/config.yaml"
+CARTO_DW_TOKEN_PATH = "/v3/connections/carto-dw/token"
+AUDIENCE = "carto-cloud-native-api"
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+TENANT_CACHE_TTL = 86400
+
+_session = None
+_session_lock = threading.Lock()
+
+# Home directories already created, and contents of the cache files
+# by path with the signature of the file when they were read
+_home_dirs = set()
+_cache_files = {}
+
+
+def _after_fork_in_child():
+    # The connections of the shared session belong to the parent
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
 
 
 def api_headers(access_token):
@@ -17,40 +50,176 @@ def api_headers(access_token):
     }
 
 
-def get_oauth_token_info(open_browser=True, org=None):
-    carto_pkce = CartoPKCE(open_browser=open_browser, org=org)
+def create_session(pool_connections=10, pool_maxsize=10, keep_alive=True):
+    """Create a requests session with a connection pool.
+
+    Args:
+        pool_connections (int, optional): Number of hosts with a cached pool.
+            Default 10.
+        pool_maxsize (int, optional): Maximum number of connections per host.
+            Default 10.
+        keep_alive (bool, optional): Whether the connections should be reused
+            between requests. Default True.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def get_session():
+    """Get the session shared by default by all the requests to CARTO."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def request(method, url, session=None, policy=None, idempotent=True, **kwargs):
+    """Send a request to CARTO with timeouts, retries and circuit breaker.
+
+    Args:
+        method (str): HTTP method.
+        url (str): URL of the request.
+        session (requests.Session, optional): Session used for the request.
+            Default the shared session, see get_session.
+        policy (RetryPolicy, optional): Retry policy of the request.
+            Default the shared policy, see retry.get_default_policy.
+        idempotent (bool, optional): Whether the request can be sent again
+            after a failed response. Default True.
+        **kwargs: Extra arguments of requests.Session.request.
+    """
+    session = session or get_session()
+    policy = policy or get_default_policy()
+    return policy.request(session, method, url, idempotent=idempotent, **kwargs)
+
+
+def get_oauth_token_info(
+    open_browser=True, org=None, session=None, policy=None, refresh_token=None
+):
+    """Get an OAuth token with a refresh token, or authorizing in the browser.
+
+    The browser is only used when there is no refresh token, or when it
+    is rejected by the server. Connection errors are raised instead, so a
+    temporary outage does not start an interactive login.
+
+    Args:
+        open_browser (bool, optional): Whether the web browser should be opened
+            to authorize the user. Default True.
+        org (str, optional): Name of the organization.
+        session (requests.Session, optional): Session used for the requests.
+        policy (RetryPolicy, optional): Retry policy of the requests.
+        refresh_token (str, optional): Refresh token of a previous login.
+
+    Returns:
+        dict: access_token, expiration and, if issued, refresh_token.
+    """
+    if refresh_token:
+        try:
+            return get_refresh_token_info(refresh_token, session, policy)
+        except CredentialsError as error:
+            if error.retryable:
+                raise
+
+    session = session or get_session()
+    from carto_auth.pkce import CartoPKCE
+
+    carto_pkce = CartoPKCE(
+        open_browser=open_browser, org=org, session=session, policy=policy
+    )
     code = carto_pkce.get_auth_response()
     return carto_pkce.get_token_info(code)
 
 
-def get_m2m_token_info(client_id, client_secret):
-    url = "https://auth.carto.com/oauth/token"
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    data = {
+def get_refresh_token_info(refresh_token, session=None, policy=None):
+    response = request(
+        "POST",
+        OAUTH_TOKEN_URL,
+        session=session,
+        policy=policy,
+        # The refresh token may be rotated, so it can only be used once
+        idempotent=False,
+        headers=FORM_HEADERS,
+        data=refresh_token_payload(refresh_token),
+    )
+    return parse_refresh_token_response(response, refresh_token)
+
+
+def refresh_token_payload(refresh_token):
+    from carto_auth.pkce import CLIENT_ID
+
+    return {
+        "grant_type": "refresh_token",
+        "client_id": CLIENT_ID,
+        "refresh_token": refresh_token,
+    }
+
+
+def parse_refresh_token_response(response, refresh_token):
+    try:
+        response_data = response.json()
+    except ValueError:
+        raise CredentialsError(
+            "Invalid OAuth refresh response", status_code=response.status_code
+        )
+
+    if "access_token" in response_data and "expires_in" in response_data:
+        return {
+            "access_token": response_data["access_token"],
+            "expiration": get_expiration(response_data["expires_in"]),
+            "refresh_token": response_data.get("refresh_token", refresh_token),
+        }
+
+    raise CredentialsError(
+        response_data.get("error_description")
+        or response_data.get("error")
+        or "Invalid attributes in OAuth refresh response",
+        status_code=response.status_code,
+    )
+
+
+def get_m2m_token_info(client_id, client_secret, session=None, policy=None):
+    response = request(
+        "POST",
+        OAUTH_TOKEN_URL,
+        session=session,
+        policy=policy,
+        headers=FORM_HEADERS,
+        data=m2m_token_payload(client_id, client_secret),
+    )
+    return parse_m2m_token_response(response)
+
+
+def m2m_token_payload(client_id, client_secret):
+    return {
         "grant_type": "client_credentials",
-        "audience": "carto-cloud-native-api",
+        "audience": AUDIENCE,
         "client_id": client_id,
         "client_secret": client_secret,
     }
-    response = requests.post(url, headers=headers, data=data)
 
+
+def parse_m2m_token_response(response):
     try:
         response_data = response.json()
-    except requests.exceptions.JSONDecodeError:
+    except ValueError:
         raise CredentialsError(
             "Invalid M2M Token response. "
             "Please, make sure client_id and client_secret are correctly defined"
         )
 
     if "access_token" in response_data and "expires_in" in response_data:
-        access_token = response_data["access_token"]
-        expires_in = response_data["expires_in"]
-        expiration = int(
-            (datetime.utcnow() + timedelta(seconds=expires_in)).timestamp()
-        )
         return {
-            "access_token": access_token,
-            "expiration": expiration,
+            "access_token": response_data["access_token"],
+            "expiration": get_expiration(response_data["expires_in"]),
         }
 
     raise CredentialsError(
@@ -59,66 +228,339 @@ def get_m2m_token_info(client_id, client_secret):
     )
 
 
-def get_api_base_url(access_token):
-    url = "https://accounts.app.carto.com/accounts"
-    headers = api_headers(access_token)
-    response = requests.get(url, headers=headers)
+def get_api_base_url(access_token, session=None, use_cache=True, policy=None):
+    """Get the API base URL of the tenant of a token.
+
+    The tenant domain is read from the claims of the token if available,
+    otherwise it is requested to the accounts API.
+    """
+    from carto_auth.jwt import get_jwt_tenant_domain
+
+    tenant_domain = get_jwt_tenant_domain(access_token)
+    if tenant_domain is None:
+        response = request(
+            "GET",
+            ACCOUNTS_URL,
+            session=session,
+            policy=policy,
+            headers=api_headers(access_token),
+        )
+        tenant_domain = parse_accounts_response(response)
+
+    if tenant_domain:
+        return get_tenant_api_base_url(tenant_domain, session, use_cache, policy)
+
+
+def get_tenant_api_base_url(tenant_domain, session=None, use_cache=True, policy=None):
+    """Get the API base URL from the config of a tenant.
+
+    The result is stored in the tenants cache file for TENANT_CACHE_TTL seconds.
+    After that, the config is revalidated with a conditional request.
+
+    Args:
+        tenant_domain (str): Domain of the CARTO tenant.
+        session (requests.Session, optional): Session used for the requests.
+        use_cache (bool, optional): Whether the tenants cache file should be used.
+            Default True.
+        policy (RetryPolicy, optional): Retry policy of the requests.
+    """
+    entry = load_tenant_cache(tenant_domain) if use_cache else None
+    if entry and time.time() < entry.get("expiration", 0):
+        return entry["api_base_url"]
+
+    url = TENANT_CONFIG_URL.format(tenant_domain=tenant_domain)
+    response = request(
+        "GET",
+        url,
+        session=session,
+        policy=policy,
+        headers=tenant_config_headers(entry),
+    )
+    entry = parse_tenant_config_response(response, entry)
+
+    if use_cache:
+        save_tenant_cache(tenant_domain, entry)
+
+    return entry["api_base_url"]
+
+
+def tenant_config_headers(entry):
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def parse_tenant_config_response(response, entry=None):
+    if entry and response.status_code == 304:
+        api_base_url = entry["api_base_url"]
+    else:
+        api_base_url = parse_config_response(response)
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if entry and response.status_code == 304:
+        # The validators of the stored config are still valid
+        etag = etag or entry.get("etag")
+        last_modified = last_modified or entry.get("last_modified")
 
+    return {
+        "api_base_url": api_base_url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "expiration": int(time.time()) + TENANT_CACHE_TTL,
+    }
+
+
+def parse_accounts_response(response):
     try:
         response_data = response.json()
-    except requests.exceptions.JSONDecodeError:
+    except ValueError:
         raise CredentialsError("Invalid Accounts response")
 
     if response_data.get("error"):
         raise CredentialsError(response_data.get("error"))
 
-    tenant_domain = response_data.get("tenant_domain")
+    return response_data.get("tenant_domain")
 
-    if tenant_domain:
-        url = f"https://{tenant_domain}/config.yaml"
-        response = requests.get(url)
 
-        try:
-            config = yaml.safe_load(response.text)
-            api_base_url = config.get("apis").get("baseUrl")
-        except Exception:
-            raise CredentialsError("Invalid Config response")
+def parse_config_response(response):
+    import yaml
+
+    try:
+        config = yaml.safe_load(response.text)
+        return config.get("apis").get("baseUrl")
+    except Exception:
+        raise CredentialsError("Invalid Config response")
+
+
+def parse_carto_dw_response(response):
+    try:
+        response_data = response.json()
+    except ValueError:
+        raise CredentialsError(
+            "Invalid CARTO DW Token response. "
+            "Please, make sure api_base_url is correctly defined"
+        )
+
+    if "projectId" in response_data and "token" in response_data:
+        return response_data["projectId"], response_data["token"]
+
+    raise CredentialsError(
+        "Invalid attributes in CARTO DW Token response. "
+        "Please, make sure api_base_url is correctly defined"
+    )
+
 
-        return api_base_url
+def get_expiration(expires_in):
+    """Get the POSIX timestamp when a token that expires in some seconds expires."""
+    return int(time.time() + expires_in)
 
 
 def get_home_dir():
     home_dir = Path.home() / ".carto-auth"
-    home_dir.mkdir(parents=True, exist_ok=True)
+    if home_dir not in _home_dirs:
+        home_dir.mkdir(parents=True, exist_ok=True)
+        _home_dirs.add(home_dir)
     return home_dir
 
 
-def get_cache_filepath(mode):
-    return get_home_dir() / f"token_{mode}.json"
+def get_cache_filepath(mode, cache_key=None):
+    """Get the default cache file of a mode, with a file for each cache key."""
+    if cache_key is None:
+        return get_home_dir() / f"token_{mode}.json"
+    return get_home_dir() / f"token_{mode}_{cache_key}.json"
+
+
+def get_refresh_token_filepath(cache_key):
+    return get_home_dir() / f"refresh_{cache_key}.json"
+
+
+def load_refresh_token(cache_key):
+    """Read the refresh token stored for a cache key, or None."""
+    try:
+        with open(get_refresh_token_filepath(cache_key), "r") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if isinstance(data, dict):
+        return data.get("refresh_token")
+
+
+def save_refresh_token(cache_key, refresh_token):
+    """Store the refresh token of a cache key, or delete it if None.
+
+    The refresh token is kept in its own file, readable only by the user,
+    and never in the token caches, which may be shared.
+    """
+    filepath = get_refresh_token_filepath(cache_key)
+    if not refresh_token:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(filepath)
+        return
+
+    if load_refresh_token(cache_key) != refresh_token:
+        # mkstemp creates the file with mode 0600
+        write_json_file(filepath, {"refresh_token": refresh_token})
+
+
+def get_cache_key(mode, client_id=None, org=None, api_base_url=None):
+    """Get the key that identifies a token in the cache."""
+    identity = json.dumps([mode, client_id, org, api_base_url])
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()[:32]
+
+
+def get_tenant_cache_filepath():
+    return get_home_dir() / "tenants.json"
+
+
+def load_tenant_cache(tenant_domain):
+    """Read the entry of a tenant from the tenants cache, or None."""
+    try:
+        tenants = _read_tenant_cache(get_tenant_cache_filepath())
+    except OSError:
+        return None
+
+    entry = tenants.get(tenant_domain)
+    if isinstance(entry, dict) and entry.get("api_base_url"):
+        return entry
+
+
+def save_tenant_cache(tenant_domain, entry):
+    """Store the entry of a tenant in the tenants cache.
+
+    The cache is optional: if it cannot be written, for example in a
+    read-only home directory, the entry is not stored.
+    """
+    try:
+        cache_filepath = get_tenant_cache_filepath()
+        with lock_cache_file(cache_filepath):
+            tenants = _read_tenant_cache(cache_filepath)
+            tenants[tenant_domain] = entry
+            write_json_file(cache_filepath, tenants)
+    except OSError:
+        pass
+
+
+def _read_tenant_cache(cache_filepath):
+    try:
+        with open(cache_filepath, "r") as f:
+            tenants = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return tenants if isinstance(tenants, dict) else {}
 
 
 def load_cache_file(cache_filepath):
-    if cache_filepath and os.path.exists(cache_filepath):
+    """Read the cache file.
+
+    The content is kept in memory and the file is only read again
+    when it is modified.
+    """
+    if not cache_filepath:
+        return None
+
+    signature = get_file_signature(cache_filepath)
+    if signature is None:
+        return None
+
+    cached = _cache_files.get(str(cache_filepath))
+    if cached is not None and cached[0] == signature:
+        data = cached[1]
+    else:
         with open(cache_filepath, "r") as f:
-            data = json.load(f)
-            if (
-                "api_base_url" in data
-                and "access_token" in data
-                and "expiration" in data
-            ):
-                return data
+            try:
+                data = json.load(f)
+            except ValueError:
+                data = None
+        _cache_files[str(cache_filepath)] = (signature, data)
+
+    if (
+        isinstance(data, dict)
+        and "api_base_url" in data
+        and "access_token" in data
+        and "expiration" in data
+    ):
+        return dict(data)
 
 
 def save_cache_file(cache_filepath, data):
-    with open(cache_filepath, "w") as f:
-        if "api_base_url" in data and "access_token" in data and "expiration" in data:
-            json.dump(data, f)
+    """Write the cache file atomically.
+
+    The data is written in a temporary file that replaces the cache file,
+    so readers never see a partially written file. The file is not written
+    if it already contains the same data.
+    """
+    if "api_base_url" in data and "access_token" in data and "expiration" in data:
+        cached = _cache_files.get(str(cache_filepath))
+        if (
+            cached is not None
+            and cached[1] == data
+            and cached[0] == get_file_signature(cache_filepath)
+        ):
+            return
+        write_json_file(cache_filepath, data)
+        _cache_files[str(cache_filepath)] = (
+            get_file_signature(cache_filepath),
+            dict(data),
+        )
+
+
+def get_file_signature(filepath):
+    """Get the modification time, inode and size of a file, or None if missing."""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+
+def write_json_file(filepath, data):
+    dirname = os.path.dirname(os.path.abspath(filepath))
+    import tempfile
+
+    fd, tmp_filepath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
+
+
+@contextlib.contextmanager
+def lock_cache_file(cache_filepath):
+    """Hold an exclusive advisory lock for the cache file.
+
+    The lock is taken on a sibling ".lock" file, because the cache file
+    is replaced on every write. It is a no-op where fcntl is not available.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(f"{cache_filepath}.lock", "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 
 def is_token_expired(expiration):
     if not expiration:
         return True
 
-    now = datetime.utcnow().timestamp()
+    return time.time() > expiration
+
+
+def get_token_ttl(expiration):
+    """Seconds left until the token expiration (negative if already expired)."""
+    if not expiration:
+        return 0
 
-    return now > expiration
+    return expiration - time.time()
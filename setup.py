@@ -19,7 +19,11 @@ setup(
     packages=find_packages(exclude=["examples", "tests"]),
     python_requires=">=3.7",
     install_requires=["requests", "pyyaml"],
-    extras_require={"carto-dw": ["google-auth", "google-cloud-bigquery>=2.34.4"]},
+    extras_require={
+        "carto-dw": ["google-auth", "google-cloud-bigquery>=2.34.4"],
+        "async": ["httpx"],
+        "jwt": ["cryptography"],
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
@@ -30,5 +34,8 @@ setup(
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
     ],
+    entry_points={
+        "console_scripts": ["carto-auth-broker = carto_auth.broker:main"],
+    },
     zip_safe=False,
 )
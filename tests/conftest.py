@@ -0,0 +1,39 @@
+import time
+import pytest
+
+from carto_auth import CartoAuth
+
+
+@pytest.fixture(autouse=True)
+def home_dir(tmp_path, monkeypatch):
+    """Use a temporary home directory for the cache files."""
+    home_dir = tmp_path / "home"
+    home_dir.mkdir()
+    monkeypatch.setenv("HOME", str(home_dir))
+    return home_dir
+
+
+@pytest.fixture
+def new_carto_auth():
+    """Create m2m CartoAuth objects with test credentials and without cache."""
+
+    def new_carto_auth(**kwargs):
+        kwargs = {
+            "api_base_url": "https://gcp-us-east1.api.carto.com",
+            "client_id": "1234",
+            "client_secret": "1234567890",
+            "use_cache": False,
+            **kwargs,
+        }
+        return CartoAuth("m2m", **kwargs)
+
+    return new_carto_auth
+
+
+@pytest.fixture
+def get_m2m(mocker):
+    """Mock the m2m token requests, which return token-1."""
+    return mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": int(time.time() + 3600)},
+    )
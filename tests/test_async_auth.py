@@ -0,0 +1,196 @@
+import json
+import time
+import httpx
+import pytest
+import asyncio
+import pathlib
+
+from carto_auth import AsyncCartoAuth, CredentialsError
+from carto_auth.utils import get_cache_key, load_cache_file, save_cache_file
+
+HERE = pathlib.Path(__file__).parent
+
+
+def mock_client(routes, calls=None):
+    def handler(request):
+        if calls is not None:
+            calls.append(request.url.path)
+        return routes[request.url.path](request)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def token_response(request):
+    return httpx.Response(
+        200,
+        json={
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            "expires_in": 86400,
+            "token_type": "Bearer",
+        },
+    )
+
+
+def test_from_m2m__not_use_cache():
+    async def main():
+        client = mock_client({"/oauth/token": token_response})
+        filepath = HERE / "fixtures/carto_credentials_ok.json"
+        async with await AsyncCartoAuth.from_m2m(
+            filepath, use_cache=False, client=client
+        ) as carto_auth:
+            assert await carto_auth.get_api_base_url() == (
+                "https://gcp-us-east1.api.carto.com"
+            )
+            assert await carto_auth.get_access_token() == (
+                "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+            )
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_from_m2m__use_cache(tmp_path):
+    cache_filepath = tmp_path / "token_m2m.json"
+    expiration = int(time.time() + 10)
+    save_cache_file(
+        cache_filepath,
+        {
+            "api_base_url": "https://gcp-us-east1.api.carto.com",
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY",
+            "expiration": expiration,
+            "key": get_cache_key(
+                "m2m", "1234", api_base_url="https://gcp-us-east1.api.carto.com"
+            ),
+        },
+    )
+
+    async def main():
+        calls = []
+        client = mock_client({"/oauth/token": token_response}, calls)
+        filepath = HERE / "fixtures/carto_credentials_ok.json"
+        carto_auth = await AsyncCartoAuth.from_m2m(
+            filepath, cache_filepath=cache_filepath, client=client
+        )
+        assert await carto_auth.get_access_token() == (
+            "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY"
+        )
+        assert calls == []
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_get_access_token_expired_single_flight(tmp_path):
+    cache_filepath = tmp_path / "token_m2m.json"
+    expiration = int(time.time() - 10)
+
+    async def main():
+        calls = []
+        client = mock_client({"/oauth/token": token_response}, calls)
+        carto_auth = AsyncCartoAuth(
+            "m2m",
+            api_base_url="https://gcp-us-east1.api.carto.com",
+            access_token="eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY",
+            expiration=expiration,
+            client_id="1234",
+            client_secret="1234567890",
+            cache_filepath=cache_filepath,
+            client=client,
+        )
+        tokens = await asyncio.gather(
+            *(carto_auth.get_access_token() for _ in range(8))
+        )
+        assert tokens == ["eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"] * 8
+        assert calls == ["/oauth/token"]
+        await client.aclose()
+
+    asyncio.run(main())
+
+    data = load_cache_file(cache_filepath)
+    assert data["access_token"] == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+
+
+def test_from_oauth(mocker, tmp_path):
+    expiration = int(time.time() + 10)
+    get_oauth = mocker.patch(
+        "carto_auth.async_auth.get_oauth_token_info",
+        return_value={
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            "expiration": expiration,
+        },
+    )
+    routes = {
+        "/accounts": lambda request: httpx.Response(
+            200, json={"tenant_domain": "clausa.app.carto.com"}
+        ),
+        "/config.yaml": lambda request: httpx.Response(
+            200, text='apis:\n  baseUrl: "https://gcp-us-east1.api.carto.com"\n'
+        ),
+    }
+
+    async def main():
+        client = mock_client(routes)
+        carto_auth = await AsyncCartoAuth.from_oauth(
+            cache_filepath=tmp_path / "token_oauth.json",
+            open_browser=False,
+            client=client,
+        )
+        assert await carto_auth.get_api_base_url() == (
+            "https://gcp-us-east1.api.carto.com"
+        )
+        await client.aclose()
+
+    asyncio.run(main())
+    get_oauth.assert_called_once()
+
+
+def test_carto_dw_credentials():
+    expiration = int(time.time() + 3600)
+    routes = {
+        "/v3/connections/carto-dw/token": lambda request: httpx.Response(
+            200, json={"projectId": "project-id-mock", "token": "token-mock"}
+        ),
+    }
+
+    async def main():
+        calls = []
+        client = mock_client(routes, calls)
+        carto_auth = AsyncCartoAuth(
+            "oauth",
+            api_base_url="https://gcp-us-east1.api.carto.com",
+            access_token="eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            expiration=expiration,
+            client=client,
+        )
+        credentials = await asyncio.gather(
+            *(carto_auth.get_carto_dw_credentials() for _ in range(4))
+        )
+        assert credentials == [("project-id-mock", "token-mock")] * 4
+        assert len(calls) == 1
+        await client.aclose()
+
+    asyncio.run(main())
+
+
+def test_carto_dw_credentials_error():
+    expiration = int(time.time() + 3600)
+    routes = {
+        "/v3/connections/carto-dw/token": lambda request: httpx.Response(
+            200, text=json.dumps({"token": "token-mock"})
+        ),
+    }
+
+    async def main():
+        client = mock_client(routes)
+        carto_auth = AsyncCartoAuth(
+            "oauth",
+            api_base_url="https://gcp-us-east1.api.carto.com",
+            access_token="eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            expiration=expiration,
+            client=client,
+        )
+        with pytest.raises(CredentialsError):
+            await carto_auth.get_carto_dw_credentials()
+        await client.aclose()
+
+    asyncio.run(main())
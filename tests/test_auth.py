@@ -1,15 +1,23 @@
 import pytest
+import time
 import pathlib
 
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from carto_auth import CartoAuth, CredentialsError
+from carto_auth import CartoAuth, CredentialsError, Metrics
+from carto_auth.cache import FileTokenCache
+from carto_auth.utils import (
+    get_cache_key,
+    load_refresh_token,
+    save_cache_file,
+    write_json_file,
+)
 
 HERE = pathlib.Path(__file__).parent
 
 
 def test_from_oauth__not_use_cache(mocker):
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     load_mock = mocker.patch("carto_auth.auth.load_cache_file")
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
     get_oauth = mocker.patch(
@@ -27,7 +35,9 @@ def test_from_oauth__not_use_cache(mocker):
     carto_auth = CartoAuth.from_oauth(open_browser=False, use_cache=False)
     assert carto_auth._mode == "oauth"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_oauth.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_oauth_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is False
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -37,16 +47,18 @@ def test_from_oauth__not_use_cache(mocker):
     save_mock.assert_not_called()
     get_oauth.assert_called_once()
     get_api_base_url.assert_called_once()
+    assert get_api_base_url.call_args.kwargs["use_cache"] is False
 
 
 def test_from_oauth__use_cache(mocker):
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     load_mock = mocker.patch(
         "carto_auth.auth.load_cache_file",
         return_value={
             "api_base_url": "https://gcp-us-east1.api.carto.com",
             "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
             "expiration": expiration,
+            "key": get_cache_key("oauth"),
         },
     )
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
@@ -56,7 +68,9 @@ def test_from_oauth__use_cache(mocker):
     carto_auth = CartoAuth.from_oauth(open_browser=False, use_cache=True)
     assert carto_auth._mode == "oauth"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_oauth.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_oauth_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is True
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -69,7 +83,7 @@ def test_from_oauth__use_cache(mocker):
 
 
 def test_from_oauth__use_cache_expired(mocker):
-    expiration = int((datetime.utcnow() - timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() - 10)
     load_mock = mocker.patch(
         "carto_auth.auth.load_cache_file",
         return_value={
@@ -79,7 +93,7 @@ def test_from_oauth__use_cache_expired(mocker):
         },
     )
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     get_oauth = mocker.patch(
         "carto_auth.auth.get_oauth_token_info",
         return_value={
@@ -95,7 +109,9 @@ def test_from_oauth__use_cache_expired(mocker):
     carto_auth = CartoAuth.from_oauth(open_browser=False, use_cache=True)
     assert carto_auth._mode == "oauth"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_oauth.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_oauth_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is True
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -108,13 +124,14 @@ def test_from_oauth__use_cache_expired(mocker):
 
 
 def test_from_oauth__org(mocker):
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     load_mock = mocker.patch(
         "carto_auth.auth.load_cache_file",
         return_value={
             "api_base_url": "https://gcp-us-east1.api.carto.com",
             "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
             "expiration": expiration,
+            "key": get_cache_key("oauth", org="org_1234"),
         },
     )
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
@@ -124,7 +141,9 @@ def test_from_oauth__org(mocker):
     carto_auth = CartoAuth.from_oauth(open_browser=False, org="org_1234")
     assert carto_auth._mode == "oauth"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_oauth.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_oauth_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is True
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -137,7 +156,7 @@ def test_from_oauth__org(mocker):
 
 
 def test_from_m2m__not_use_cache(mocker):
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     load_mock = mocker.patch("carto_auth.auth.load_cache_file")
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
     get_m2m = mocker.patch(
@@ -152,7 +171,9 @@ def test_from_m2m__not_use_cache(mocker):
     carto_auth = CartoAuth.from_m2m(filepath, use_cache=False)
     assert carto_auth._mode == "m2m"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_m2m.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_m2m_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is False
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -164,13 +185,16 @@ def test_from_m2m__not_use_cache(mocker):
 
 
 def test_from_m2m__use_cache(mocker):
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     load_mock = mocker.patch(
         "carto_auth.auth.load_cache_file",
         return_value={
             "api_base_url": "https://gcp-us-east1.api.carto.com",
             "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
             "expiration": expiration,
+            "key": get_cache_key(
+                "m2m", "1234", api_base_url="https://gcp-us-east1.api.carto.com"
+            ),
         },
     )
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
@@ -180,7 +204,9 @@ def test_from_m2m__use_cache(mocker):
     carto_auth = CartoAuth.from_m2m(filepath, use_cache=True)
     assert carto_auth._mode == "m2m"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_m2m.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_m2m_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is True
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -192,7 +218,7 @@ def test_from_m2m__use_cache(mocker):
 
 
 def test_from_m2m__use_cache_expired(mocker):
-    expiration = int((datetime.utcnow() - timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() - 10)
     load_mock = mocker.patch(
         "carto_auth.auth.load_cache_file",
         return_value={
@@ -202,7 +228,7 @@ def test_from_m2m__use_cache_expired(mocker):
         },
     )
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     get_m2m = mocker.patch(
         "carto_auth.auth.get_m2m_token_info",
         return_value={
@@ -215,7 +241,9 @@ def test_from_m2m__use_cache_expired(mocker):
     carto_auth = CartoAuth.from_m2m(filepath, use_cache=True)
     assert carto_auth._mode == "m2m"
     assert carto_auth._api_base_url == "https://gcp-us-east1.api.carto.com"
-    assert str(carto_auth._cache_filepath).endswith(".carto-auth/token_m2m.json")
+    assert str(carto_auth._cache_filepath).endswith(
+        f".carto-auth/token_m2m_{carto_auth._cache_key}.json"
+    )
     assert carto_auth._use_cache is True
     assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
     assert carto_auth._expiration == expiration
@@ -226,6 +254,65 @@ def test_from_m2m__use_cache_expired(mocker):
     get_m2m.assert_called_once()
 
 
+def test_from_m2m__use_cache_previous_version(mocker):
+    # Cache file without key: its expiration may be shifted by the UTC offset
+    load_mock = mocker.patch(
+        "carto_auth.auth.load_cache_file",
+        return_value={
+            "api_base_url": "https://gcp-us-east1.api.carto.com",
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            "expiration": int(time.time() + 3600),
+        },
+    )
+    save_mock = mocker.patch("carto_auth.auth.save_cache_file")
+    expiration = int(time.time() + 10)
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY",
+            "expiration": expiration,
+        },
+    )
+
+    filepath = HERE / "fixtures/carto_credentials_ok.json"
+    carto_auth = CartoAuth.from_m2m(filepath, use_cache=True)
+    assert carto_auth._access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY"
+    assert carto_auth._expiration == expiration
+    load_mock.assert_called_once()
+    get_m2m.assert_called_once()
+    assert save_mock.call_args.args[1]["key"] == carto_auth._cache_key
+
+
+def test_from_m2m__default_cache_by_identity(mocker, tmp_path):
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        side_effect=lambda client_id, client_secret, **kwargs: {
+            "access_token": f"token-{client_id}",
+            "expiration": int(time.time() + 3600),
+        },
+    )
+    filepaths = []
+    for client_id in ("1", "2"):
+        filepath = tmp_path / f"carto_credentials_{client_id}.json"
+        write_json_file(
+            filepath,
+            {
+                "api_base_url": "https://gcp-us-east1.api.carto.com",
+                "client_id": client_id,
+                "client_secret": "1234567890",
+            },
+        )
+        filepaths.append(filepath)
+
+    carto_auths = [CartoAuth.from_m2m(filepath) for filepath in filepaths]
+    assert carto_auths[0]._cache_filepath != carto_auths[1]._cache_filepath
+
+    # Each identity reads its own token, not overwritten by the other one
+    carto_auths = [CartoAuth.from_m2m(filepath) for filepath in filepaths]
+    assert [c.get_access_token() for c in carto_auths] == ["token-1", "token-2"]
+    assert get_m2m.call_count == 2
+
+
 def test_from_m2m_error():
     filepath = HERE / "fixtures/carto_credentials_no_attr.json"
     with pytest.raises(AttributeError):
@@ -251,7 +338,7 @@ def test_get_access_token(mocker):
     save_mock = mocker.patch("carto_auth.auth.save_cache_file")
 
     access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     carto_auth = CartoAuth("oauth", access_token=access_token, expiration=expiration)
 
     access_token = carto_auth.get_access_token()
@@ -263,7 +350,7 @@ def test_get_access_token(mocker):
 
 
 def test_get_access_token_oauth_expired(mocker):
-    new_expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    new_expiration = int(time.time() + 10)
     get_oauth = mocker.patch(
         "carto_auth.auth.get_oauth_token_info",
         return_value={
@@ -273,7 +360,7 @@ def test_get_access_token_oauth_expired(mocker):
     )
 
     access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    expiration = int((datetime.utcnow() - timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() - 10)
     carto_auth = CartoAuth("oauth", access_token=access_token, expiration=expiration)
 
     access_token = carto_auth.get_access_token()
@@ -284,8 +371,42 @@ def test_get_access_token_oauth_expired(mocker):
     get_oauth.assert_called_once()
 
 
+def test_get_access_token_oauth_refresh_token(mocker, tmp_path):
+    new_expiration = int(time.time() + 10)
+    get_oauth = mocker.patch(
+        "carto_auth.auth.get_oauth_token_info",
+        return_value={
+            "access_token": "new-token",
+            "expiration": new_expiration,
+            "refresh_token": "rt-2",
+        },
+    )
+
+    expiration = int(time.time() - 10)
+    carto_auth = CartoAuth(
+        "oauth",
+        api_base_url="https://gcp-us-east1.api.carto.com",
+        access_token="old-token",
+        expiration=expiration,
+        refresh_token="rt-1",
+        cache_filepath=tmp_path / "token.json",
+    )
+
+    assert carto_auth.get_access_token() == "new-token"
+    assert get_oauth.call_args.kwargs["refresh_token"] == "rt-1"
+    assert carto_auth._refresh_token == "rt-2"
+    # The rotated refresh token is stored apart from the token cache
+    assert load_refresh_token(carto_auth._cache_key) == "rt-2"
+    assert "rt-2" not in carto_auth._cache_filepath.read_text()
+
+    carto_auth._expiration = expiration
+    carto_auth._refresh_token = None
+    carto_auth.get_access_token()
+    assert get_oauth.call_args.kwargs["refresh_token"] == "rt-2"
+
+
 def test_get_access_token_m2m_expired(mocker):
-    new_expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    new_expiration = int(time.time() + 10)
     get_m2m = mocker.patch(
         "carto_auth.auth.get_m2m_token_info",
         return_value={
@@ -295,7 +416,7 @@ def test_get_access_token_m2m_expired(mocker):
     )
 
     access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    expiration = int((datetime.utcnow() - timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() - 10)
     carto_auth = CartoAuth("m2m", access_token=access_token, expiration=expiration)
 
     access_token = carto_auth.get_access_token()
@@ -321,7 +442,7 @@ def test_carto_dw_credentials(mocker, requests_mock):
 
     api_base_url = "https://gcp-us-east1.api.carto.com"
     access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     carto_auth = CartoAuth(
         "oauth",
         api_base_url=api_base_url,
@@ -347,7 +468,7 @@ def test_carto_dw_credentials_error(mocker, requests_mock):
 
     api_base_url = "https://gcp-us-east1.api.carto.com"
     access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     carto_auth = CartoAuth(
         "oauth",
         api_base_url=api_base_url,
@@ -383,13 +504,17 @@ def test_carto_dw_client(mocker):
     from google.cloud.bigquery import Client
 
     get_creds = mocker.patch(
-        "carto_auth.auth.CartoAuth.get_carto_dw_credentials",
-        return_value=("project-id-mock", "token-mock"),
+        "carto_auth.auth.CartoAuth._get_carto_dw_credentials",
+        return_value={
+            "project_id": "project-id-mock",
+            "token": "token-mock",
+            "expiration": int(time.time()) + 3600,
+        },
     )
 
     api_base_url = "https://gcp-us-east1.api.carto.com"
     access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    expiration = int((datetime.utcnow() + timedelta(seconds=10)).timestamp())
+    expiration = int(time.time() + 10)
     carto_auth = CartoAuth(
         "oauth",
         api_base_url=api_base_url,
@@ -400,4 +525,399 @@ def test_carto_dw_client(mocker):
     bq_client = carto_auth.get_carto_dw_client()
     assert isinstance(bq_client, Client)
     assert bq_client.project == "project-id-mock"
+    assert carto_auth.get_carto_dw_client() is bq_client
     get_creds.assert_called_once()
+
+
+def test_carto_dw_client_refresh(mocker, requests_mock):
+    requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        [
+            {"json": {"projectId": "project-id-mock", "token": "token-mock"}},
+            {"json": {"projectId": "project-id-mock", "token": "token-mock-2"}},
+        ],
+    )
+
+    api_base_url = "https://gcp-us-east1.api.carto.com"
+    access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    expiration = int(time.time() + 3600)
+    carto_auth = CartoAuth(
+        "oauth",
+        api_base_url=api_base_url,
+        access_token=access_token,
+        expiration=expiration,
+    )
+
+    bq_client = carto_auth.get_carto_dw_client()
+    credentials = bq_client._credentials
+    assert credentials.token == "token-mock"
+    assert not credentials.expired
+
+    # DW token about to expire
+    carto_auth._carto_dw_credentials["expiration"] = int(time.time()) + 60
+    credentials.refresh(None)
+    assert credentials.token == "token-mock-2"
+    assert not credentials.expired
+
+
+def test_background_refresh(mocker):
+    new_expiration = int(time.time() + 3600)
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY",
+            "expiration": new_expiration,
+        },
+    )
+
+    access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    expiration = int(time.time() + 60)
+    carto_auth = CartoAuth(
+        "m2m",
+        access_token=access_token,
+        expiration=expiration,
+        refresh_skew=120,
+        background_refresh=True,
+    )
+
+    try:
+        assert carto_auth.is_background_refresh_running()
+        for _ in range(100):
+            if get_m2m.called:
+                break
+            time.sleep(0.01)
+    finally:
+        carto_auth.stop_background_refresh(timeout=1)
+
+    assert not carto_auth.is_background_refresh_running()
+    get_m2m.assert_called_once()
+    assert carto_auth.get_access_token() == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY"
+    assert carto_auth._expiration == new_expiration
+
+
+def test_background_refresh_oauth_error():
+    carto_auth = CartoAuth("oauth")
+    with pytest.raises(CredentialsError):
+        carto_auth.start_background_refresh()
+
+
+def test_get_access_token_single_flight(mocker):
+    new_expiration = int(time.time() + 3600)
+
+    def get_token_info(*args, **kwargs):
+        time.sleep(0.1)
+        return {
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY",
+            "expiration": new_expiration,
+        }
+
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info", side_effect=get_token_info
+    )
+
+    access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    expiration = int(time.time() - 10)
+    carto_auth = CartoAuth("m2m", access_token=access_token, expiration=expiration)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tokens = list(executor.map(lambda _: carto_auth.get_access_token(), range(8)))
+
+    assert tokens == ["eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY"] * 8
+    get_m2m.assert_called_once()
+
+
+def test_get_access_token_refresh_timeout(mocker):
+    access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    expiration = int(time.time() - 10)
+    carto_auth = CartoAuth(
+        "m2m", access_token=access_token, expiration=expiration, refresh_timeout=0.01
+    )
+
+    carto_auth._refresh_lock.acquire()
+    try:
+        with pytest.raises(CredentialsError):
+            carto_auth.get_access_token()
+    finally:
+        carto_auth._refresh_lock.release()
+
+
+def test_get_access_token_shared_cache(mocker, tmp_path):
+    get_m2m = mocker.patch("carto_auth.auth.get_m2m_token_info")
+
+    cache_filepath = tmp_path / "token_m2m.json"
+    access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    expiration = int(time.time() - 10)
+    carto_auth = CartoAuth(
+        "m2m",
+        api_base_url="https://gcp-us-east1.api.carto.com",
+        access_token=access_token,
+        expiration=expiration,
+        cache_filepath=cache_filepath,
+        shared_cache=True,
+    )
+
+    # Token renewed by another process
+    new_expiration = int(time.time() + 3600)
+    save_cache_file(
+        cache_filepath,
+        {
+            "api_base_url": "https://gcp-us-east1.api.carto.com",
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY",
+            "expiration": new_expiration,
+            "key": get_cache_key(
+                "m2m", api_base_url="https://gcp-us-east1.api.carto.com"
+            ),
+        },
+    )
+
+    assert carto_auth.get_access_token() == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY"
+    assert carto_auth._expiration == new_expiration
+    get_m2m.assert_not_called()
+
+
+def test_carto_dw_credentials_cached(mocker, requests_mock):
+    dw_mock = requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        json={
+            "projectId": "project-id-mock",
+            "token": "token-mock",
+        },
+    )
+
+    api_base_url = "https://gcp-us-east1.api.carto.com"
+    access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    expiration = int(time.time() + 3600)
+    carto_auth = CartoAuth(
+        "oauth",
+        api_base_url=api_base_url,
+        access_token=access_token,
+        expiration=expiration,
+    )
+
+    for _ in range(3):
+        assert carto_auth.get_carto_dw_credentials() == (
+            "project-id-mock",
+            "token-mock",
+        )
+    assert dw_mock.call_count == 1
+
+    # DW token expired
+    carto_auth._carto_dw_credentials["expiration"] = int(time.time()) - 1
+    carto_auth.get_carto_dw_credentials()
+    assert dw_mock.call_count == 2
+
+    # Access token changed
+    carto_auth._access_token = "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpY"
+    carto_auth.get_carto_dw_credentials()
+    assert dw_mock.call_count == 3
+
+
+def test_carto_dw_credentials_cache_file(mocker, requests_mock, tmp_path):
+    dw_mock = requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        json={
+            "projectId": "project-id-mock",
+            "token": "token-mock",
+        },
+    )
+    expiration = int(time.time() + 3600)
+    mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            "expiration": expiration,
+        },
+    )
+
+    filepath = HERE / "fixtures/carto_credentials_ok.json"
+    cache_filepath = tmp_path / "token_m2m.json"
+    carto_auth = CartoAuth.from_m2m(
+        filepath, cache_filepath=cache_filepath, cache_carto_dw=True
+    )
+    carto_auth.get_carto_dw_credentials()
+
+    carto_auth = CartoAuth.from_m2m(
+        filepath, cache_filepath=cache_filepath, cache_carto_dw=True
+    )
+    assert carto_auth.get_carto_dw_credentials() == ("project-id-mock", "token-mock")
+    assert dw_mock.call_count == 1
+
+
+def test_from_oauth__other_org_cache(mocker, tmp_path):
+    cache_filepath = tmp_path / "token_oauth.json"
+    expiration = int(time.time() + 3600)
+    mocker.patch(
+        "carto_auth.auth.get_oauth_token_info",
+        side_effect=[
+            {"access_token": "token-org-1", "expiration": expiration},
+            {"access_token": "token-org-2", "expiration": expiration},
+        ],
+    )
+    mocker.patch(
+        "carto_auth.auth.get_api_base_url",
+        return_value="https://gcp-us-east1.api.carto.com",
+    )
+
+    carto_auth = CartoAuth.from_oauth(cache_filepath=cache_filepath, org="org_1")
+    assert carto_auth.get_access_token() == "token-org-1"
+
+    carto_auth = CartoAuth.from_oauth(cache_filepath=cache_filepath, org="org_2")
+    assert carto_auth.get_access_token() == "token-org-2"
+
+
+def test_from_m2m__token_cache(mocker, tmp_path):
+    expiration = int(time.time() + 3600)
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        side_effect=[
+            {"access_token": "token-1", "expiration": expiration},
+            {"access_token": "token-2", "expiration": expiration},
+        ],
+    )
+    credentials_1 = tmp_path / "carto_credentials_1.json"
+    credentials_1.write_text(
+        '{"api_base_url": "https://gcp-us-east1.api.carto.com", '
+        '"client_id": "1", "client_secret": "secret-1"}'
+    )
+    credentials_2 = tmp_path / "carto_credentials_2.json"
+    credentials_2.write_text(
+        '{"api_base_url": "https://gcp-us-east1.api.carto.com", '
+        '"client_id": "2", "client_secret": "secret-2"}'
+    )
+    token_cache = FileTokenCache(tmp_path / "tokens.json")
+
+    for _ in range(2):
+        carto_auth_1 = CartoAuth.from_m2m(credentials_1, token_cache=token_cache)
+        carto_auth_2 = CartoAuth.from_m2m(credentials_2, token_cache=token_cache)
+        assert carto_auth_1.get_access_token() == "token-1"
+        assert carto_auth_2.get_access_token() == "token-2"
+
+    assert get_m2m.call_count == 2
+
+
+def test_stats(mocker, tmp_path):
+    expiration = int(time.time() + 3600)
+    mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    metrics = Metrics()
+    credentials = HERE / "fixtures/carto_credentials_ok.json"
+    cache_filepath = tmp_path / "token.json"
+
+    carto_auth = CartoAuth.from_m2m(
+        credentials, cache_filepath=cache_filepath, metrics=metrics
+    )
+    carto_auth.get_access_token()
+    carto_auth = CartoAuth.from_m2m(
+        credentials, cache_filepath=cache_filepath, metrics=metrics
+    )
+    carto_auth.get_access_token()
+
+    stats = carto_auth.stats()
+    assert stats["cache_requests_total"] == [
+        {"labels": {"layer": "file", "result": "hit"}, "value": 1},
+        {"labels": {"layer": "file", "result": "miss"}, "value": 1},
+        {"labels": {"layer": "memory", "result": "hit"}, "value": 2},
+    ]
+    assert stats["token_refreshes_total"] == [{"labels": {"mode": "m2m"}, "value": 1}]
+    assert stats["token_refresh_duration_seconds"][0]["count"] == 1
+    assert stats["token_ttl_at_use_seconds"][0]["count"] == 2
+
+
+def test_stats_refresh_error(mocker):
+    mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        side_effect=CredentialsError("Invalid credentials"),
+    )
+    metrics = Metrics()
+    carto_auth = CartoAuth(
+        "m2m", client_id="1234", client_secret="1234567890", metrics=metrics
+    )
+
+    with pytest.raises(CredentialsError):
+        carto_auth.get_access_token()
+
+    assert metrics.stats()["token_refresh_errors_total"] == [
+        {"labels": {"mode": "m2m"}, "value": 1}
+    ]
+
+
+def test_from_m2m__cache_not_rewritten(mocker, tmp_path):
+    expiration = int(time.time() + 3600)
+    mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    write_mock = mocker.patch("carto_auth.utils.write_json_file", wraps=write_json_file)
+    credentials = HERE / "fixtures/carto_credentials_ok.json"
+    cache_filepath = tmp_path / "token.json"
+
+    for _ in range(3):
+        carto_auth = CartoAuth.from_m2m(credentials, cache_filepath=cache_filepath)
+        assert carto_auth.get_access_token() == "token-1"
+
+    write_mock.assert_called_once()
+
+
+def test_from_m2m__token_cache_not_rewritten(mocker, tmp_path):
+    expiration = int(time.time() + 3600)
+    mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    token_cache = FileTokenCache(tmp_path / "tokens.json")
+    set_mock = mocker.spy(token_cache, "set")
+    credentials = HERE / "fixtures/carto_credentials_ok.json"
+
+    for _ in range(3):
+        CartoAuth.from_m2m(credentials, token_cache=token_cache)
+
+    set_mock.assert_called_once()
+
+
+def test_prewarm(mocker, requests_mock):
+    expiration = int(time.time() + 3600)
+    get_oauth = mocker.patch(
+        "carto_auth.auth.get_oauth_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    get_api_base_url = mocker.patch(
+        "carto_auth.auth.get_api_base_url",
+        return_value="https://gcp-us-east1.api.carto.com",
+    )
+    carto_dw_mock = requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        json={"projectId": "project-id-mock", "token": "token-mock"},
+    )
+    carto_auth = CartoAuth("oauth", open_browser=False)
+
+    carto_auth.prewarm()
+
+    assert carto_auth.get_api_base_url() == "https://gcp-us-east1.api.carto.com"
+    assert carto_auth.get_access_token() == "token-1"
+    assert carto_auth.get_carto_dw_credentials() == ("project-id-mock", "token-mock")
+    get_oauth.assert_called_once()
+    get_api_base_url.assert_called_once()
+    assert carto_dw_mock.call_count == 1
+
+
+def test_prewarm_background(mocker, requests_mock):
+    expiration = int(time.time() + 3600)
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    carto_dw_mock = requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        json={"projectId": "project-id-mock", "token": "token-mock"},
+    )
+
+    carto_auth = CartoAuth.from_m2m(
+        HERE / "fixtures/carto_credentials_ok.json", use_cache=False, prewarm=True
+    )
+    carto_auth._prewarm_future.result(timeout=5)
+
+    assert carto_auth.get_carto_dw_credentials() == ("project-id-mock", "token-mock")
+    get_m2m.assert_called_once()
+    assert carto_dw_mock.call_count == 1
@@ -0,0 +1,153 @@
+import os
+import stat
+import time
+import socket
+import pytest
+import tempfile
+
+from carto_auth import CartoAuth, CredentialsError
+from carto_auth.broker import TokenBroker
+
+CREDENTIALS = (
+    '{"api_base_url": "https://gcp-us-east1.api.carto.com",'
+    ' "client_id": "1234", "client_secret": "1234567890"}'
+)
+
+
+@pytest.fixture
+def socket_path():
+    # Unix socket paths are limited to about 100 characters
+    with tempfile.TemporaryDirectory(dir="/tmp") as dirname:
+        yield f"{dirname}/broker.sock"
+
+
+@pytest.fixture
+def credentials_filepath(tmp_path):
+    filepath = tmp_path / "carto_credentials.json"
+    filepath.write_text(CREDENTIALS)
+    return filepath
+
+
+@pytest.fixture
+def broker(socket_path, tmp_path):
+    broker = TokenBroker(socket_path, cache_filepath=tmp_path / "token.json")
+    broker.start()
+    yield broker
+    broker.stop()
+
+
+def test_from_broker(broker, credentials_filepath, get_m2m):
+    carto_auths = [
+        CartoAuth.from_broker(credentials_filepath, socket_path=broker.socket_path)
+        for _ in range(3)
+    ]
+
+    for carto_auth in carto_auths:
+        assert carto_auth.get_access_token() == "token-1"
+        assert carto_auth.get_api_base_url() == "https://gcp-us-east1.api.carto.com"
+        assert carto_auth._use_cache is False
+
+    # One token for all the clients, renewed in the background by the broker
+    get_m2m.assert_called_once()
+    assert broker.get_carto_auth(
+        {"filepath": str(credentials_filepath)}
+    ).is_background_refresh_running()
+
+
+def test_from_broker_expired_token(broker, credentials_filepath, get_m2m):
+    carto_auth = CartoAuth.from_broker(
+        credentials_filepath, socket_path=broker.socket_path
+    )
+    carto_auth._expiration = int(time.time() - 10)
+    get_m2m.return_value = {
+        "access_token": "token-2",
+        "expiration": int(time.time() + 3600),
+    }
+    broker.get_carto_auth({"filepath": str(credentials_filepath)})._expiration = 0
+
+    assert carto_auth.get_access_token() == "token-2"
+    assert get_m2m.call_count == 2
+
+
+def test_from_broker_stale_token(broker, credentials_filepath, get_m2m):
+    carto_auth = CartoAuth.from_broker(
+        credentials_filepath, socket_path=broker.socket_path
+    )
+    other = CartoAuth.from_broker(credentials_filepath, socket_path=broker.socket_path)
+    get_m2m.return_value = {
+        "access_token": "token-2",
+        "expiration": int(time.time() + 3600),
+    }
+
+    # Rejected with a 401 response before it expired
+    assert carto_auth._refresh_access_token("token-1") == "token-2"
+    assert get_m2m.call_count == 2
+
+    # Already renewed by the broker for another client
+    assert other._refresh_access_token("token-1") == "token-2"
+    assert get_m2m.call_count == 2
+
+
+def test_from_broker_carto_dw_credentials(
+    broker, credentials_filepath, get_m2m, requests_mock
+):
+    carto_dw = requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        json={"projectId": "carto-dw-ac-1234", "token": "cdw-token"},
+    )
+    carto_auth = CartoAuth.from_broker(
+        credentials_filepath, socket_path=broker.socket_path
+    )
+
+    assert carto_auth.get_carto_dw_credentials() == ("carto-dw-ac-1234", "cdw-token")
+    assert carto_auth.get_carto_dw_credentials() == ("carto-dw-ac-1234", "cdw-token")
+    other = CartoAuth.from_broker(credentials_filepath, socket_path=broker.socket_path)
+    assert other.get_carto_dw_credentials() == ("carto-dw-ac-1234", "cdw-token")
+    assert carto_dw.call_count == 1
+
+
+def test_from_broker_errors(broker, tmp_path, get_m2m):
+    with pytest.raises(CredentialsError, match="FileNotFoundError"):
+        CartoAuth.from_broker(tmp_path / "missing.json", socket_path=broker.socket_path)
+
+    assert broker.handle({"op": "unknown"}) == {
+        "ok": False,
+        "error": "Unknown operation: unknown",
+        "retryable": False,
+        "status_code": None,
+    }
+    assert broker.handle({"op": "token", "identity": {"mode": "oauth"}})["ok"] is False
+
+
+def test_from_broker_not_available(socket_path, credentials_filepath):
+    with pytest.raises(CredentialsError, match="Broker not available") as error:
+        CartoAuth.from_broker(credentials_filepath, socket_path=socket_path)
+    assert error.value.retryable is True
+
+
+def test_broker_restart(socket_path, credentials_filepath, get_m2m, tmp_path):
+    broker = TokenBroker(socket_path, cache_filepath=tmp_path / "token.json").start()
+    carto_auth = CartoAuth.from_broker(credentials_filepath, socket_path=socket_path)
+    broker.stop()
+
+    broker = TokenBroker(socket_path, cache_filepath=tmp_path / "token.json").start()
+    try:
+        # The connection to the previous broker is replaced
+        assert carto_auth._broker.get_token_info()["access_token"] == "token-1"
+        assert len(broker._carto_auths) == 1
+    finally:
+        broker.stop()
+
+
+def test_broker_socket(broker, socket_path):
+    assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+    with pytest.raises(CredentialsError, match="already running"):
+        TokenBroker(socket_path).start()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(b'not json\n{"op": "ping"}\n')
+        reader = sock.makefile("rb")
+        assert b"Invalid request" in reader.readline()
+        assert b"pong" in reader.readline()
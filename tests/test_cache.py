@@ -0,0 +1,432 @@
+import os
+import time
+import pytest
+import threading
+import socketserver
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+
+from carto_auth import CartoAuth, CredentialsError
+from carto_auth.cache import (
+    TokenCache,
+    MemoryTokenCache,
+    FileTokenCache,
+    SQLiteTokenCache,
+    RedisTokenCache,
+)
+from carto_auth.utils import get_cache_key, write_json_file
+
+CREDENTIALS = """{
+    "api_base_url": "https://gcp-us-east1.api.carto.com",
+    "client_id": "1234",
+    "client_secret": "1234567890"
+}"""
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    """Minimal Redis server with the commands used by RedisTokenCache."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RedisHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        # Commands whose reply is lost after they are applied
+        self.drop_replies = set()
+
+    def execute(self, command, *args):
+        with self.lock:
+            now = time.monotonic()
+            self.data = {k: v for k, v in self.data.items() if v[1] > now}
+            if command in ("PING", "AUTH", "SELECT"):
+                return "+OK"
+            if command == "GET":
+                return self.data.get(args[0], (None,))[0]
+            if command == "DEL":
+                return self.data.pop(args[0], None) is not None
+            if command == "SET":
+                key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+                if "NX" in options and key in self.data:
+                    return None
+                expiry = float("inf")
+                if "EX" in options:
+                    expiry = now + int(options[options.index("EX") + 1])
+                if "PX" in options:
+                    expiry = now + int(options[options.index("PX") + 1]) / 1000
+                self.data[key] = (value, expiry)
+                return "+OK"
+            if command == "EVAL":
+                # Compare and delete script of RedisTokenCache
+                key, owner = args[2], args[3]
+                if self.data.get(key, (None,))[0] == owner:
+                    del self.data[key]
+                    return True
+                return False
+            return f"-ERR unknown command {command}"
+
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2].decode())
+            reply = self.server.execute(args[0].upper(), *args[1:])
+            if args[0].upper() in self.server.drop_replies:
+                self.server.drop_replies.discard(args[0].upper())
+                return
+            self.wfile.write(encode_reply(reply))
+
+
+def encode_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        return f":{int(reply)}\r\n".encode()
+    if reply.startswith(("+", "-")):
+        return f"{reply}\r\n".encode()
+    value = reply.encode()
+    return f"${len(value)}\r\n".encode() + value + b"\r\n"
+
+
+@pytest.fixture
+def redis_server():
+    server = RedisStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "file", "sqlite", "redis"])
+def token_cache(request, tmp_path):
+    if request.param == "memory":
+        return MemoryTokenCache()
+    if request.param == "file":
+        return FileTokenCache(tmp_path / "tokens.json")
+    if request.param == "sqlite":
+        return SQLiteTokenCache(tmp_path / "tokens.db")
+    server = request.getfixturevalue("redis_server")
+    return RedisTokenCache(*server.server_address)
+
+
+def token_data(access_token, seconds=3600):
+    expiration = int(time.time() + seconds)
+    return {
+        "api_base_url": "https://gcp-us-east1.api.carto.com",
+        "access_token": access_token,
+        "expiration": expiration,
+    }
+
+
+def test_get_cache_key():
+    key = get_cache_key("m2m", "1234", None, "https://gcp-us-east1.api.carto.com")
+
+    assert key == get_cache_key(
+        "m2m", "1234", None, "https://gcp-us-east1.api.carto.com"
+    )
+    assert key != get_cache_key(
+        "m2m", "5678", None, "https://gcp-us-east1.api.carto.com"
+    )
+    assert get_cache_key("oauth", org="org_1") != get_cache_key("oauth", org="org_2")
+
+
+def test_file_token_cache(tmp_path):
+    token_cache = FileTokenCache(tmp_path / "tokens.json")
+    token_cache.set("key-1", token_data("token-1"))
+    token_cache.set("key-2", token_data("token-2"))
+
+    assert token_cache.get("key-1")["access_token"] == "token-1"
+    assert token_cache.get("key-2")["access_token"] == "token-2"
+    assert token_cache.get("key-3") is None
+
+    token_cache.delete("key-1")
+    assert token_cache.get("key-1") is None
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        [],
+        {"version": 1, "entries": []},
+        {"version": 1, "entries": {"key-1": "token-1", "key-2": []}},
+    ],
+)
+def test_file_token_cache_invalid_file(tmp_path, content):
+    filepath = tmp_path / "tokens.json"
+    write_json_file(filepath, content)
+    token_cache = FileTokenCache(filepath)
+
+    assert token_cache.get("key-1") is None
+    token_cache.set("key-1", token_data("token-1"))
+    assert FileTokenCache(filepath).get("key-1")["access_token"] == "token-1"
+
+
+def test_file_token_cache_shared_file(tmp_path):
+    token_cache_1 = FileTokenCache(tmp_path / "tokens.json")
+    token_cache_2 = FileTokenCache(tmp_path / "tokens.json")
+
+    token_cache_1.set("key-1", token_data("token-1"))
+    token_cache_2.set("key-2", token_data("token-2"))
+
+    assert token_cache_1.get("key-2")["access_token"] == "token-2"
+    assert token_cache_2.get("key-1")["access_token"] == "token-1"
+
+
+def test_file_token_cache_prune(tmp_path):
+    token_cache = FileTokenCache(tmp_path / "tokens.json", max_entries=2)
+    token_cache.set("expired", token_data("token-0", seconds=-10))
+    token_cache.set("key-1", token_data("token-1"))
+    token_cache.set("key-2", token_data("token-2"))
+    token_cache._entries["key-1"]["last_used"] += 10  # key-2 least recently used
+    token_cache.set("key-3", token_data("token-3"))
+
+    assert sorted(token_cache._entries) == ["key-1", "key-3"]
+
+    token_cache = FileTokenCache(tmp_path / "tokens.json")
+    assert token_cache.get("key-1")["access_token"] == "token-1"
+    assert token_cache.get("key-2") is None
+    assert token_cache.get("key-3")["access_token"] == "token-3"
+
+
+def test_token_cache(token_cache):
+    token_cache.set("key-1", token_data("token-1"))
+    token_cache.set("key-2", token_data("token-2"))
+    token_cache.set("expired", token_data("token-0", seconds=-10))
+
+    assert token_cache.get("key-1") == token_data("token-1")
+    assert token_cache.get("key-2")["access_token"] == "token-2"
+    assert token_cache.get("key-3") is None
+    assert token_cache.get("expired") is None
+
+    token_cache.set("key-1", token_data("token-1b"))
+    assert token_cache.get("key-1")["access_token"] == "token-1b"
+
+    token_cache.delete("key-1")
+    assert token_cache.get("key-1") is None
+
+
+def test_token_cache_lock(token_cache):
+    active = []
+    overlaps = []
+
+    def renew(i):
+        with token_cache.lock("key"):
+            overlaps.append(len(active))
+            active.append(i)
+            time.sleep(0.01)
+            token_cache.set("key", token_data(f"token-{i}"))
+            active.remove(i)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(renew, range(4)))
+
+    assert overlaps == [0, 0, 0, 0]
+    assert token_cache.get("key")["access_token"].startswith("token-")
+
+
+def test_token_cache_lock_by_key(token_cache):
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with token_cache.lock("key-1"):
+            acquired.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    acquired.wait(5)
+    try:
+        # The renewal of another key does not wait for the lock of key-1
+        start = time.monotonic()
+        with token_cache.lock("key-2"):
+            token_cache.set("key-2", token_data("token-2"))
+        assert time.monotonic() - start < 1
+    finally:
+        release.set()
+        thread.join()
+
+    assert token_cache.get("key-2")["access_token"] == "token-2"
+
+
+def test_sqlite_token_cache_lock_timeout(tmp_path):
+    filepath = tmp_path / "tokens.db"
+    # Locks of another process, never released
+    locks = [
+        SQLiteTokenCache(filepath, timeout=5).lock("key-1"),
+        SQLiteTokenCache(filepath, timeout=0.1).lock("key-2"),
+    ]
+    for lock in locks:
+        lock.__enter__()
+
+    token_cache = SQLiteTokenCache(filepath, timeout=0.2)
+    with pytest.raises(CredentialsError, match="Timeout"):
+        with token_cache.lock("key-1"):
+            pass
+
+    # The expired lock is taken over
+    time.sleep(0.1)
+    with token_cache.lock("key-2"):
+        pass
+
+
+def test_token_cache_shared_refresh(mocker, tmp_path, token_cache):
+    expiration = int(time.time() + 3600)
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    filepath = tmp_path / "carto_credentials.json"
+    filepath.write_text(CREDENTIALS)
+
+    def start_worker(_):
+        carto_auth = CartoAuth.from_m2m(
+            filepath, token_cache=token_cache, shared_cache=True
+        )
+        return carto_auth.get_access_token()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tokens = list(executor.map(start_worker, range(8)))
+
+    assert tokens == ["token-1"] * 8
+    get_m2m.assert_called_once()
+
+
+def test_sqlite_token_cache_wal(tmp_path):
+    token_cache = SQLiteTokenCache(tmp_path / "tokens.db")
+    token_cache.set("key-1", token_data("token-1"))
+
+    connection = token_cache._connect()
+    assert connection.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert SQLiteTokenCache(tmp_path / "tokens.db").get("key-1") == token_data(
+        "token-1"
+    )
+
+
+def set_token(args):
+    filepath, start, key = args
+    while time.time() < start:
+        pass
+    SQLiteTokenCache(filepath).set(key, token_data("token-1"))
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="requires fork"
+)
+def test_sqlite_token_cache_processes(tmp_path):
+    # Processes initializing the same new database at the same time
+    with multiprocessing.get_context("fork").Pool(8) as pool:
+        for i in range(10):
+            filepath = str(tmp_path / f"tokens-{i}.db")
+            start = time.time() + 0.1
+            pool.map(set_token, [(filepath, start, f"key-{j}") for j in range(8)])
+            connection = SQLiteTokenCache(filepath)._connect()
+            count = connection.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+            assert count == 8
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_sqlite_token_cache_fork(tmp_path):
+    token_cache = SQLiteTokenCache(tmp_path / "tokens.db")
+    connection = token_cache._connect()
+    token_cache.set("key-1", token_data("token-1"))
+
+    pid = os.fork()
+    if pid == 0:
+        # The connection of the parent is not used by the child
+        ok = token_cache._connect() is not connection and token_cache.get("key-1")
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+
+def test_token_cache_invalid_data(tmp_path, redis_server):
+    token_cache = SQLiteTokenCache(tmp_path / "tokens.db")
+    token_cache.set("key-1", token_data("token-1"))
+    token_cache._connect().execute("UPDATE tokens SET data = 'not json'")
+    assert token_cache.get("key-1") is None
+
+    token_cache = RedisTokenCache(*redis_server.server_address)
+    redis_server.data["carto-auth:token:key-1"] = ("not json", float("inf"))
+    assert token_cache.get("key-1") is None
+
+
+def test_redis_token_cache_lock_reply_lost(redis_server):
+    token_cache = RedisTokenCache(*redis_server.server_address, lock_timeout=5)
+    redis_server.drop_replies.add("SET")
+    start = time.monotonic()
+
+    # The lock set before the reply was lost is owned by this cache
+    with token_cache.lock("key-1"):
+        assert "carto-auth:lock:key-1" in redis_server.data
+
+    assert time.monotonic() - start < 1
+    assert "carto-auth:lock:key-1" not in redis_server.data
+
+
+def test_redis_token_cache_nodes(mocker, tmp_path, redis_server):
+    expiration = int(time.time() + 3600)
+    get_m2m = mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    filepath = tmp_path / "carto_credentials.json"
+    filepath.write_text(CREDENTIALS)
+    url = "redis://127.0.0.1:{}/0".format(redis_server.server_address[1])
+
+    # A cache by node, sharing the same Redis server
+    for _ in range(3):
+        token_cache = RedisTokenCache.from_url(url)
+        carto_auth = CartoAuth.from_m2m(
+            filepath, token_cache=token_cache, shared_cache=True
+        )
+        assert carto_auth.get_access_token() == "token-1"
+
+    get_m2m.assert_called_once()
+    ttl = redis_server.data[next(iter(redis_server.data))][1] - time.monotonic()
+    assert 3500 < ttl <= 3600
+
+
+def test_redis_token_cache_unavailable(redis_server):
+    token_cache = RedisTokenCache(*redis_server.server_address)
+    redis_server.shutdown()
+    redis_server.server_close()
+
+    token_cache.set("key-1", token_data("token-1"))
+    assert token_cache.get("key-1") is None
+    with token_cache.lock("key-1"):
+        pass
+
+
+def test_memory_token_cache_no_files(mocker, tmp_path, home_dir):
+    expiration = int(time.time() + 3600)
+    mocker.patch(
+        "carto_auth.auth.get_m2m_token_info",
+        return_value={"access_token": "token-1", "expiration": expiration},
+    )
+    filepath = tmp_path / "carto_credentials.json"
+    filepath.write_text(CREDENTIALS)
+
+    CartoAuth.from_m2m(filepath, token_cache=MemoryTokenCache())
+
+    assert list(home_dir.iterdir()) == []
+
+
+def test_token_cache_interface():
+    class IncompleteTokenCache(TokenCache):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        TokenCache()
+    with pytest.raises(TypeError):
+        IncompleteTokenCache()
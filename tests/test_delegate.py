@@ -0,0 +1,160 @@
+import time
+import socket
+import pickle
+import pytest
+import threading
+import multiprocessing
+
+from carto_auth import CredentialsError
+from carto_auth.delegate import (
+    ConnectionChannel,
+    DelegateServer,
+    TokenChannel,
+    _answer_challenge,
+    _deliver_challenge,
+)
+
+
+def get_token(handle):
+    return handle.get_access_token()
+
+
+def test_delegate(new_carto_auth, requests_mock):
+    expiration = int(time.time() + 3600)
+    carto_auth = new_carto_auth(
+        access_token="token-1",
+        expiration=expiration,
+        carto_dw_credentials={
+            "project_id": "carto-dw-ac-1234",
+            "token": "cdw-token",
+            "expiration": expiration,
+        },
+    )
+
+    data = pickle.dumps(carto_auth.delegate())
+    handle = pickle.loads(data)
+
+    assert b"1234567890" not in data
+    assert handle.get_access_token() == "token-1"
+    assert handle.get_api_base_url() == "https://gcp-us-east1.api.carto.com"
+    assert handle.get_carto_dw_credentials() == ("carto-dw-ac-1234", "cdw-token")
+    assert requests_mock.call_count == 0
+
+
+def test_delegate_expired_without_channel(new_carto_auth):
+    carto_auth = new_carto_auth(
+        access_token="token-1", expiration=int(time.time() + 3600)
+    )
+    handle = carto_auth.delegate()
+    handle.expiration = int(time.time() - 10)
+
+    with pytest.raises(CredentialsError, match="no channel"):
+        handle.get_access_token()
+
+
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="requires fork"
+)
+def test_delegate_server(new_carto_auth, get_m2m):
+    carto_auth = new_carto_auth()
+    with DelegateServer(carto_auth) as server:
+        handle = carto_auth.delegate(server.channel())
+        # The token of the handles expired before they were sent
+        handle.expiration = int(time.time() - 10)
+
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            tokens = pool.map(get_token, [handle] * 16)
+
+    assert tokens == ["token-1"] * 16
+    get_m2m.assert_called_once()
+
+
+def test_delegate_server_carto_dw_credentials(new_carto_auth, get_m2m, requests_mock):
+    carto_dw = requests_mock.get(
+        "https://gcp-us-east1.api.carto.com/v3/connections/carto-dw/token",
+        json={"projectId": "carto-dw-ac-1234", "token": "cdw-token"},
+    )
+    carto_auth = new_carto_auth()
+    with DelegateServer(carto_auth) as server:
+        handles = [
+            pickle.loads(pickle.dumps(carto_auth.delegate(server.channel())))
+            for _ in range(3)
+        ]
+        for handle in handles:
+            assert handle.get_carto_dw_credentials() == (
+                "carto-dw-ac-1234",
+                "cdw-token",
+            )
+
+    assert carto_dw.call_count == 1
+
+
+def test_delegate_server_authkey(new_carto_auth, get_m2m):
+    carto_auth = new_carto_auth()
+    with DelegateServer(carto_auth) as server:
+        assert server.channel().get_token_info()["access_token"] == "token-1"
+
+        channel = ConnectionChannel(server.address, b"wrong", timeout=1)
+        with pytest.raises(CredentialsError, match="rejected the authkey"):
+            channel.get_token_info()
+
+
+def close_in_thread(server):
+    thread = threading.Thread(target=server.close, daemon=True)
+    thread.start()
+    thread.join(5)
+    return not thread.is_alive()
+
+
+def test_delegate_server_close_after_rejected_authkey(new_carto_auth, get_m2m):
+    for _ in range(20):
+        server = DelegateServer(new_carto_auth())
+        channel = ConnectionChannel(server.address, b"wrong", timeout=1)
+        with pytest.raises(CredentialsError, match="rejected the authkey"):
+            channel.get_token_info()
+
+        assert close_in_thread(server)
+
+
+def test_delegate_server_silent_client(new_carto_auth, get_m2m):
+    server = DelegateServer(new_carto_auth())
+    # A client that connects and never sends the handshake
+    with socket.create_connection(server.address):
+        assert server.channel().get_token_info()["access_token"] == "token-1"
+        assert close_in_thread(server)
+
+
+def test_token_channel_interface():
+    class StaticChannel(TokenChannel):
+        def request(self, op, **params):
+            return {"op": op, **params}
+
+    with pytest.raises(TypeError):
+        TokenChannel()
+    assert StaticChannel().get_token_info("token-1") == {
+        "op": "token",
+        "stale_token": "token-1",
+    }
+
+
+@pytest.mark.parametrize("client_authkey", [b"secret", b"wrong"])
+def test_authkey_challenge(client_authkey):
+    server, client = multiprocessing.Pipe()
+    errors = []
+
+    def answer():
+        try:
+            _answer_challenge(client, client_authkey)
+        except multiprocessing.AuthenticationError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=answer)
+    thread.start()
+    if client_authkey == b"secret":
+        _deliver_challenge(server, b"secret")
+    else:
+        with pytest.raises(multiprocessing.AuthenticationError):
+            _deliver_challenge(server, b"secret")
+    thread.join(5)
+
+    assert bool(errors) == (client_authkey != b"secret")
@@ -0,0 +1,66 @@
+import sys
+import json
+import time
+import subprocess
+
+from carto_auth.utils import get_cache_key
+
+LAZY_MODULES = (
+    "requests",
+    "yaml",
+    "webbrowser",
+    "http.server",
+    "asyncio",
+    "httpx",
+    "carto_auth.pkce",
+)
+
+CHECK_SCRIPT = """
+import sys
+import carto_auth
+
+carto_auth = carto_auth.CartoAuth.from_m2m({filepath!r}, cache_filepath={cache!r})
+assert carto_auth.get_access_token() == "cached"
+print(",".join(m for m in {modules!r} if m in sys.modules))
+"""
+
+
+def test_cached_token_path_imports_lazily(tmp_path):
+    filepath = tmp_path / "carto_credentials.json"
+    filepath.write_text(
+        json.dumps(
+            {
+                "api_base_url": "https://api.carto.com",
+                "client_id": "1234",
+                "client_secret": "1234567890",
+            }
+        )
+    )
+    cache_filepath = tmp_path / "token.json"
+    cache_filepath.write_text(
+        json.dumps(
+            {
+                "api_base_url": "https://api.carto.com",
+                "access_token": "cached",
+                "expiration": int(time.time()) + 3600,
+                "key": get_cache_key(
+                    "m2m", "1234", api_base_url="https://api.carto.com"
+                ),
+            }
+        )
+    )
+
+    script = CHECK_SCRIPT.format(
+        filepath=str(filepath), cache=str(cache_filepath), modules=LAZY_MODULES
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == ""
+
+
+def test_async_auth_is_exported_lazily():
+    import carto_auth
+
+    assert carto_auth.AsyncCartoAuth.__name__ == "AsyncCartoAuth"
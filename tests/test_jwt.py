@@ -0,0 +1,189 @@
+import json
+import time
+import base64
+import pytest
+
+from carto_auth import CartoAuth
+from carto_auth.errors import CredentialsError
+from carto_auth.jwt import (
+    decode_jwt,
+    get_jwt_expiration,
+    get_jwt_tenant_domain,
+    get_jwks_cache_filepath,
+    verify_jwt,
+)
+from carto_auth.utils import get_api_base_url
+
+JWKS_URL = "https://auth.carto.com/.well-known/jwks.json"
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def encode_jwt(claims, header=None, sign=None):
+    header = header or {"alg": "RS256", "typ": "JWT", "kid": "key1"}
+    signing_input = ".".join(
+        b64encode(json.dumps(segment).encode("utf-8")) for segment in (header, claims)
+    )
+    signature = sign(signing_input.encode("ascii")) if sign else b"signature"
+    return f"{signing_input}.{b64encode(signature)}"
+
+
+@pytest.fixture
+def rsa_key():
+    pytest.importorskip("cryptography")
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    numbers = private_key.public_key().public_numbers()
+
+    def sign(data):
+        return private_key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+    jwk = {
+        "kty": "RSA",
+        "kid": "key1",
+        "n": b64encode(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, "big")),
+        "e": b64encode(numbers.e.to_bytes(3, "big")),
+    }
+    return sign, jwk
+
+
+def valid_claims(**extra):
+    return dict(
+        {
+            "iss": "https://auth.carto.com/",
+            "aud": ["carto-cloud-native-api", "https://carto-production.us.auth0.com"],
+            "exp": int(time.time() + 3600),
+        },
+        **extra,
+    )
+
+
+def test_decode_jwt():
+    token = encode_jwt({"exp": 1667471700, "tenant_domain": "clausa.app.carto.com"})
+
+    assert decode_jwt(token)["exp"] == 1667471700
+    assert get_jwt_expiration(token) == 1667471700
+    assert get_jwt_tenant_domain(token) == "clausa.app.carto.com"
+
+
+def test_decode_jwt_invalid():
+    assert decode_jwt("eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX") is None
+    assert decode_jwt("a.b.c") is None
+    assert decode_jwt(None) is None
+    assert get_jwt_expiration("a.b.c") is None
+    assert get_jwt_expiration(encode_jwt({"exp": "tomorrow"})) is None
+    assert get_jwt_tenant_domain(encode_jwt({"exp": 1667471700})) is None
+
+
+def test_get_api_base_url_from_claims(requests_mock):
+    accounts = requests_mock.get("https://accounts.app.carto.com/accounts")
+    requests_mock.get(
+        "https://clausa.app.carto.com/config.yaml",
+        text='apis:\n  baseUrl: "https://gcp-us-east1.api.carto.com"\n',
+    )
+    token = encode_jwt({"http://app.carto.com/tenant_domain": "clausa.app.carto.com"})
+
+    assert get_api_base_url(token) == "https://gcp-us-east1.api.carto.com"
+    assert accounts.called is False
+
+
+def test_carto_auth_expiration_from_claims(mocker):
+    get_m2m = mocker.patch("carto_auth.auth.get_m2m_token_info")
+    expiration = int(time.time() + 3600)
+    token = encode_jwt({"exp": expiration})
+
+    carto_auth = CartoAuth(
+        "m2m",
+        api_base_url="https://gcp-us-east1.api.carto.com",
+        access_token=token,
+        client_id="1234",
+        client_secret="1234567890",
+    )
+
+    assert carto_auth._expiration == expiration
+    assert carto_auth.get_access_token() == token
+    get_m2m.assert_not_called()
+
+
+def test_verify_jwt(requests_mock, rsa_key):
+    sign, jwk = rsa_key
+    jwks = requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+    token = encode_jwt(valid_claims(sub="user"), sign=sign)
+
+    assert verify_jwt(token)["sub"] == "user"
+    assert verify_jwt(token)["sub"] == "user"
+
+    # The keys are cached
+    assert jwks.call_count == 1
+    assert get_jwks_cache_filepath().exists()
+
+
+@pytest.mark.parametrize(
+    "claims,message",
+    [
+        (valid_claims(exp=int(time.time() - 60)), "expired"),
+        (valid_claims(aud="another-api"), "audience"),
+        (valid_claims(iss="https://example.com/"), "issuer"),
+    ],
+)
+def test_verify_jwt_invalid_claims(requests_mock, rsa_key, claims, message):
+    sign, jwk = rsa_key
+    requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+
+    with pytest.raises(CredentialsError, match=message):
+        verify_jwt(encode_jwt(claims, sign=sign))
+
+
+def test_verify_jwt_invalid_signature(requests_mock, rsa_key):
+    sign, jwk = rsa_key
+    requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+    token = encode_jwt(valid_claims(), sign=sign)
+    forged = encode_jwt(valid_claims(sub="admin"), sign=lambda data: b"x" * 256)
+
+    with pytest.raises(CredentialsError, match="signature"):
+        verify_jwt(forged)
+    with pytest.raises(CredentialsError, match="algorithm"):
+        verify_jwt(encode_jwt(valid_claims(), header={"alg": "none"}))
+    with pytest.raises(CredentialsError, match="Invalid JWT"):
+        verify_jwt("eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX")
+    assert verify_jwt(token)
+
+
+def test_verify_jwt_unknown_key(requests_mock, rsa_key):
+    sign, jwk = rsa_key
+    jwks = requests_mock.get(JWKS_URL, json={"keys": [dict(jwk, kid="old")]})
+    token = encode_jwt(valid_claims(), sign=sign)
+
+    with pytest.raises(CredentialsError, match="Unknown JWT key"):
+        verify_jwt(token)
+    # The keys were fetched recently, so they are not requested again
+    with pytest.raises(CredentialsError, match="Unknown JWT key"):
+        verify_jwt(token)
+    assert jwks.call_count == 1
+
+    # Key rotation after the minimum interval
+    cache = json.loads(get_jwks_cache_filepath().read_text())
+    cache["fetched_at"] -= 600
+    get_jwks_cache_filepath().write_text(json.dumps(cache))
+    jwks = requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+
+    assert verify_jwt(token)
+    assert jwks.call_count == 1
+
+
+def test_carto_auth_verify_token(requests_mock, rsa_key):
+    sign, jwk = rsa_key
+    requests_mock.get(JWKS_URL, json={"keys": [jwk]})
+    forged = encode_jwt(valid_claims(), sign=lambda data: b"x" * 256)
+
+    with pytest.raises(CredentialsError, match="signature"):
+        CartoAuth(
+            "m2m",
+            api_base_url="https://gcp-us-east1.api.carto.com",
+            access_token=forged,
+            verify_token=True,
+        )
@@ -0,0 +1,103 @@
+import time
+import threading
+
+from carto_auth import CartoAuth
+from carto_auth.metrics import Metrics, prometheus_exporter
+
+
+def test_counters():
+    metrics = Metrics()
+    metrics.inc("cache_requests_total", layer="memory", result="hit")
+    metrics.inc("cache_requests_total", layer="memory", result="hit")
+    metrics.inc("cache_requests_total", layer="file", result="miss")
+
+    assert metrics.stats() == {
+        "cache_requests_total": [
+            {"labels": {"layer": "file", "result": "miss"}, "value": 1},
+            {"labels": {"layer": "memory", "result": "hit"}, "value": 2},
+        ]
+    }
+
+
+def test_histograms():
+    metrics = Metrics()
+    for value in (0.1, 0.7, 3):
+        metrics.observe("duration_seconds", value, buckets=(0.5, 1), mode="m2m")
+
+    (sample,) = metrics.stats()["duration_seconds"]
+    assert sample["labels"] == {"mode": "m2m"}
+    assert sample["count"] == 3
+    assert sample["sum"] == 3.8
+    assert list(sample["buckets"].values()) == [1, 2, 3]
+
+
+def test_reset():
+    metrics = Metrics()
+    counter = metrics.counter("token_refreshes_total")
+    counter.inc()
+    metrics.reset()
+    counter.inc()
+
+    assert metrics.stats() == {"token_refreshes_total": [{"labels": {}, "value": 1}]}
+
+
+def test_prometheus_exporter():
+    metrics = Metrics()
+    metrics.inc("token_refreshes_total", mode="m2m")
+    metrics.observe("token_refresh_duration_seconds", 0.2, buckets=(0.1, 1))
+
+    text = metrics.export(prometheus_exporter)
+
+    assert text == (
+        "# TYPE carto_auth_token_refreshes_total counter\n"
+        'carto_auth_token_refreshes_total{mode="m2m"} 1\n'
+        "# TYPE carto_auth_token_refresh_duration_seconds histogram\n"
+        'carto_auth_token_refresh_duration_seconds_bucket{le="0.1"} 0\n'
+        'carto_auth_token_refresh_duration_seconds_bucket{le="1"} 1\n'
+        'carto_auth_token_refresh_duration_seconds_bucket{le="+Inf"} 1\n'
+        "carto_auth_token_refresh_duration_seconds_sum 0.2\n"
+        "carto_auth_token_refresh_duration_seconds_count 1\n"
+    )
+
+
+def test_counters_threads():
+    metrics = Metrics()
+    counter = metrics.counter("cache_requests_total", layer="memory", result="hit")
+    histogram = metrics.histogram("token_ttl_at_use_seconds", buckets=(1,))
+
+    def work():
+        for _ in range(1000):
+            counter.inc()
+            histogram.observe(0.5)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.value == 8000
+    assert metrics.stats()["token_ttl_at_use_seconds"][0]["count"] == 8000
+
+
+def test_token_hits_without_lock():
+    metrics = Metrics()
+    carto_auth = CartoAuth(
+        "m2m",
+        access_token="token-1",
+        expiration=int(time.time() + 3600),
+        use_cache=False,
+        metrics=metrics,
+    )
+    tokens = []
+
+    # The cache hits do not wait for the lock of the metrics
+    with metrics._lock:
+        thread = threading.Thread(
+            target=lambda: tokens.append(carto_auth.get_access_token()), daemon=True
+        )
+        thread.start()
+        thread.join(5)
+
+    assert tokens == ["token-1"]
+    assert metrics.stats()["cache_requests_total"][0]["value"] == 1
@@ -1,5 +1,10 @@
+import pytest
+import socket
+import requests
+
 from urllib.parse import urlparse, parse_qs
 
+from carto_auth.errors import CredentialsError
 from carto_auth.pkce import CartoPKCE
 
 
@@ -58,3 +63,50 @@ def test_token_from_input_mocked(mocker, requests_mock):
     carto_pkce = CartoPKCE(open_browser=False)
     code = carto_pkce.get_auth_response()
     assert code == "abcde"
+
+
+@pytest.fixture
+def local_flow(mocker):
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    open_new = mocker.patch("carto_auth.pkce.webbrowser.open_new", return_value=True)
+
+    def start(timeout=5):
+        carto_pkce = CartoPKCE(open_browser=True, timeout=timeout)
+        carto_pkce.redirect_uri = f"http://localhost:{port}/callback/"
+        future = carto_pkce.get_auth_code_future()
+        auth_url = open_new.call_args[0][0]
+        state = parse_qs(urlparse(auth_url).query)["state"][0]
+        return future, f"http://localhost:{port}/callback/", state
+
+    return start
+
+
+def test_local_server_ignores_stray_requests(local_flow):
+    future, callback_url, state = local_flow()
+
+    assert requests.get(f"{callback_url}favicon.ico").status_code == 404
+    response = requests.get(callback_url, params={"state": "other", "code": "x"})
+    assert response.status_code == 404
+    assert not future.done()
+
+    response = requests.get(callback_url, params={"state": state, "code": "abcde"})
+    assert response.status_code == 200
+    assert future.result(timeout=5) == "abcde"
+
+
+def test_local_server_error(local_flow):
+    future, callback_url, state = local_flow()
+
+    requests.get(callback_url, params={"state": state, "error": "access_denied"})
+
+    with pytest.raises(CredentialsError, match="access_denied"):
+        future.result(timeout=5)
+
+
+def test_local_server_timeout(local_flow):
+    future, _, _ = local_flow(timeout=0.1)
+
+    with pytest.raises(CredentialsError, match="Timeout"):
+        future.result(timeout=5)
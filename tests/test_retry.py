@@ -0,0 +1,172 @@
+import pytest
+import requests
+
+from carto_auth.errors import CredentialsError
+from carto_auth.metrics import Metrics, prometheus_exporter
+from carto_auth.retry import RetryPolicy, CircuitBreaker
+from carto_auth.utils import get_m2m_token_info
+
+TOKEN_URL = "https://auth.carto.com/oauth/token"
+TOKEN_RESPONSE = {
+    "json": {
+        "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+        "expires_in": 86400,
+    }
+}
+
+
+@pytest.fixture
+def sleep_mock(mocker):
+    return mocker.patch("carto_auth.retry.time.sleep")
+
+
+def test_retry_status(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(
+        TOKEN_URL,
+        [{"status_code": 503}, {"status_code": 502}, TOKEN_RESPONSE],
+    )
+    policy = RetryPolicy(max_retries=3, backoff_factor=1)
+
+    token_info = get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    assert token_info["access_token"] == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    assert token_mock.call_count == 3
+    assert sleep_mock.call_count == 2
+    assert 0 <= sleep_mock.call_args_list[0][0][0] <= 1
+    assert 0 <= sleep_mock.call_args_list[1][0][0] <= 2
+
+
+def test_retry_after(requests_mock, sleep_mock):
+    requests_mock.post(
+        TOKEN_URL,
+        [{"status_code": 429, "headers": {"Retry-After": "7"}}, TOKEN_RESPONSE],
+    )
+    policy = RetryPolicy()
+
+    get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    sleep_mock.assert_called_once_with(7.0)
+
+
+def test_retry_exhausted(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(TOKEN_URL, status_code=500)
+    policy = RetryPolicy(max_retries=2)
+
+    with pytest.raises(CredentialsError) as error:
+        get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    assert error.value.retryable is True
+    assert error.value.status_code == 500
+    assert token_mock.call_count == 3
+
+
+def test_retry_deadline(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(
+        TOKEN_URL, status_code=503, headers={"Retry-After": "120"}
+    )
+    policy = RetryPolicy(deadline=60)
+
+    with pytest.raises(CredentialsError):
+        get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    assert token_mock.call_count == 1
+    sleep_mock.assert_not_called()
+
+
+def test_retry_connection_error(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(
+        TOKEN_URL,
+        [{"exc": requests.exceptions.ConnectTimeout}, TOKEN_RESPONSE],
+    )
+    policy = RetryPolicy()
+
+    get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    assert token_mock.call_count == 2
+    assert token_mock.last_request.timeout == (5, 30)
+
+
+def test_retry_not_idempotent(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(TOKEN_URL, status_code=503)
+    policy = RetryPolicy()
+
+    with pytest.raises(CredentialsError):
+        policy.request(requests.Session(), "POST", TOKEN_URL, idempotent=False)
+
+    assert token_mock.call_count == 1
+
+
+def test_fatal_error_not_retried(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(TOKEN_URL, status_code=401, json={})
+    policy = RetryPolicy()
+
+    with pytest.raises(CredentialsError) as error:
+        get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    assert error.value.retryable is False
+    assert token_mock.call_count == 1
+
+
+def test_circuit_breaker(requests_mock, sleep_mock):
+    token_mock = requests_mock.post(TOKEN_URL, status_code=503)
+    policy = RetryPolicy(max_retries=0, failure_threshold=2, recovery_timeout=30)
+
+    for _ in range(2):
+        with pytest.raises(CredentialsError):
+            get_m2m_token_info("1234", "1234567890", policy=policy)
+    assert token_mock.call_count == 2
+
+    with pytest.raises(CredentialsError) as error:
+        get_m2m_token_info("1234", "1234567890", policy=policy)
+    assert "Circuit open" in str(error.value)
+    assert token_mock.call_count == 2
+
+
+def test_circuit_breaker_half_open(mocker):
+    monotonic = mocker.patch("carto_auth.retry.time.monotonic", return_value=100)
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    breaker.record_failure()
+
+    with pytest.raises(CredentialsError):
+        breaker.before_request()
+
+    monotonic.return_value = 131
+    breaker.before_request()  # probe request
+    with pytest.raises(CredentialsError):
+        breaker.before_request()
+
+    breaker.record_success()
+    breaker.before_request()
+
+
+def test_retry_metrics(requests_mock, sleep_mock):
+    requests_mock.post(TOKEN_URL, [{"status_code": 503}, TOKEN_RESPONSE])
+    metrics = Metrics()
+    policy = RetryPolicy(metrics=metrics)
+
+    get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    stats = metrics.stats()
+    labels = {"method": "POST", "host": "auth.carto.com"}
+    assert stats["http_requests_total"] == [
+        {"labels": dict(labels, status="200"), "value": 1},
+        {"labels": dict(labels, status="503"), "value": 1},
+    ]
+    assert stats["http_request_duration_seconds"][0]["count"] == 2
+
+
+def test_retry_metrics_connection_error(requests_mock, sleep_mock):
+    requests_mock.post(
+        TOKEN_URL, [{"exc": requests.exceptions.ConnectionError}, TOKEN_RESPONSE]
+    )
+    metrics = Metrics()
+    policy = RetryPolicy(metrics=metrics)
+
+    get_m2m_token_info("1234", "1234567890", policy=policy)
+
+    labels = {"method": "POST", "host": "auth.carto.com"}
+    assert metrics.stats()["http_requests_total"] == [
+        {"labels": dict(labels, status="200"), "value": 1},
+        {"labels": dict(labels, status="error"), "value": 1},
+    ]
+    assert 'status="error"} 1' in metrics.export(prometheus_exporter)
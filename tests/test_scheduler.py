@@ -0,0 +1,160 @@
+import time
+import pytest
+import threading
+
+from carto_auth import CartoAuth, CredentialsError
+from carto_auth.scheduler import RefreshScheduler
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timeout waiting for the condition"
+        time.sleep(0.01)
+
+
+def token_info(client_id, client_secret, **kwargs):
+    return {
+        "access_token": f"token-{client_id}",
+        "expiration": int(time.time() + 3600),
+    }
+
+
+def test_refresh_time_jitter(new_carto_auth):
+    expiration = int(time.time() + 3600)
+    carto_auths = [
+        new_carto_auth(access_token="token-1", expiration=expiration) for _ in range(20)
+    ]
+    scheduler = RefreshScheduler(refresh_skew=300, jitter=0.5)
+    for carto_auth in carto_auths:
+        scheduler.add(carto_auth)
+
+    refresh_times = sorted(refresh_time for refresh_time, _, _ in scheduler._heap)
+    deadline = carto_auths[0]._token.deadline
+    # Spread between 300 seconds and half the lifetime before the expiration
+    assert refresh_times[0] >= deadline - 300 - 0.5 * 3300 - 1
+    assert refresh_times[-1] <= deadline - 300 + 1
+    assert refresh_times[-1] - refresh_times[0] > 60
+    assert len(scheduler) == 20
+
+
+def test_scheduler_refresh(new_carto_auth, get_m2m):
+    get_m2m.side_effect = token_info
+    carto_auths = [new_carto_auth(client_id=str(i)) for i in range(10)]
+
+    with RefreshScheduler(max_concurrency=3) as scheduler:
+        for carto_auth in carto_auths:
+            scheduler.add(carto_auth)
+        wait_until(lambda: get_m2m.call_count == 10)
+        assert scheduler.is_running()
+
+    assert not scheduler.is_running()
+    # The tokens were renewed before their first use
+    for i, carto_auth in enumerate(carto_auths):
+        wait_until(lambda: carto_auth._access_token is not None)
+        assert carto_auth.get_access_token() == f"token-{i}"
+    assert get_m2m.call_count == 10
+
+
+def test_scheduler_max_concurrency(new_carto_auth, get_m2m):
+    lock = threading.Lock()
+    running = []
+    concurrency = []
+
+    def slow_token_info(client_id, client_secret, **kwargs):
+        with lock:
+            running.append(client_id)
+            concurrency.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(client_id)
+        return token_info(client_id, client_secret)
+
+    get_m2m.side_effect = slow_token_info
+    scheduler = RefreshScheduler(max_concurrency=2)
+    for i in range(8):
+        scheduler.add(new_carto_auth(client_id=str(i)))
+
+    with scheduler:
+        wait_until(lambda: get_m2m.call_count == 8)
+
+    assert max(concurrency) == 2
+
+
+def test_scheduler_priority(new_carto_auth, get_m2m):
+    calls = []
+
+    def record_token_info(client_id, client_secret, **kwargs):
+        calls.append(client_id)
+        return token_info(client_id, client_secret)
+
+    get_m2m.side_effect = record_token_info
+    carto_auths = [new_carto_auth(client_id=str(i)) for i in range(4)]
+    # Used recently: the identities most likely to be used next
+    carto_auths[2]._last_used = time.monotonic() - 1
+    carto_auths[3]._last_used = time.monotonic()
+
+    scheduler = RefreshScheduler(max_concurrency=1)
+    for carto_auth in carto_auths:
+        scheduler.add(carto_auth)
+
+    with scheduler:
+        wait_until(lambda: get_m2m.call_count == 4)
+
+    assert calls[:2] == ["3", "2"]
+
+
+def test_scheduler_retry(new_carto_auth, get_m2m, mocker):
+    mocker.patch("carto_auth.scheduler.REFRESH_RETRY_INTERVAL", 0.01)
+    get_m2m.side_effect = [
+        CredentialsError("Service unavailable", retryable=True),
+        token_info("1234", "1234567890"),
+    ]
+    carto_auth = new_carto_auth()
+
+    with RefreshScheduler() as scheduler:
+        scheduler.add(carto_auth)
+        wait_until(lambda: carto_auth._access_token == "token-1234")
+
+    assert get_m2m.call_count == 2
+
+
+def test_scheduler_renewed_by_other_means(new_carto_auth, get_m2m):
+    get_m2m.side_effect = token_info
+    carto_auth = new_carto_auth(access_token="token-1", expiration=int(time.time()))
+    scheduler = RefreshScheduler()
+    scheduler.add(carto_auth)
+
+    # Renewed inline after it was scheduled, for example after a 401 response
+    carto_auth._access_token = "token-2"
+    carto_auth._expiration = int(time.time() + 3600)
+
+    with scheduler:
+        wait_until(
+            lambda: scheduler._heap and scheduler._heap[0][0] > time.monotonic() + 60
+        )
+
+    assert carto_auth.get_access_token() == "token-2"
+    get_m2m.assert_not_called()
+
+
+def test_scheduler_add_remove(new_carto_auth):
+    scheduler = RefreshScheduler()
+    carto_auth = new_carto_auth(
+        access_token="token-1", expiration=int(time.time() + 3600)
+    )
+    scheduler.add(carto_auth)
+    scheduler.add(carto_auth)
+
+    assert carto_auth in scheduler
+    assert len(scheduler) == 1
+
+    scheduler.remove(carto_auth)
+    assert carto_auth not in scheduler
+    assert len(scheduler) == 0
+
+    with pytest.raises(CredentialsError, match="only available for m2m"):
+        scheduler.add(CartoAuth("oauth", access_token="token-1", use_cache=False))
+
+    with pytest.raises(ValueError):
+        RefreshScheduler(max_concurrency=0)
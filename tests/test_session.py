@@ -0,0 +1,93 @@
+import time
+import pytest
+import requests
+
+from carto_auth import CartoAuth, CredentialsError, Metrics
+
+CONNECTIONS_URL = "https://gcp-us-east1.api.carto.com/v3/connections"
+
+
+@pytest.fixture
+def carto_auth(new_carto_auth, get_m2m):
+    # The token is renewed to token-2
+    get_m2m.return_value = {
+        "access_token": "token-2",
+        "expiration": int(time.time() + 3600),
+    }
+    return new_carto_auth(
+        access_token="token-1",
+        expiration=int(time.time() + 3600),
+        metrics=Metrics(),
+    )
+
+
+def test_requests_auth(carto_auth, get_m2m, requests_mock):
+    api_mock = requests_mock.get(CONNECTIONS_URL, json={"data": []})
+
+    session = carto_auth.get_api_session()
+    response = session.get("/v3/connections")
+
+    assert response.json() == {"data": []}
+    assert api_mock.last_request.headers["Authorization"] == "Bearer token-1"
+    get_m2m.assert_not_called()
+
+
+def test_requests_auth_unauthorized(carto_auth, get_m2m, requests_mock):
+    api_mock = requests_mock.post(
+        CONNECTIONS_URL,
+        [{"status_code": 401}, {"status_code": 200, "json": {"id": "1"}}],
+    )
+
+    session = carto_auth.get_api_session()
+    response = session.post(CONNECTIONS_URL, json={"name": "connection"})
+
+    assert response.status_code == 200
+    assert [r.status_code for r in response.history] == [401]
+    assert [r.headers["Authorization"] for r in api_mock.request_history] == [
+        "Bearer token-1",
+        "Bearer token-2",
+    ]
+    assert api_mock.last_request.json() == {"name": "connection"}
+    assert carto_auth.get_access_token() == "token-2"
+    get_m2m.assert_called_once()
+
+
+def test_requests_auth_unauthorized_once(carto_auth, get_m2m, requests_mock):
+    api_mock = requests_mock.get(CONNECTIONS_URL, status_code=401)
+
+    session = carto_auth.get_api_session()
+    response = session.get("/v3/connections")
+
+    assert response.status_code == 401
+    assert api_mock.call_count == 2
+    get_m2m.assert_called_once()
+
+
+def test_requests_auth_unauthorized_coalesced(carto_auth, get_m2m, requests_mock):
+
+    def api_response(request, context):
+        if request.headers["Authorization"] == "Bearer token-1":
+            context.status_code = 401
+            return {}
+        return {"data": []}
+
+    requests_mock.get(CONNECTIONS_URL, json=api_response)
+    session = carto_auth.get_api_session()
+
+    # Requests prepared with the same token before it is renewed
+    request = requests.Request("GET", CONNECTIONS_URL)
+    prepared = [session.prepare_request(request) for _ in range(4)]
+    responses = [session.send(request) for request in prepared]
+
+    assert [r.status_code for r in responses] == [200] * 4
+    get_m2m.assert_called_once()
+    assert carto_auth.stats()["unauthorized_retries_total"][0]["value"] == 4
+
+
+def test_api_session_without_api_base_url(requests_mock):
+    carto_auth = CartoAuth("oauth", access_token="token-1", use_cache=False)
+    session = carto_auth.get_api_session()
+
+    with pytest.raises(CredentialsError, match="api_base_url required"):
+        session.get("/v3/connections")
+    assert requests_mock.call_count == 0
@@ -0,0 +1,184 @@
+import os
+import time
+import pytest
+import threading
+
+from carto_auth.shm import SharedTokenSlot, get_shared_slot_filepath
+from carto_auth.metrics import Metrics
+from carto_auth.retry import RetryPolicy
+from carto_auth.token_state import TokenState
+
+fork_only = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+
+
+def run_in_child(func):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            code = 0 if func() else 1
+        except BaseException:
+            code = 2
+        os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status)
+
+
+def test_shared_token_slot(tmp_path):
+    slot = SharedTokenSlot(tmp_path / "token.shm")
+    other = SharedTokenSlot(tmp_path / "token.shm")
+    expiration = int(time.time() + 3600)
+
+    assert slot.read() is None
+    assert slot.generation() == 0
+
+    with slot.lock():
+        generation = slot.write(TokenState("token-1", expiration))
+
+    assert other.generation() == generation == 2
+    generation, token = other.read()
+    assert token.access_token == "token-1"
+    assert token.expiration == expiration
+    assert oct(os.stat(tmp_path / "token.shm").st_mode & 0o777) == "0o600"
+
+
+def test_shared_token_slot_interrupted_write(tmp_path):
+    slot = SharedTokenSlot(tmp_path / "token.shm")
+    slot.write(TokenState("token-1", int(time.time() + 3600)))
+
+    # A writer died in the middle of a write
+    slot._mmap[0:8] = (3).to_bytes(8, "little")
+    assert slot.read() is None
+
+    assert slot.write(TokenState("token-2", int(time.time() + 3600))) == 4
+    assert slot.read()[1].access_token == "token-2"
+
+
+def test_shared_token_slot_capacity(tmp_path):
+    slot = SharedTokenSlot(tmp_path / "token.shm", capacity=8)
+
+    with pytest.raises(ValueError):
+        slot.write(TokenState("a" * 9, int(time.time() + 3600)))
+
+
+def test_shared_memory_refresh(new_carto_auth, get_m2m):
+    expiration = int(time.time() + 3600)
+    first = new_carto_auth(shared_memory=True)
+    second = new_carto_auth(shared_memory=True)
+
+    assert first.get_access_token() == "token-1"
+    assert second.get_access_token() == "token-1"
+    get_m2m.assert_called_once()
+
+    # Renewed early by one process, for example after a 401 response
+    get_m2m.return_value = {"access_token": "token-2", "expiration": expiration}
+    first._refresh_access_token("token-1")
+
+    assert second.get_access_token() == "token-2"
+    assert get_m2m.call_count == 2
+    assert get_shared_slot_filepath(first._cache_key).exists()
+
+
+@fork_only
+def test_shared_memory_fork(new_carto_auth, get_m2m):
+    expiration = int(time.time() + 3600)
+    carto_auth = new_carto_auth(shared_memory=True)
+    assert carto_auth.get_access_token() == "token-1"
+
+    def refresh_in_child():
+        get_m2m.return_value = {"access_token": "token-2", "expiration": expiration}
+        return carto_auth._refresh_access_token("token-1") == "token-2"
+
+    assert run_in_child(refresh_in_child) == 0
+
+    # The parent reads the token renewed by the child
+    assert carto_auth.get_access_token() == "token-2"
+    get_m2m.assert_called_once()
+
+
+@fork_only
+def test_fork_safety(new_carto_auth):
+    carto_auth = new_carto_auth(
+        shared_memory=True, access_token="token-1", expiration=int(time.time() + 3600)
+    )
+    session = carto_auth._get_session()
+
+    def check_child():
+        # The lock held by the parent is not held in the child
+        return (
+            carto_auth._refresh_lock.acquire(timeout=1)
+            and carto_auth._get_session() is not session
+            and carto_auth.get_access_token() == "token-1"
+        )
+
+    with carto_auth._refresh_lock:
+        assert run_in_child(check_child) == 0
+
+
+@fork_only
+def test_fork_safety_shared_locks(new_carto_auth, requests_mock):
+    requests_mock.post(
+        "https://auth.carto.com/oauth/token",
+        json={"access_token": "token-2", "expires_in": 3600},
+    )
+    metrics = Metrics()
+    policy = RetryPolicy(metrics=metrics)
+    breaker = policy._get_breaker("https://auth.carto.com/oauth/token")
+    carto_auth = new_carto_auth(
+        shared_memory=True,
+        access_token="token-1",
+        expiration=int(time.time() - 10),
+        metrics=metrics,
+        retry_policy=policy,
+    )
+    miss = metrics.counter("cache_requests_total", layer="memory", result="miss")
+    locks = [metrics._lock, miss._lock, policy._lock, breaker._lock]
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold_locks():
+        for lock in locks:
+            lock.acquire()
+        acquired.set()
+        release.wait()
+        for lock in locks:
+            lock.release()
+
+    thread = threading.Thread(target=hold_locks)
+    thread.start()
+    acquired.wait()
+
+    def check_child():
+        # The locks held by the thread of the parent are not held in the child
+        return carto_auth.get_access_token() == "token-2" and bool(
+            carto_auth.stats()["http_requests_total"]
+        )
+
+    try:
+        assert run_in_child(check_child) == 0
+    finally:
+        release.set()
+        thread.join()
+
+
+@fork_only
+def test_fork_background_refresh(new_carto_auth):
+    expiration = int(time.time() + 3600)
+    shared = new_carto_auth(
+        shared_memory=True, access_token="token-1", expiration=expiration
+    )
+    private = new_carto_auth(access_token="token-1", expiration=expiration)
+    for carto_auth in (shared, private):
+        carto_auth.start_background_refresh()
+
+    def check_child():
+        # Only the object with a shared slot renews the token in the workers
+        return (
+            shared.is_background_refresh_running()
+            and not private.is_background_refresh_running()
+        )
+
+    try:
+        assert run_in_child(check_child) == 0
+    finally:
+        for carto_auth in (shared, private):
+            carto_auth.stop_background_refresh()
@@ -0,0 +1,33 @@
+import time
+
+from carto_auth.token_state import TokenState
+
+
+def test_token_state():
+    token = TokenState("eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX", int(time.time() + 10))
+
+    assert token.access_token == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
+    assert token.is_expired() is False
+    assert 8 < token.ttl() <= 10
+
+
+def test_token_state_expired():
+    assert TokenState().is_expired() is True
+    assert TokenState("token", 0).is_expired() is True
+    assert TokenState("token", int(time.time() - 10)).ttl() < 0
+
+
+def test_token_state_wall_clock_jump(mocker):
+    token = TokenState("token", int(time.time() + 60))
+
+    # The system clock moves forward after the token is received
+    mocker.patch("time.time", return_value=time.time() + 3600)
+
+    assert token.is_expired() is False
+    assert token.ttl() > 0
+
+
+def test_token_state_slots():
+    token = TokenState("token", int(time.time() + 60))
+
+    assert not hasattr(token, "__dict__")
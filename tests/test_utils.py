@@ -1,16 +1,34 @@
+import json
+import time
 import pytest
 import pathlib
+import threading
 
-from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+from carto_auth import utils
 from carto_auth.errors import CredentialsError
 from carto_auth.utils import (
+    create_session,
+    get_session,
+    get_home_dir,
     get_cache_filepath,
+    get_cache_key,
     get_oauth_token_info,
+    get_refresh_token_info,
+    load_refresh_token,
+    save_refresh_token,
+    get_refresh_token_filepath,
     get_m2m_token_info,
     get_api_base_url,
+    get_tenant_api_base_url,
+    load_tenant_cache,
+    save_tenant_cache,
     load_cache_file,
     save_cache_file,
+    lock_cache_file,
     is_token_expired,
+    get_token_ttl,
+    get_expiration,
 )
 
 HERE = pathlib.Path(__file__).parent
@@ -34,9 +52,7 @@ def test_get_oauth_token_info(mocker, requests_mock):
     token_info = get_oauth_token_info(open_browser=False)
 
     assert token_info["access_token"] == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    assert token_info["expiration"] >= int(
-        (datetime.utcnow() + timedelta(seconds=86400)).timestamp()
-    )
+    assert token_info["expiration"] >= int(time.time() + 86400)
 
     # FIXME in CI
     # mocker.patch(
@@ -66,6 +82,84 @@ def test_get_oauth_token_info_error(mocker, requests_mock):
         get_oauth_token_info(open_browser=False)
 
 
+def test_get_oauth_token_info_refresh_token(mocker, requests_mock):
+    pkce = mocker.patch("carto_auth.pkce.CartoPKCE")
+    token_mock = requests_mock.post(
+        "https://auth.carto.com/oauth/token",
+        json={"access_token": "new-token", "expires_in": 86400},
+    )
+
+    token_info = get_oauth_token_info(open_browser=False, refresh_token="rt-1")
+
+    assert token_info["access_token"] == "new-token"
+    # The refresh token is kept when it is not rotated
+    assert token_info["refresh_token"] == "rt-1"
+    assert "grant_type=refresh_token" in token_mock.last_request.text
+    assert "refresh_token=rt-1" in token_mock.last_request.text
+    pkce.assert_not_called()
+
+
+def test_get_oauth_token_info_refresh_token_rejected(mocker, requests_mock):
+    mocker.patch(
+        "carto_auth.pkce.CartoPKCE._input",
+        return_value="carto.com/autorize?code=abcde",
+    )
+    requests_mock.post(
+        "https://auth.carto.com/oauth/token",
+        [
+            {
+                "status_code": 403,
+                "json": {
+                    "error": "invalid_grant",
+                    "error_description": "Unknown or invalid refresh token.",
+                },
+            },
+            {
+                "json": {
+                    "access_token": "browser-token",
+                    "refresh_token": "rt-2",
+                    "expires_in": 86400,
+                }
+            },
+        ],
+    )
+
+    with pytest.raises(CredentialsError, match="invalid refresh token"):
+        get_refresh_token_info("rt-1")
+
+    token_info = get_oauth_token_info(open_browser=False, refresh_token="rt-1")
+
+    assert token_info["access_token"] == "browser-token"
+    assert token_info["refresh_token"] == "rt-2"
+
+
+def test_get_oauth_token_info_refresh_token_unavailable(mocker):
+    pkce = mocker.patch("carto_auth.pkce.CartoPKCE")
+    mocker.patch(
+        "carto_auth.utils.request",
+        side_effect=CredentialsError("Connection failed", retryable=True),
+    )
+
+    with pytest.raises(CredentialsError, match="Connection failed"):
+        get_oauth_token_info(open_browser=False, refresh_token="rt-1")
+    pkce.assert_not_called()
+
+
+def test_save_refresh_token():
+    assert load_refresh_token("key") is None
+
+    save_refresh_token("key", "rt-1")
+
+    filepath = get_refresh_token_filepath("key")
+    assert load_refresh_token("key") == "rt-1"
+    assert filepath.stat().st_mode & 0o777 == 0o600
+
+    save_refresh_token("key", None)
+
+    assert load_refresh_token("key") is None
+    assert not filepath.exists()
+
+
 def test_get_m2m_token_info(requests_mock):
     requests_mock.post(
         "https://auth.carto.com/oauth/token",
@@ -80,9 +174,7 @@ def test_get_m2m_token_info(requests_mock):
     token_info = get_m2m_token_info("1234", "1234567890")
 
     assert token_info["access_token"] == "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX"
-    assert token_info["expiration"] >= int(
-        (datetime.utcnow() + timedelta(seconds=86400)).timestamp()
-    )
+    assert token_info["expiration"] >= int(time.time() + 86400)
 
 
 def test_get_m2m_token_info_error(requests_mock):
@@ -147,6 +239,11 @@ def test_get_cache_filepath():
     filepath = get_cache_filepath("m2m")
     assert str(filepath).endswith(".carto-auth/token_m2m.json")
 
+    filepath = get_cache_filepath("m2m", get_cache_key("m2m", "1234"))
+    assert str(filepath).endswith(
+        f".carto-auth/token_m2m_{get_cache_key('m2m', '1234')}.json"
+    )
+
 
 def test_load_cache_file():
     data = load_cache_file(HERE / "fixtures/token_ok.json")
@@ -182,9 +279,235 @@ def test_save_cache_file(tmp_path):
 
 
 def test_is_token_expired():
-    now = datetime.utcnow()
+    now = time.time()
     assert is_token_expired(None) is True
     assert is_token_expired(0) is True
     assert is_token_expired(1) is True
-    assert is_token_expired((now - timedelta(seconds=10)).timestamp()) is True
-    assert is_token_expired((now + timedelta(seconds=10)).timestamp()) is False
+    assert is_token_expired(now - 10) is True
+    assert is_token_expired(now + 10) is False
+
+
+def test_get_token_ttl():
+    now = time.time()
+    assert get_token_ttl(None) == 0
+    assert get_token_ttl(now - 10) < 0
+    assert 0 < get_token_ttl(now + 10) <= 10
+
+
+def test_get_expiration_is_utc(monkeypatch):
+    # The expiration is a POSIX timestamp regardless of the local timezone
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        assert abs(get_expiration(60) - (time.time() + 60)) <= 1
+    finally:
+        monkeypatch.delenv("TZ")
+        time.tzset()
+
+
+def test_save_cache_file_atomic(tmp_path):
+    data = {
+        "api_base_url": "https://gcp-us-east1.api.carto.com",
+        "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+        "expiration": 1667471700,
+    }
+
+    save_cache_file(tmp_path / "carto_token_saved.json", data)
+    save_cache_file(tmp_path / "carto_token_saved.json", data)
+
+    assert [p.name for p in tmp_path.glob("*.*")] == ["carto_token_saved.json"]
+
+
+def test_load_cache_file_truncated(tmp_path):
+    (tmp_path / "carto_token_truncated.json").write_text('{"api_base_url": "htt')
+
+    assert load_cache_file(tmp_path / "carto_token_truncated.json") is None
+
+
+def test_lock_cache_file(tmp_path):
+    cache_filepath = tmp_path / "carto_token.json"
+    events = []
+
+    def locked(name):
+        with lock_cache_file(cache_filepath):
+            events.append(f"{name}-in")
+            time.sleep(0.05)
+            events.append(f"{name}-out")
+
+    threads = [threading.Thread(target=locked, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert events[0][0] == events[1][0]
+    assert events[2][0] == events[3][0]
+
+
+def test_create_session():
+    session = create_session(pool_connections=2, pool_maxsize=20, keep_alive=False)
+    adapter = session.get_adapter("https://auth.carto.com/oauth/token")
+
+    assert adapter._pool_connections == 2
+    assert adapter._pool_maxsize == 20
+    assert session.headers["Connection"] == "close"
+
+
+def test_get_session():
+    assert get_session() is get_session()
+
+
+def test_get_m2m_token_info_session(requests_mock):
+    requests_mock.post(
+        "https://auth.carto.com/oauth/token",
+        json={
+            "access_token": "eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX",
+            "expires_in": 86400,
+        },
+    )
+    session = create_session()
+    spy = MagicMock(wraps=session.request)
+    session.request = spy
+
+    get_m2m_token_info("1234", "1234567890", session=session)
+
+    spy.assert_called_once()
+
+
+def test_get_api_base_url_tenant_cache(requests_mock):
+    requests_mock.get(
+        "https://accounts.app.carto.com/accounts",
+        json={
+            "tenant_domain": "clausa.app.carto.com",
+        },
+    )
+    config_mock = requests_mock.get(
+        "https://clausa.app.carto.com/config.yaml",
+        text="""
+        apis:
+            baseUrl: "https://gcp-us-east1.api.carto.com"
+        """,
+        headers={"ETag": '"abc"'},
+    )
+
+    for _ in range(2):
+        api_base_url = get_api_base_url("eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX")
+        assert api_base_url == "https://gcp-us-east1.api.carto.com"
+    assert config_mock.call_count == 1
+
+    # Cache expired, config not modified
+    entry = load_tenant_cache("clausa.app.carto.com")
+    entry["expiration"] = 0
+    save_tenant_cache("clausa.app.carto.com", entry)
+    config_mock = requests_mock.get(
+        "https://clausa.app.carto.com/config.yaml", status_code=304
+    )
+
+    api_base_url = get_api_base_url("eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX")
+    assert api_base_url == "https://gcp-us-east1.api.carto.com"
+    assert config_mock.last_request.headers["If-None-Match"] == '"abc"'
+    assert load_tenant_cache("clausa.app.carto.com")["expiration"] > time.time()
+
+
+def test_get_api_base_url_no_cache(requests_mock):
+    requests_mock.get(
+        "https://accounts.app.carto.com/accounts",
+        json={
+            "tenant_domain": "clausa.app.carto.com",
+        },
+    )
+    requests_mock.get(
+        "https://clausa.app.carto.com/config.yaml",
+        text="""
+        apis:
+            baseUrl: "https://gcp-us-east1.api.carto.com"
+        """,
+    )
+
+    get_api_base_url("eyJhbGciOiJSUzI1NiIsInR5cCI6IkpX", use_cache=False)
+
+    assert load_tenant_cache("clausa.app.carto.com") is None
+
+
+def test_get_api_base_url_not_modified_without_etag(requests_mock):
+    requests_mock.get(
+        "https://clausa.app.carto.com/config.yaml",
+        [
+            {
+                "text": 'apis:\n  baseUrl: "https://gcp-us-east1.api.carto.com"',
+                "headers": {"ETag": '"abc"'},
+            },
+            {"status_code": 304},
+            {"status_code": 304},
+        ],
+    )
+    for _ in range(3):
+        get_tenant_api_base_url("clausa.app.carto.com")
+        entry = load_tenant_cache("clausa.app.carto.com")
+        entry["expiration"] = 0
+        save_tenant_cache("clausa.app.carto.com", entry)
+
+    # The stored ETag is kept when the 304 response has none
+    assert requests_mock.last_request.headers["If-None-Match"] == '"abc"'
+    assert load_tenant_cache("clausa.app.carto.com")["etag"] == '"abc"'
+
+
+def test_get_api_base_url_unwritable_home(mocker, requests_mock):
+    requests_mock.get(
+        "https://clausa.app.carto.com/config.yaml",
+        text='apis:\n  baseUrl: "https://gcp-us-east1.api.carto.com"',
+    )
+    mocker.patch(
+        "carto_auth.utils.get_home_dir", side_effect=PermissionError("Read-only")
+    )
+
+    api_base_url = get_tenant_api_base_url("clausa.app.carto.com")
+
+    assert api_base_url == "https://gcp-us-east1.api.carto.com"
+
+
+def test_load_cache_file_memory(mocker, tmp_path):
+    cache_filepath = tmp_path / "carto_token.json"
+    data = {
+        "api_base_url": "https://gcp-us-east1.api.carto.com",
+        "access_token": "token-1",
+        "expiration": 1667471700,
+    }
+    cache_filepath.write_text(json.dumps(data))
+    json_load = mocker.spy(json, "load")
+
+    assert load_cache_file(cache_filepath) == data
+    assert load_cache_file(cache_filepath) == data
+    assert json_load.call_count == 1
+
+    # Modified by another process
+    cache_filepath.write_text(json.dumps(dict(data, access_token="token-2")))
+    assert load_cache_file(cache_filepath)["access_token"] == "token-2"
+    assert json_load.call_count == 2
+
+
+def test_save_cache_file_unchanged(mocker, tmp_path):
+    cache_filepath = tmp_path / "carto_token.json"
+    data = {
+        "api_base_url": "https://gcp-us-east1.api.carto.com",
+        "access_token": "token-1",
+        "expiration": 1667471700,
+    }
+    write_mock = mocker.spy(utils, "write_json_file")
+
+    save_cache_file(cache_filepath, data)
+    save_cache_file(cache_filepath, dict(data))
+    assert write_mock.call_count == 1
+
+    save_cache_file(cache_filepath, dict(data, access_token="token-2"))
+    assert write_mock.call_count == 2
+    assert load_cache_file(cache_filepath)["access_token"] == "token-2"
+
+
+def test_get_home_dir_memoized(mocker, home_dir):
+    mkdir = mocker.spy(pathlib.Path, "mkdir")
+
+    assert get_home_dir() == home_dir / ".carto-auth"
+    assert get_home_dir() == home_dir / ".carto-auth"
+    assert get_cache_filepath("m2m") == home_dir / ".carto-auth/token_m2m.json"
+    assert mkdir.call_count == 1